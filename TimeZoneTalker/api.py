@@ -0,0 +1,544 @@
+"""JSON API for high-frequency clients.
+
+Timer actions return the updated entry as a small JSON payload instead of
+redirecting to the dashboard, so a start/stop cycle costs one lightweight
+request. Requests must carry the session cookie and, while CSRF protection
+is enabled, the token from the page's csrf-token meta tag in X-CSRFToken.
+"""
+import calendar
+from datetime import date, datetime, timedelta
+from functools import wraps
+import io
+import json
+import math
+import os
+from flask import Response, jsonify, request, send_file
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from sqlalchemy.orm import joinedload
+from wtforms.validators import ValidationError
+from app import app, db
+from models import Job, Project, Task, TimeEntry
+from utils import get_weekly_stats, get_project_stats
+from stats import project_totals
+import importer
+import jobs
+import planner
+import pubsub
+import reporting
+import sweeper
+import teams
+import timer
+import timezones
+
+# Expose the token to templates so scripts can send it with API calls
+app.jinja_env.globals.setdefault('csrf_token', generate_csrf)
+
+
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+
+def api_login_required(view):
+    """Like login_required, but answers 401 JSON instead of redirecting to the login page"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return api_error('authentication required', 401)
+        if request.method == 'POST' and app.config.get('WTF_CSRF_ENABLED', True):
+            try:
+                validate_csrf(request.headers.get('X-CSRFToken'))
+            except ValidationError as e:
+                return api_error(str(e), 400)
+        return view(*args, **kwargs)
+    return wrapped
+
+
+@app.template_filter('utc_timestamp')
+def utc_timestamp(dt):
+    """Unix timestamp of a naive UTC datetime"""
+    return calendar.timegm(dt.utctimetuple()) if dt else None
+
+
+def serialize_entry(entry, now=None):
+    """Compact timer state for API responses"""
+    if entry is None:
+        return None
+    if now is None:
+        now = datetime.utcnow()
+    if entry.status == 'running':
+        duration = max(int((now - entry.start_time).total_seconds()), 0)
+    else:
+        duration = entry.duration or 0
+    return {
+        'id': entry.id,
+        'status': entry.status,
+        'project': {'id': entry.project.id, 'name': entry.project.name, 'color': entry.project.color},
+        'task': {'id': entry.task.id, 'name': entry.task.name} if entry.task else None,
+        'description': entry.description,
+        'started_at': utc_timestamp(entry.start_time),
+        'duration': duration,
+    }
+
+
+def _owned_entry(entry_id):
+    return TimeEntry.query.filter_by(id=entry_id, user_id=current_user.id).first()
+
+
+@app.route('/api/v1/timer', methods=['GET'])
+@api_login_required
+def api_timer_current():
+    """The user's running timer, or null"""
+    entry = TimeEntry.query.options(joinedload(TimeEntry.project), joinedload(TimeEntry.task)).filter_by(
+        user_id=current_user.id, status='running'
+    ).first()
+    return jsonify({'entry': serialize_entry(entry)})
+
+
+def report_days(value):
+    """Clamp the ?days= report period to between one day and a year"""
+    return min(max(value or 30, 1), 366)
+
+
+@app.route('/api/v1/dashboard', methods=['GET'])
+@api_login_required
+def api_dashboard():
+    """Dashboard chart data and the running timer"""
+    entry = TimeEntry.query.options(joinedload(TimeEntry.project), joinedload(TimeEntry.task)).filter_by(
+        user_id=current_user.id, status='running'
+    ).first()
+    return jsonify({
+        'weekly': get_weekly_stats(current_user.id, current_user.timezone),
+        'projects': get_project_stats(current_user.id),
+        'timer': serialize_entry(entry),
+    })
+
+
+@app.route('/api/v1/reports', methods=['GET'])
+@api_login_required
+def api_reports():
+    """Report chart data and per-project totals for the last ?days= days (default 30)"""
+    since = datetime.utcnow() - timedelta(days=report_days(request.args.get('days', type=int)))
+    return jsonify({
+        'weekly': get_weekly_stats(current_user.id, current_user.timezone),
+        'projects': get_project_stats(current_user.id),
+        'project_totals': project_totals(current_user.id, since=since),
+    })
+
+
+@app.route('/api/v1/reports/timeseries', methods=['GET'])
+@api_login_required
+def api_report_timeseries():
+    """Time per hour, day, week or month of ?start= to ?end= (exclusive, default this week), by ?group_by="""
+    start, end = reporting.default_range(current_user.timezone)
+    try:
+        if request.args.get('start'):
+            start = date.fromisoformat(request.args['start'])
+        if request.args.get('end'):
+            end = date.fromisoformat(request.args['end'])
+    except ValueError:
+        return api_error('start and end must be YYYY-MM-DD', 400)
+    try:
+        result = reporting.time_series(
+            current_user.id, start, end,
+            granularity=request.args.get('granularity', 'day'),
+            group_by=reporting.parse_group_by(request.args.get('group_by')),
+            timezone_str=current_user.timezone or 'UTC',
+        )
+    except reporting.ReportError as e:
+        return api_error(str(e), 400)
+    return jsonify(result)
+
+
+@app.route('/api/v1/timer/events', methods=['GET'])
+@api_login_required
+def api_timer_events():
+    """Server-Sent Events stream of the user's timer changes, from any tab or device"""
+    if not pubsub.events_enabled():
+        return api_error('timer events are disabled', 404)
+    subscription = pubsub.timer_events.subscribe(pubsub.timer_channel(current_user.id))
+    heartbeat = app.config['TIMER_EVENTS_HEARTBEAT']
+
+    # Runs after the request context is gone, so it must not touch the session
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                message = subscription.get(timeout=heartbeat)
+                if message is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield f'event: timer\ndata: {json.dumps(message)}\n\n'
+        finally:
+            subscription.close()
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def _timer_settings(user):
+    max_hours, idle_minutes = sweeper.limits(user)
+    return {
+        'max_hours': user.timer_max_hours,
+        'idle_minutes': user.timer_idle_minutes,
+        'effective': {'max_hours': max_hours, 'idle_minutes': idle_minutes},
+    }
+
+
+@app.route('/api/v1/timer/settings', methods=['GET', 'POST'])
+@api_login_required
+def api_timer_settings():
+    """The user's auto-stop rules; POST max_hours and/or idle_minutes (null for the default, 0 for off)"""
+    user = current_user.user
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        for field, column, limit in (('max_hours', 'timer_max_hours', 24 * 31),
+                                     ('idle_minutes', 'timer_idle_minutes', 24 * 60)):
+            if field not in data:
+                continue
+            value = data[field]
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int)
+                                      or not 0 <= value <= limit):
+                return api_error(f'{field} must be null or a whole number from 0 to {limit}', 400)
+            setattr(user, column, value)
+        if 'idle_minutes' in data:
+            # Activity isn't recorded while no idle rule applies, so start counting from now
+            user.last_active_at = datetime.utcnow()
+        db.session.commit()
+    return jsonify(_timer_settings(user))
+
+
+@app.route('/api/v1/timer/<int:entry_id>', methods=['GET'])
+@api_login_required
+def api_timer_get(entry_id):
+    entry = _owned_entry(entry_id)
+    if not entry:
+        return api_error('time entry not found', 404)
+    return jsonify({'entry': serialize_entry(entry)})
+
+
+@app.route('/api/v1/timer/start', methods=['POST'])
+@api_login_required
+def api_timer_start():
+    data = request.get_json(silent=True) or {}
+    try:
+        project_id = int(data.get('project_id'))
+    except (TypeError, ValueError):
+        return api_error('project_id is required', 400)
+    description = data.get('description')
+    if description is not None and not isinstance(description, str):
+        return api_error('description must be a string', 400)
+
+    # Verify project belongs to user
+    project = Project.query.filter_by(id=project_id, user_id=current_user.id).first()
+    if not project:
+        return api_error('invalid project', 400)
+
+    # Ignore a task that does not belong to the project, as the form view does
+    try:
+        task_id = int(data.get('task_id') or 0) or None
+    except (TypeError, ValueError):
+        task_id = None
+    if task_id:
+        task = Task.query.filter_by(id=task_id, project_id=project_id).first()
+        if not task:
+            task_id = None
+
+    entry = timer.start(
+        user_id=current_user.id,
+        project_id=project_id,
+        task_id=task_id,
+        description=description or None,
+        timezone_str=current_user.timezone or 'UTC'
+    )
+    return jsonify({'entry': serialize_entry(entry)}), 201
+
+
+def _transition(entry_id, action):
+    try:
+        entry = action(entry_id, current_user.id, current_user.timezone or 'UTC')
+    except timer.TimerNotFound:
+        return api_error('time entry not found', 404)
+    except timer.TimerConflict as e:
+        return jsonify({'error': str(e), 'entry': serialize_entry(e.entry)}), 409
+    return jsonify({'entry': serialize_entry(entry)})
+
+
+@app.route('/api/v1/timer/<int:entry_id>/pause', methods=['POST'])
+@api_login_required
+def api_timer_pause(entry_id):
+    return _transition(entry_id, timer.pause)
+
+
+@app.route('/api/v1/timer/<int:entry_id>/resume', methods=['POST'])
+@api_login_required
+def api_timer_resume(entry_id):
+    return _transition(entry_id, timer.resume)
+
+
+@app.route('/api/v1/timer/<int:entry_id>/stop', methods=['POST'])
+@api_login_required
+def api_timer_stop(entry_id):
+    return _transition(entry_id, timer.stop)
+
+
+@app.route('/api/v1/time-entries/import', methods=['POST'])
+@api_login_required
+def api_import_entries():
+    """Bulk import entries from an uploaded CSV or NDJSON file (multipart field 'file')"""
+    upload = request.files.get('file')
+    if upload is None:
+        return api_error('file is required', 400)
+    fmt = request.form.get('format') or ('ndjson' if upload.filename.endswith(('.ndjson', '.jsonl')) else 'csv')
+    if fmt not in importer.READERS:
+        return api_error(f'unsupported format {fmt}', 400)
+
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8', newline='')
+    result = importer.import_entries(
+        current_user.id, stream, fmt=fmt, batch_size=app.config['IMPORT_BATCH_SIZE']
+    )
+    return jsonify(result.to_dict())
+
+
+def _parse_batch_timestamp(value, source):
+    """Naive local datetime and its zone; aware timestamps are read as UTC"""
+    dt = datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        return dt, source
+    return dt.astimezone(timezones.UTC).replace(tzinfo=None), 'UTC'
+
+
+def _overflowing_index(values, sources, targets):
+    """Index of the first timestamp whose conversion leaves the datetime range"""
+    for index, (value, source, target) in enumerate(zip(values, sources, targets)):
+        try:
+            timezones.convert_one(value, source, target)
+        except OverflowError:
+            return index
+    return 0
+
+
+@app.route('/api/v1/timezones/convert-batch', methods=['POST'])
+@api_login_required
+def api_convert_batch():
+    """Convert many timestamps at once
+
+    Body: {"timestamps": [...], "from": zone or [zones], "to": zone or [zones]}.
+    Naive timestamps are read in their "from" zone, ones with an offset as UTC.
+    """
+    data = request.get_json(silent=True) or {}
+    values = data.get('timestamps')
+    if not isinstance(values, list):
+        return api_error('timestamps must be a list', 400)
+    if len(values) > app.config['TIMEZONE_BATCH_MAX_ITEMS']:
+        return api_error(f"at most {app.config['TIMEZONE_BATCH_MAX_ITEMS']} timestamps per request", 413)
+
+    try:
+        sources = timezones.broadcast_zones(data.get('from') or 'UTC', len(values))
+        targets = timezones.broadcast_zones(data.get('to') or 'UTC', len(values))
+    except (TypeError, ValueError):
+        return api_error('from and to must be a zone name or one zone per timestamp', 400)
+
+    naive, naive_sources = [], []
+    for index, (value, source) in enumerate(zip(values, sources)):
+        try:
+            dt, source = _parse_batch_timestamp(value, source)
+        except (ValueError, OverflowError):
+            return api_error(f'invalid timestamp at index {index}', 400)
+        naive.append(dt)
+        naive_sources.append(source)
+
+    try:
+        converted = timezones.convert_batch(naive, naive_sources, targets)
+    except timezones.UnknownTimezoneError as e:
+        return api_error(f'unknown timezone {e.args[0]!r}', 400)
+    except TypeError:
+        return api_error('zone names must be strings', 400)
+    except OverflowError:
+        return api_error(f'invalid timestamp at index {_overflowing_index(naive, naive_sources, targets)}', 400)
+
+    return jsonify({'results': [
+        {'datetime': local.isoformat() + timezones.format_offset(offset), 'utc_offset': offset}
+        for local, offset in converted
+    ]})
+
+
+def _utc_iso(dt):
+    return dt.isoformat() + 'Z'
+
+
+@app.route('/api/v1/timezones/meeting-windows', methods=['POST'])
+@api_login_required
+def api_meeting_windows():
+    """Windows when every participant is within working hours
+
+    Body: {"participants": [{"timezone": ..., "start": "09:00", "end": "17:00",
+    "weekdays": [0, 1, 2, 3, 4]}], "start": ISO date or datetime (UTC, default
+    now), "weeks": 2, "min_minutes": 30}.
+    """
+    data = request.get_json(silent=True) or {}
+    people = data.get('participants')
+    if not isinstance(people, list) or not people:
+        return api_error('participants must be a non-empty list', 400)
+    if len(people) > planner.MAX_PARTICIPANTS:
+        return api_error(f'at most {planner.MAX_PARTICIPANTS} participants', 413)
+
+    try:
+        participants = [
+            planner.Participant(
+                person['timezone'],
+                planner.parse_hours(person.get('start', '09:00')),
+                planner.parse_hours(person.get('end', '17:00')),
+                [int(day) for day in person.get('weekdays', planner.WORKDAYS)],
+            )
+            for person in people
+        ]
+    except timezones.UnknownTimezoneError as e:
+        return api_error(f'unknown timezone {e.args[0]!r}', 400)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return api_error('each participant needs a timezone and HH:MM start and end', 400)
+
+    try:
+        start = _parse_batch_timestamp(data['start'], 'UTC')[0] if data.get('start') else datetime.utcnow()
+        weeks = float(data.get('weeks', 2))
+        min_minutes = float(data.get('min_minutes', 30))
+    except (TypeError, ValueError):
+        return api_error('invalid start, weeks or min_minutes', 400)
+    if not 0 < weeks <= planner.MAX_WEEKS:
+        return api_error(f'weeks must be between 0 and {planner.MAX_WEEKS}', 400)
+    if not math.isfinite(min_minutes) or min_minutes > 24 * 60:
+        return api_error('min_minutes must be a number of minutes up to a day', 400)
+
+    try:
+        windows = planner.find_meeting_windows(
+            participants, start, start + timedelta(weeks=weeks), min_duration=timedelta(minutes=max(min_minutes, 0))
+        )
+    except timezones.UnknownTimezoneError as e:
+        return api_error(f'unknown timezone {e.args[0]!r}', 400)
+    except OverflowError:
+        return api_error('start is out of range', 400)
+    return jsonify({'windows': [
+        {'start': _utc_iso(window_start), 'end': _utc_iso(window_end),
+         'minutes': int((window_end - window_start).total_seconds()) // 60}
+        for window_start, window_end in windows
+    ]})
+
+
+def _team_report(scope, scope_id):
+    if not teams.can_view(current_user.id, scope, scope_id):
+        return api_error(f'{scope} not found', 404)
+    since, until = teams.default_range()
+    try:
+        if request.args.get('since'):
+            since = date.fromisoformat(request.args['since'])
+        if request.args.get('until'):
+            until = date.fromisoformat(request.args['until'])
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = teams.page_size(int(request.args.get('per_page', 0)))
+    except ValueError:
+        return api_error('since and until must be YYYY-MM-DD, page and per_page integers', 400)
+    if not 0 < (until - since).days <= 366:
+        return api_error('until must be after since and at most a year later', 400)
+
+    try:
+        result = teams.report(
+            scope, scope_id, since, until,
+            group_by=request.args.get('group_by', 'team'),
+            source=request.args.get('source', 'rollups'),
+            page=page,
+            per_page=per_page,
+        )
+    except teams.ReportError as e:
+        return api_error(str(e), 400)
+    return jsonify(result)
+
+
+@app.route('/api/v1/organizations/<int:organization_id>/report', methods=['GET'])
+@api_login_required
+def api_organization_report(organization_id):
+    """Time across an organization (admins only); ?since=&until=&group_by=&source=&page=&per_page="""
+    return _team_report('organization', organization_id)
+
+
+@app.route('/api/v1/teams/<int:team_id>/report', methods=['GET'])
+@api_login_required
+def api_team_report(team_id):
+    """Time across a team (its managers and organization admins); same parameters"""
+    return _team_report('team', team_id)
+
+
+@app.route('/api/v1/jobs', methods=['POST'])
+@api_login_required
+def api_submit_job():
+    """Queue a report, team_report, export or import job
+
+    JSON {"kind": ..., "params": {...}}, or for imports a multipart form with
+    'file' and optional 'format'. Answers 202, or 200 with a recent job that
+    had the same parameters.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        kind, params = request.form.get('kind', 'import'), {}
+        if request.form.get('format'):
+            params['format'] = request.form['format']
+        elif upload.filename.endswith(('.ndjson', '.jsonl')):
+            params['format'] = 'ndjson'
+        payload = upload.read(app.config['JOB_MAX_UPLOAD_BYTES'] + 1)
+        if len(payload) > app.config['JOB_MAX_UPLOAD_BYTES']:
+            return api_error('file is too large', 413)
+    else:
+        body = request.get_json(silent=True) or {}
+        kind, params, payload = body.get('kind'), body.get('params') or {}, None
+        if not isinstance(params, dict):
+            return api_error('params must be an object', 400)
+    if kind == 'import' and payload is None:
+        return api_error('file is required', 400)
+
+    try:
+        job, reused = jobs.submit(current_user.id, kind, params, payload=payload)
+    except jobs.JobError as e:
+        return api_error(str(e), 400)
+    response = jsonify({'job': jobs.serialize_job(job), 'reused': reused})
+    response.status_code = 200 if reused else 202
+    response.headers['Location'] = f'/api/v1/jobs/{job.id}'
+    return response
+
+
+def _owned_job(job_id):
+    return Job.query.filter_by(id=job_id, user_id=current_user.id).first()
+
+
+@app.route('/api/v1/jobs/<int:job_id>', methods=['GET'])
+@api_login_required
+def api_job_status(job_id):
+    """A job's status, with result_url once it has succeeded"""
+    job = _owned_job(job_id)
+    if job is None:
+        return api_error('job not found', 404)
+    response = jsonify({'job': jobs.serialize_job(job)})
+    if job.status in jobs.ACTIVE_STATUSES:
+        response.headers['Retry-After'] = '2'
+    return response
+
+
+@app.route('/api/v1/jobs/<int:job_id>/result', methods=['GET'])
+@api_login_required
+def api_job_result(job_id):
+    """Download what a succeeded job produced"""
+    job = _owned_job(job_id)
+    if job is None:
+        return api_error('job not found', 404)
+    if job.status != 'succeeded':
+        return api_error(f'job is {job.status}', 409)
+    if job.result_path:
+        if not os.path.exists(job.result_path):
+            return api_error('job result is no longer available', 410)
+        return send_file(job.result_path, mimetype=job.result_type, as_attachment=True,
+                         download_name=job.result_name)
+    return Response(
+        job.result,
+        mimetype=job.result_type,
+        headers={'Content-Disposition': f'attachment; filename={job.result_name}'},
+    )
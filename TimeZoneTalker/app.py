@@ -1,15 +1,21 @@
 import os
-import logging
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_login import LoginManager
+from logconfig import configure_logging
 
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging: LOG_LEVEL for the root logger, LOG_LEVELS for per-logger
+# overrides, LOG_DEBUG_SAMPLE to thin repeated debug messages (see logconfig.py)
+configure_logging(
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    overrides=os.environ.get("LOG_LEVELS", ""),
+    debug_sample=int(os.environ.get("LOG_DEBUG_SAMPLE", 1)),
+    use_queue=os.environ.get("LOG_QUEUE", "1") != "0",
+)
 
 class Base(DeclarativeBase):
     pass
@@ -29,6 +35,60 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 }
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# /time-entries paging; streaming renders the page as it is generated
+app.config["TIME_ENTRIES_PAGE_SIZE"] = int(os.environ.get("TIME_ENTRIES_PAGE_SIZE", 50))
+app.config["TIME_ENTRIES_MAX_PAGE_SIZE"] = int(os.environ.get("TIME_ENTRIES_MAX_PAGE_SIZE", 200))
+app.config["TIME_ENTRIES_STREAM"] = os.environ.get("TIME_ENTRIES_STREAM", "0") == "1"
+
+# Per-user stats cache: none:// (default), memory:// (single process only) or redis://...
+app.config["STATS_CACHE_URL"] = os.environ.get("STATS_CACHE_URL", "none://")
+app.config["STATS_CACHE_TTL"] = int(os.environ.get("STATS_CACHE_TTL", 300))
+app.config["STATS_CACHE_SIZE"] = int(os.environ.get("STATS_CACHE_SIZE", 1024))
+
+# Logged-in users' id, username and timezone, reused without a query: memory:// (default,
+# per process, so other processes see a change after at most the TTL) or redis://...
+app.config["PRINCIPAL_CACHE_URL"] = os.environ.get("PRINCIPAL_CACHE_URL", "memory://")
+app.config["PRINCIPAL_CACHE_TTL"] = int(os.environ.get("PRINCIPAL_CACHE_TTL", 60))
+
+# Team and organization reports: groups per page and seconds a page is cached
+app.config["TEAM_REPORT_PAGE_SIZE"] = int(os.environ.get("TEAM_REPORT_PAGE_SIZE", 50))
+app.config["TEAM_REPORT_MAX_PAGE_SIZE"] = int(os.environ.get("TEAM_REPORT_MAX_PAGE_SIZE", 500))
+app.config["REPORT_CACHE_TTL"] = int(os.environ.get("REPORT_CACHE_TTL", 120))
+
+# Hours before a report or weekly chart range to look for entries that run into it
+app.config["REPORT_LOOKBACK_HOURS"] = int(os.environ.get("REPORT_LOOKBACK_HOURS", 24))
+
+# Background jobs (see jobs.py): reuse window, lease, retries, retention, upload size and worker niceness
+app.config["JOB_REUSE_TTL"] = int(os.environ.get("JOB_REUSE_TTL", 600))
+app.config["JOB_LEASE_SECONDS"] = int(os.environ.get("JOB_LEASE_SECONDS", 300))
+app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+app.config["JOB_RETENTION_HOURS"] = int(os.environ.get("JOB_RETENTION_HOURS", 24))
+app.config["JOB_MAX_UPLOAD_BYTES"] = int(os.environ.get("JOB_MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+app.config["JOB_NICE"] = int(os.environ.get("JOB_NICE", 10))
+# Where streamed job results (exports) are written; web and job workers must share it
+app.config["JOB_RESULT_DIR"] = os.environ.get("JOB_RESULT_DIR", os.path.join(app.instance_path, "job-results"))
+
+# Timer sweeper (see sweeper.py): default max running hours and idle minutes (0 = off),
+# and seconds between writes of a user's last activity
+app.config["TIMER_MAX_HOURS"] = int(os.environ.get("TIMER_MAX_HOURS", 12))
+app.config["TIMER_IDLE_MINUTES"] = int(os.environ.get("TIMER_IDLE_MINUTES", 0))
+app.config["TIMER_ACTIVITY_INTERVAL"] = int(os.environ.get("TIMER_ACTIVITY_INTERVAL", 300))
+
+# Rows per INSERT batch for bulk imports
+app.config["IMPORT_BATCH_SIZE"] = int(os.environ.get("IMPORT_BATCH_SIZE", 5000))
+
+# Live timer events: none:// (default), memory:// (single process only) or redis://...
+app.config["TIMER_EVENTS_URL"] = os.environ.get("TIMER_EVENTS_URL", "none://")
+app.config["TIMER_EVENTS_HEARTBEAT"] = int(os.environ.get("TIMER_EVENTS_HEARTBEAT", 15))
+
+# Largest request accepted by the batch timezone conversion API
+app.config["TIMEZONE_BATCH_MAX_ITEMS"] = int(os.environ.get("TIMEZONE_BATCH_MAX_ITEMS", 10000))
+
+# Per-request timing: Server-Timing headers, request log lines and /metrics (see instrumentation.py)
+app.config["INSTRUMENTATION"] = os.environ.get("INSTRUMENTATION", "0") == "1"
+# /metrics is only served with a token, sent as "Authorization: Bearer <token>"
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
 # initialize the app with the extension, flask-sqlalchemy >= 3.0.x
 db.init_app(app)
 
@@ -41,12 +101,18 @@ with app.app_context():
     # Import models and routes
     import models  # noqa: F401
     from routes import *  # noqa: F401
+    import api  # noqa: F401
+    import commands  # noqa: F401
+    import instrumentation  # noqa: F401
+    import sweeper  # noqa: F401
     
-    # Create all database tables
-    db.create_all()
+    # Bring the schema up to date (set AUTO_MIGRATE=0 to run `flask db upgrade` separately)
+    if os.environ.get("AUTO_MIGRATE", "1") != "0":
+        import migrations
+        migrations.upgrade()
 
 # Setup user loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    from models import User
-    return User.query.get(int(user_id))
+    from principal import load_principal
+    return load_principal(int(user_id))
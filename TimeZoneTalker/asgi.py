@@ -0,0 +1,257 @@
+"""Optional ASGI entry point with async handlers for the read-heavy endpoints.
+
+    pip install ".[asgi]"    # plus asyncpg for PostgreSQL
+    uvicorn asgi:application --workers 4
+
+The JSON endpoints that only read (/api/v1/dashboard, /api/v1/reports,
+/api/v1/timer and /get-tasks/<id>) are served natively on an async
+SQLAlchemy engine. While one of them waits on the database, the worker keeps
+serving other requests. They run the same statements and use the same stats
+cache as the sync views.
+
+Everything else goes to the Flask app through asgiref's WSGI adapter. That
+includes pages, writes, the SSE stream and the timezone APIs, which are pure
+CPU work with nothing to await. It also covers requests without a session
+cookie, so redirects and error responses are exactly the sync ones.
+
+The async handlers skip Flask's request hooks, so they do that work
+themselves: they record the user's activity for the timer sweeper and, while
+INSTRUMENTATION is on, report to the same Server-Timing header, request log
+and /metrics counters under the Flask endpoint name.
+
+ASYNC_DATABASE_URL overrides the engine URL, which is otherwise derived from
+DATABASE_URL.
+"""
+from datetime import datetime, timedelta
+import logging
+import os
+import re
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_cookie
+from app import app
+from models import Project, Task, TimeEntry
+from principal import Principal, principal_statement
+from api import report_days, serialize_entry
+from utils import cache_weekly_totals, weekly_stats_payload, project_stats_payload
+import cache
+import instrumentation
+import rollups
+import stats
+import sweeper
+
+logger = logging.getLogger(__name__)
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_url(url):
+    """Swap the sync driver of a database URL for its asyncio counterpart"""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+engine = create_async_engine(
+    os.environ.get('ASYNC_DATABASE_URL') or async_database_url(app.config['SQLALCHEMY_DATABASE_URI']),
+    pool_recycle=300,
+    pool_pre_ping=True,
+)
+Session = async_sessionmaker(engine, expire_on_commit=False)
+wsgi_application = WsgiToAsgi(app)
+
+ROUTES = []
+
+
+def route(pattern):
+    """Register an async GET handler(session, user, query, **path params) returning (status, payload)"""
+    def decorator(handler):
+        ROUTES.append((re.compile(pattern + '$'), handler))
+        return handler
+    return decorator
+
+
+def session_user_id(scope):
+    """The Flask-Login user id from the signed session cookie, or None"""
+    cookie_header = b'; '.join(value for name, value in scope['headers'] if name == b'cookie')
+    cookie = parse_cookie(cookie_header.decode('latin-1')).get(app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        data = serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return None
+    user_id = data.get('_user_id')
+    return int(user_id) if user_id and str(user_id).isdigit() else None
+
+
+async def load_principal(session, user_id):
+    """Async twin of principal.principal_data(), sharing its cache"""
+    key = cache.principal_key(user_id)
+    data = cache.principal_cache.get(key)
+    if data is None:
+        row = (await session.execute(principal_statement(user_id))).first()
+        if row is None:
+            return None
+        data = row._asdict()
+        cache.principal_cache.set(key, data)
+    return Principal(**data)
+
+
+async def record_activity(session, user):
+    """Async twin of sweeper.record_activity(), sharing its throttle; skipped while no idle rule applies"""
+    if not sweeper.idle_limit(user) or not sweeper.activity_due(user.id):
+        return
+    try:
+        await session.execute(sweeper.activity_statement(user.id))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        logger.exception("Could not record activity for user %s", user.id)
+
+
+def flask_endpoint(path):
+    """The Flask endpoint name a GET of `path` resolves to, for the metrics labels"""
+    try:
+        return app.url_map.bind('localhost').match(path, method='GET')[0]
+    except HTTPException:
+        return None
+
+
+async def weekly_stats(session, user):
+    days, bounds = stats.current_week(user.timezone or 'UTC')
+    key = cache.weekly_key(user.id, days[0])
+    cached = cache.stats_cache.get(key)
+    if cached is None:
+        rows = (await session.execute(stats.daily_totals_statement(user.id, bounds))).all()
+        cached = cache_weekly_totals(key, stats.fold_daily_rows(rows, bounds))
+    return weekly_stats_payload(days, cached, bounds)
+
+
+async def project_stats(session, user):
+    key = cache.projects_key(user.id)
+    totals = cache.stats_cache.get(key)
+    if totals is None:
+        rows = (await session.execute(rollups.project_totals_statement(user.id))).all()
+        totals = rollups.fold_project_rows(rows)
+        cache.stats_cache.set(key, totals)
+    return project_stats_payload(totals)
+
+
+async def running_entry(session, user):
+    result = await session.execute(
+        select(TimeEntry).options(joinedload(TimeEntry.project), joinedload(TimeEntry.task)).where(
+            TimeEntry.user_id == user.id, TimeEntry.status == 'running'
+        ).limit(1)
+    )
+    return result.scalars().first()
+
+
+@route(r'/api/v1/dashboard')
+async def dashboard(session, user, query):
+    return 200, {
+        'weekly': await weekly_stats(session, user),
+        'projects': await project_stats(session, user),
+        'timer': serialize_entry(await running_entry(session, user)),
+    }
+
+
+@route(r'/api/v1/reports')
+async def reports(session, user, query):
+    try:
+        days = int(query.get('days', ['30'])[0])
+    except ValueError:
+        days = None
+    since = datetime.utcnow() - timedelta(days=report_days(days))
+    rows = (await session.execute(stats.project_totals_statement(user.id, since=since))).all()
+    return 200, {
+        'weekly': await weekly_stats(session, user),
+        'projects': await project_stats(session, user),
+        'project_totals': stats.fold_project_rows(rows),
+    }
+
+
+@route(r'/api/v1/timer')
+async def timer_current(session, user, query):
+    return 200, {'entry': serialize_entry(await running_entry(session, user))}
+
+
+@route(r'/get-tasks/(?P<project_id>\d+)')
+async def get_tasks(session, user, query, project_id):
+    project = await session.scalar(
+        select(Project.id).where(Project.id == int(project_id), Project.user_id == user.id)
+    )
+    if project is None:
+        return 200, []
+    tasks = await session.execute(select(Task.id, Task.name).where(Task.project_id == project))
+    return 200, [{'id': task_id, 'name': name} for task_id, name in tasks]
+
+
+def _match(scope):
+    if scope['method'] != 'GET':
+        return None, None
+    for pattern, handler in ROUTES:
+        match = pattern.match(scope['path'])
+        if match:
+            return handler, match.groupdict()
+    return None, None
+
+
+async def _send_json(send, status, payload, extra_headers=()):
+    # Same compact encoding as jsonify() outside debug mode
+    body = (app.json.dumps(payload, indent=None, separators=(',', ':')) + '\n').encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                    *extra_headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    if scope['type'] == 'http':
+        handler, params = _match(scope)
+        user_id = session_user_id(scope) if handler else None
+        if user_id is not None:
+            timing_stats = instrumentation.RequestStats() if instrumentation.enabled() else None
+            token = instrumentation.request_stats.set(timing_stats)
+            try:
+                async with Session() as session:
+                    user = await load_principal(session, user_id)
+                    if user is not None:
+                        await record_activity(session, user)
+                        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+                        status, payload = await handler(session, user, query, **params)
+            finally:
+                instrumentation.request_stats.reset(token)
+            if user is not None:
+                headers = []
+                if timing_stats is not None:
+                    timing = instrumentation.record(timing_stats, 'GET', scope['path'], flask_endpoint(scope['path']), status)
+                    headers.append((b'server-timing', timing.encode('latin-1')))
+                return await _send_json(send, status, payload, headers)
+
+    await wsgi_application(scope, receive, send)
@@ -0,0 +1,1137 @@
+"""Benchmarks for the time tracker's hot paths.
+
+Runs against a throwaway SQLite database by default, or against the database
+in BENCH_DATABASE_URL. Results are printed as JSON so they can be diffed
+between commits.
+
+    python benchmark.py weekly --entries 10000 100000 1000000
+    python benchmark.py routes --users 20 --entries 20000 --years 3 --modes sync async
+    python benchmark.py timer_stress --threads 16 --actions 500
+    python benchmark.py team_report --org-users 5000 --teams 50
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+if 'BENCH_DATABASE_URL' in os.environ:
+    os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+else:
+    _bench_dir = tempfile.mkdtemp(prefix='timetracker-bench-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_bench_dir, 'bench.db')
+# Cached reads are measured within this one process
+os.environ.setdefault('STATS_CACHE_URL', 'memory://')
+# Export job results are throwaway too
+os.environ.setdefault('JOB_RESULT_DIR', tempfile.mkdtemp(prefix='timetracker-bench-results-'))
+
+from flask import g  # noqa: E402
+from sqlalchemy import event, func, insert  # noqa: E402
+from app import app, db  # noqa: E402
+from models import User, Project, Task, TimeEntry  # noqa: E402
+
+
+class QueryCounter:
+    """Count statements sent to the database while active"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+
+
+def reset_database():
+    db.drop_all()
+    db.create_all()
+
+
+def seed_user(entries, username='bench', timezone='America/New_York', projects=5, tasks_per_project=4,
+              span_days=365, batch_size=10000):
+    """Create one user with `entries` time entries spread over the last `span_days` days"""
+    user = User(username=username, email=f'{username}@example.com', timezone=timezone)
+    user.set_password('benchmark')
+    db.session.add(user)
+    db.session.flush()
+
+    project_ids = []
+    task_ids = {}
+    for p in range(projects):
+        project = Project(name=f'Project {p}', user_id=user.id, color='#6c757d')
+        db.session.add(project)
+        db.session.flush()
+        project_ids.append(project.id)
+        task_ids[project.id] = []
+        for t in range(tasks_per_project):
+            task = Task(name=f'Task {p}.{t}', project_id=project.id)
+            db.session.add(task)
+            db.session.flush()
+            task_ids[project.id].append(task.id)
+    db.session.commit()
+
+    rng = random.Random(entries)
+    now = datetime.utcnow()
+    rows = []
+    for i in range(entries):
+        project_id = rng.choice(project_ids)
+        start = now - timedelta(seconds=rng.randint(0, span_days * 86400))
+        duration = rng.randint(60, 4 * 3600)
+        status = 'completed' if rng.random() < 0.95 else 'paused'
+        rows.append({
+            'user_id': user.id,
+            'project_id': project_id,
+            'task_id': rng.choice(task_ids[project_id]),
+            'description': f'entry {i}',
+            'start_time': start,
+            'end_time': start + timedelta(seconds=duration) if status == 'completed' else None,
+            'duration': duration,
+            'status': status,
+            'created_at': start,
+        })
+        if len(rows) >= batch_size:
+            db.session.execute(insert(TimeEntry), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(TimeEntry), rows)
+
+    # Every user has one live timer
+    db.session.add(TimeEntry(user_id=user.id, project_id=project_ids[0], start_time=now - timedelta(minutes=30),
+                             status='running'))
+    db.session.commit()
+    return user
+
+
+def timed(fn, repeat):
+    """Run fn `repeat` times, returning (last result, latencies in ms, queries per call)"""
+    latencies = []
+    with count_queries() as counter:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = fn()
+            latencies.append((time.perf_counter() - started) * 1000)
+            db.session.rollback()
+    latencies.sort()
+    return result, {
+        'queries_per_call': counter.count / repeat,
+        'min_ms': round(latencies[0], 3),
+        'median_ms': round(latencies[len(latencies) // 2], 3),
+        'max_ms': round(latencies[-1], 3),
+    }
+
+
+def uncached(fn):
+    """fn with the stats cache cleared before each call, so the query is what gets timed"""
+    import cache
+
+    def call():
+        cache.stats_cache.clear()
+        return fn()
+    return call
+
+
+def bench_weekly(args):
+    from utils import get_weekly_stats
+
+    results = []
+    for entries in args.entries:
+        reset_database()
+        user = seed_user(entries)
+        user_id, timezone = user.id, user.timezone
+        _, stats = timed(uncached(lambda: get_weekly_stats(user_id, timezone)), args.repeat)
+        results.append({'entries': entries, **stats})
+    return results
+
+
+def bench_timeseries(args):
+    import reporting
+
+    results = []
+    for entries in args.entries:
+        reset_database()
+        user = seed_user(entries)
+        user_id, timezone = user.id, user.timezone
+        end = datetime.utcnow().date() + timedelta(days=1)
+        for granularity, days, group_by in (('hour', 7, ()), ('day', 90, ('project', 'task')), ('month', 365, ('tag',))):
+            start = end - timedelta(days=days)
+            _, stats = timed(
+                lambda: reporting.time_series(user_id, start, end, granularity, group_by, timezone), args.repeat
+            )
+            results.append({'entries': entries, 'granularity': granularity, 'days': days,
+                            'group_by': ','.join(group_by), **stats})
+    return results
+
+
+def bench_projects(args):
+    from stats import project_totals
+    from utils import get_project_stats
+
+    results = []
+    for entries in args.entries:
+        reset_database()
+        user_id = seed_user(entries).id
+        since = datetime.utcnow() - timedelta(days=30)
+        _, dashboard = timed(uncached(lambda: get_project_stats(user_id)), args.repeat)
+        _, reports = timed(lambda: project_totals(user_id, since=since), args.repeat)
+        results.append({'entries': entries, 'get_project_stats': dashboard, 'reports_project_totals': reports})
+    return results
+
+
+def _hot_queries(user_id):
+    """The statements the index migration is meant to serve"""
+    from sqlalchemy import select
+    from stats import local_day_bounds
+
+    week = local_day_bounds('UTC', (datetime.utcnow() - timedelta(days=7)).date(), 7)
+    return {
+        'active_timer': select(TimeEntry.id).where(TimeEntry.user_id == user_id, TimeEntry.status == 'running').limit(1),
+        'recent_entries': select(TimeEntry.id).where(TimeEntry.user_id == user_id)
+        .order_by(TimeEntry.created_at.desc()).limit(5),
+        'weekly_range': select(TimeEntry.id, TimeEntry.duration).where(
+            TimeEntry.user_id == user_id, TimeEntry.start_time >= week[0], TimeEntry.start_time < week[-1]),
+        'time_entries_page': select(TimeEntry.id).where(TimeEntry.user_id == user_id)
+        .order_by(TimeEntry.start_time.desc()).limit(50),
+    }
+
+
+def _explain(statement):
+    sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    with db.engine.connect() as connection:
+        rows = connection.exec_driver_sql(prefix + sql).all()
+    return [' '.join(str(column) for column in row) for row in rows]
+
+
+def bench_plans(args):
+    """Query plans and latency for the hot-path filters with and without the TimeEntry indexes"""
+    results = []
+    for entries in args.entries:
+        reset_database()
+        user_id = seed_user(entries).id
+        # Other users' rows make the user_id filter selective, as in production
+        for n in range(args.users - 1):
+            seed_user(entries // args.users, username=f'other{n}')
+
+        indexes = [index for index in TimeEntry.__table__.indexes]
+        report = {'entries': entries, 'before': {}, 'after': {}}
+        for phase in ('before', 'after'):
+            with db.engine.begin() as connection:
+                for index in indexes:
+                    if phase == 'before':
+                        index.drop(connection, checkfirst=True)
+                    else:
+                        index.create(connection, checkfirst=True)
+            for name, statement in _hot_queries(user_id).items():
+                _, stats = timed(lambda: db.session.execute(statement).all(), args.repeat)
+                report[phase][name] = {'plan': _explain(statement), **stats}
+        results.append(report)
+    return results
+
+
+def fresh_request_state():
+    """Start from an empty identity map and an unloaded current_user, as a new
+    request in production would; the benchmark's app context outlives requests"""
+    db.session.remove()
+    g.pop('_login_user', None)
+
+
+def login_client(username, password='benchmark'):
+    """Flask test client logged in as `username`"""
+    app.config['WTF_CSRF_ENABLED'] = False
+    fresh_request_state()
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    if response.status_code != 302:
+        raise RuntimeError(f'Could not log in as {username}')
+    return client
+
+
+def queries_per_request(client, url):
+    """Number of statements a single GET of `url` sends to the database"""
+    fresh_request_state()
+    with count_queries() as counter:
+        response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f'GET {url} returned {response.status_code}')
+    return counter.count
+
+
+LIST_PAGES = ('/dashboard', '/reports', '/time-entries?per_page=200', '/tasks')
+
+
+def bench_nplusone(args):
+    """Fail when a list page's query count grows with the number of rows it shows"""
+    counts = {}
+    for rows in (args.rows, args.rows * 2):
+        reset_database()
+        user = User(username='lists', email='lists@example.com', timezone='UTC')
+        user.set_password('benchmark')
+        db.session.add(user)
+        db.session.flush()
+        now = datetime.utcnow()
+        for i in range(rows):
+            # A distinct project and task per row defeats the identity map
+            project = Project(name=f'Project {i}', user_id=user.id)
+            db.session.add(project)
+            db.session.flush()
+            task = Task(name=f'Task {i}', project_id=project.id)
+            db.session.add(task)
+            db.session.flush()
+            db.session.add(TimeEntry(user_id=user.id, project_id=project.id, task_id=task.id,
+                                     start_time=now - timedelta(hours=i + 1), duration=600, status='completed'))
+        db.session.commit()
+
+        client = login_client('lists')
+        counts[rows] = {url: queries_per_request(client, url) for url in LIST_PAGES}
+
+    small, large = counts[args.rows], counts[args.rows * 2]
+    growing = [url for url in LIST_PAGES if large[url] > small[url]]
+    result = {'rows': counts, 'growing': growing}
+    if growing:
+        json.dump(result, sys.stderr, indent=2)
+        raise SystemExit('Query count grows with row count on: ' + ', '.join(growing))
+    return result
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process so far"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def bench_import(args):
+    """Bulk CSV import throughput and peak memory"""
+    import csv
+    import importer
+
+    results = []
+    for entries in args.entries:
+        reset_database()
+        user = seed_user(0, username='importer')
+        projects = [p.name for p in Project.query.filter_by(user_id=user.id)]
+
+        path = os.path.join(tempfile.mkdtemp(prefix='timetracker-import-'), 'entries.csv')
+        rng = random.Random(entries)
+        start = datetime(2020, 1, 1)
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['project', 'description', 'start_time', 'duration', 'status'])
+            for i in range(entries):
+                started = start + timedelta(minutes=10 * i)
+                writer.writerow([rng.choice(projects), f'imported {i}', started.isoformat(), rng.randint(60, 3600),
+                                 'completed'])
+
+        memory_before = peak_memory_mb()
+        started = time.perf_counter()
+        with open(path, newline='') as f:
+            result = importer.import_entries(user.id, f, fmt='csv', batch_size=args.batch_size)
+        elapsed = time.perf_counter() - started
+        os.remove(path)
+        results.append({
+            'entries': entries,
+            'batch_size': args.batch_size,
+            'imported': result.imported,
+            'seconds': round(elapsed, 2),
+            'rows_per_second': round(result.imported / elapsed) if elapsed else None,
+            'peak_rss_mb_before': memory_before,
+            'peak_rss_mb_after': peak_memory_mb(),
+        })
+    return results
+
+
+def _rate(fn, calls):
+    started = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    return round(calls / elapsed) if elapsed else None
+
+
+def bench_timezones(args):
+    """Conversion throughput through the shared registry versus per-call pytz lookups"""
+    import pytz
+    import timezones
+    from forms import RegisterForm
+
+    names = list(timezones.COMMON_TIMEZONES)
+    base = datetime(2024, 1, 1)
+
+    def pytz_convert(i):
+        source = pytz.timezone(names[i % len(names)])
+        local = source.localize(base + timedelta(minutes=i))
+        return local.astimezone(pytz.timezone('UTC'))
+
+    def registry_convert(i):
+        return timezones.local_to_utc(base + timedelta(minutes=i), names[i % len(names)])
+
+    def legacy_choices(i):
+        return [(tz, tz) for tz in pytz.common_timezones]
+
+    results = []
+    for calls in args.entries:
+        with app.test_request_context():
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                RegisterForm(meta={'csrf': False})
+            form_ms = (time.perf_counter() - started) * 1000 / args.repeat
+        results.append({
+            'calls': calls,
+            'pytz_conversions_per_second': _rate(pytz_convert, calls),
+            'registry_conversions_per_second': _rate(registry_convert, calls),
+            'legacy_choice_lists_per_second': _rate(legacy_choices, min(calls, 10000)),
+            'offset_lookups_per_second': _rate(lambda i: timezones.current_utc_offset(names[i % len(names)]), calls),
+            'form_construction_ms': round(form_ms, 3),
+        })
+    return results
+
+
+def bench_convert_batch(args):
+    """Batch timezone conversion versus convert_timezone() one item at a time"""
+    import timezones
+    from utils import convert_timezone
+
+    names = list(timezones.COMMON_TIMEZONES)
+    rng = random.Random(0)
+    results = []
+    for count in args.entries:
+        values = [datetime(2000, 1, 1) + timedelta(seconds=rng.randint(0, 30 * 365 * 86400)) for _ in range(count)]
+        workloads = {
+            # A schedule fanned out to a handful of attendee zones
+            'one_source_ten_targets': ('America/New_York', [names[i % 10 * 40] for i in range(count)]),
+            # Worst case: nearly every item a different zone pair
+            'random_pairs': ([rng.choice(names) for _ in range(count)], [rng.choice(names) for _ in range(count)]),
+        }
+        for workload, (source_zones, target_zones) in workloads.items():
+            sources = timezones.broadcast_zones(source_zones, count)
+            targets = timezones.broadcast_zones(target_zones, count)
+            # Tables are built once per process; time that apart from the steady state
+            started = time.perf_counter()
+            zones = set(sources) | set(targets)
+            for name in zones:
+                timezones.transition_table(name)
+            tables = time.perf_counter() - started
+            timezones.convert_batch(values[:1000], sources[:1000], targets[:1000])
+
+            started = time.perf_counter()
+            for value, source, target in zip(values, sources, targets):
+                convert_timezone(value, source, target)
+            per_item = time.perf_counter() - started
+
+            started = time.perf_counter()
+            timezones.convert_batch(values, source_zones, target_zones)
+            batch = time.perf_counter() - started
+
+            results.append({
+                'timestamps': count,
+                'workload': workload,
+                'per_item_per_second': round(count / per_item),
+                'batch_per_second': round(count / batch),
+                'speedup': round(per_item / batch, 2),
+                'zones': len(zones),
+                'table_build_ms': round(tables * 1000, 1),
+            })
+    return results
+
+
+def bench_planner(args):
+    """Meeting windows for N participants in distinct zones over a quarter"""
+    from datetime import time as clock
+    import planner
+    import timezones
+
+    # Zones within a few hours of each other, so windows exist to be found
+    names = [name for name in timezones.COMMON_TIMEZONES if name.startswith(('Europe/', 'Africa/'))]
+    start = datetime(2024, 1, 1)
+    results = []
+    for count in args.entries:
+        participants = [planner.Participant(names[i % len(names)], clock(6), clock(20)) for i in range(count)]
+        windows, stats = timed(
+            lambda: planner.find_meeting_windows(participants, start, start + timedelta(weeks=13)), args.repeat
+        )
+        results.append({'participants': count, 'distinct_zones': min(count, len(names)), 'windows': len(windows),
+                        **stats})
+    return results
+
+
+def _free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def serve(mode, workers):
+    """Run the app in a server subprocess: gunicorn sync workers or uvicorn with the ASGI entry point"""
+    import subprocess
+    import urllib.request
+
+    port = _free_port()
+    if mode == 'sync':
+        command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', f'127.0.0.1:{port}',
+                   'main:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', '--workers', str(workers), '--port', str(port),
+                   '--log-level', 'warning', 'asgi:application']
+    env = dict(os.environ, AUTO_MIGRATE='0')
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1)
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f'{mode} server did not start')
+                time.sleep(0.2)
+        yield port
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)], 2)
+
+
+def session_cookie_header(client):
+    """Cookie header carrying a test client's session, for requests to a real server"""
+    name = app.config['SESSION_COOKIE_NAME']
+    return f'{name}={client.get_cookie(name).value}'
+
+
+def load_test(port, path, cookie, concurrency, duration):
+    """Hammer one path with `concurrency` keep-alive clients for `duration` seconds"""
+    import http.client
+    import threading
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        mine = []
+        failed = 0
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                connection.request('GET', path, headers={'Cookie': cookie})
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            mine.append((time.perf_counter() - started) * 1000)
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(latencies, 0.50),
+        'p99_ms': percentile(latencies, 0.99),
+    }
+
+
+def bench_load(args):
+    """Requests/sec and p99 latency of the read endpoints, sync workers versus the ASGI entry point"""
+    reset_database()
+    seed_user(args.entries[0])
+    db.session.remove()
+    cookie = session_cookie_header(login_client('bench'))
+
+    project_id = Project.query.first().id
+    paths = ['/api/v1/dashboard', '/api/v1/reports', '/api/v1/timer', f'/get-tasks/{project_id}']
+    results = []
+    for mode in args.modes:
+        with serve(mode, args.workers) as port:
+            for path in paths:
+                load_test(port, path, cookie, args.concurrency, 1)  # warm up
+                results.append({
+                    'mode': mode,
+                    'workers': args.workers,
+                    'concurrency': args.concurrency,
+                    'path': path,
+                    **load_test(port, path, cookie, args.concurrency, args.duration),
+                })
+    return results
+
+
+def seed_dataset(args):
+    """Users with projects, tasks and years of entries, rollups included; returns the first user"""
+    import rollups
+
+    reset_database()
+    users = [
+        seed_user(args.entries[0], username=f'user{n}', projects=args.projects, tasks_per_project=args.tasks,
+                  span_days=int(365 * args.years))
+        for n in range(args.users)
+    ]
+    rollups.rebuild()
+    return users[0]
+
+
+def route_requests(user_id):
+    """(name, method, url, request kwargs, expected status) for the routes under test"""
+    project = Project.query.filter_by(user_id=user_id).first()
+    return [
+        ('dashboard', 'GET', '/dashboard', {}, 200),
+        ('reports', 'GET', '/reports', {}, 200),
+        ('time_entries', 'GET', '/time-entries', {}, 200),
+        ('time_entries_200', 'GET', '/time-entries?per_page=200', {}, 200),
+        ('tasks', 'GET', '/tasks', {}, 200),
+        ('projects', 'GET', '/projects', {}, 200),
+        ('get_tasks', 'GET', f'/get-tasks/{project.id}', {}, 200),
+        ('timezone_converter', 'GET', '/timezone-converter', {}, 200),
+        ('timezone_convert', 'POST', '/timezone-converter', {'data': {
+            'source_timezone': 'UTC', 'target_timezone': 'Asia/Tokyo', 'date_time': '2024-03-10 12:00',
+        }}, 200),
+        ('api_dashboard', 'GET', '/api/v1/dashboard', {}, 200),
+        ('api_reports', 'GET', '/api/v1/reports', {}, 200),
+        ('api_timer', 'GET', '/api/v1/timer', {}, 200),
+    ]
+
+
+def measure_route(client, method, url, kwargs, expected, repeat, cold):
+    """Latency percentiles, queries per request and peak Python allocation of one route"""
+    import tracemalloc
+    from cache import principal_cache, stats_cache
+
+    latencies = []
+    with count_queries() as counter:
+        for _ in range(repeat):
+            fresh_request_state()
+            if cold:
+                stats_cache.clear()
+                principal_cache.clear()
+            started = time.perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != expected:
+                raise RuntimeError(f'{method} {url} returned {response.status_code}')
+
+    # Allocation tracing slows requests down, so it gets a pass of its own
+    fresh_request_state()
+    tracemalloc.start()
+    client.open(url, method=method, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'queries_per_request': round(counter.count / repeat, 2),
+        'p50_ms': percentile(latencies, 0.50),
+        'p90_ms': percentile(latencies, 0.90),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': round(latencies[-1], 2),
+        'peak_alloc_kb': round(peak / 1024, 1),
+    }
+
+
+def measure_timer_actions(client, user_id, repeat):
+    """Latency and queries of a full start, pause, resume, stop cycle, per action"""
+    project = Project.query.filter_by(user_id=user_id).first()
+    actions = {name: {'latencies': [], 'queries': 0} for name in ('start', 'pause', 'resume', 'stop')}
+    for _ in range(repeat):
+        entry_id = None
+        for name in actions:
+            fresh_request_state()
+            with count_queries() as counter:
+                started = time.perf_counter()
+                if name == 'start':
+                    response = client.post('/api/v1/timer/start', json={'project_id': project.id})
+                    entry_id = response.get_json()['entry']['id']
+                else:
+                    response = client.post(f'/timer/{entry_id}/{name}')
+                elapsed = (time.perf_counter() - started) * 1000
+            if response.status_code not in (201, 302):
+                raise RuntimeError(f'timer {name} returned {response.status_code}')
+            actions[name]['latencies'].append(elapsed)
+            actions[name]['queries'] += counter.count
+
+    results = {}
+    for name, measured in actions.items():
+        latencies = sorted(measured['latencies'])
+        results[f'timer_{name}'] = {
+            'queries_per_request': round(measured['queries'] / repeat, 2),
+            'p50_ms': percentile(latencies, 0.50),
+            'p90_ms': percentile(latencies, 0.90),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': round(latencies[-1], 2),
+        }
+    return results
+
+
+def bench_routes(args):
+    """Per-route latency, queries and memory through the test client, then concurrent HTTP load"""
+    started = time.perf_counter()
+    user = seed_dataset(args)
+    user_id = user.id
+    seeded_in = round(time.perf_counter() - started, 1)
+    fresh_request_state()
+
+    client = login_client(user.username)
+    routes = {}
+    for name, method, url, kwargs, expected in route_requests(user_id):
+        routes[name] = measure_route(client, method, url, kwargs, expected, args.repeat, args.cold)
+    routes.update(measure_timer_actions(client, user_id, args.repeat))
+
+    http = []
+    if not args.skip_http:
+        cookie = session_cookie_header(client)
+        paths = [url for _, method, url, _, _ in route_requests(user_id) if method == 'GET']
+        for mode in args.modes:
+            with serve(mode, args.workers) as port:
+                for path in paths:
+                    load_test(port, path, cookie, args.concurrency, 1)  # warm up
+                    http.append({
+                        'mode': mode,
+                        'workers': args.workers,
+                        'concurrency': args.concurrency,
+                        'path': path,
+                        **load_test(port, path, cookie, args.concurrency, args.duration),
+                    })
+
+    return {
+        'dataset': {
+            'users': args.users,
+            'projects_per_user': args.projects,
+            'tasks_per_project': args.tasks,
+            'entries_per_user': args.entries[0],
+            'years': args.years,
+            'seconds_to_seed': seeded_in,
+        },
+        'cold_cache': args.cold,
+        'routes': routes,
+        'http': http,
+        'peak_rss_mb': peak_memory_mb(),
+    }
+
+
+def bench_timer_stress(args):
+    """Threads racing timer actions on one user's timer, then checks that no state was lost
+
+    Fails (exit status 1) if two timers end up running, an entry's state
+    doesn't match the pauses and resumes that succeeded on it, a successful
+    start left no entry, or the rollups drifted from a rebuild.
+    """
+    import threading
+    from sqlalchemy.exc import OperationalError
+    from models import DailyProjectRollup
+    import rollups
+    import timer
+
+    reset_database()
+    user = seed_user(100, projects=1, tasks_per_project=1)
+    user_id, timezone_str = user.id, user.timezone
+    rollups.rebuild(user_id)
+    project_id = Project.query.filter_by(user_id=user_id).first().id
+
+    # Statements per transition, one at a time
+    statements = {}
+    entry = timer.start(user_id, project_id, timezone_str=timezone_str)
+    for name in ('pause', 'resume', 'stop', 'start'):
+        with count_queries() as counter:
+            if name == 'start':
+                timer.start(user_id, project_id, timezone_str=timezone_str)
+            else:
+                getattr(timer, name)(entry.id, user_id, timezone_str)
+        statements[name] = counter.count
+    seeded = TimeEntry.query.filter_by(user_id=user_id).count()
+
+    outcomes = {name: {'ok': 0, 'conflict': 0, 'busy': 0} for name in ('start', 'pause', 'resume', 'stop')}
+    # Successful pauses minus resumes per entry, counting the seeded paused ones,
+    # which its final state must agree with
+    paused_balance = dict.fromkeys(db.session.execute(
+        db.select(TimeEntry.id).where(TimeEntry.user_id == user_id, TimeEntry.status == 'paused')
+    ).scalars(), 1)
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        with app.app_context():
+            for _ in range(args.actions):
+                name = rng.choice(('start', 'pause', 'pause', 'resume', 'resume', 'stop'))
+                entry_id = db.session.execute(
+                    db.select(TimeEntry.id).where(TimeEntry.user_id == user_id)
+                    .order_by(TimeEntry.id.desc()).limit(1)
+                ).scalar()
+                db.session.rollback()
+                try:
+                    if name == 'start':
+                        timer.start(user_id, project_id, timezone_str=timezone_str)
+                    else:
+                        getattr(timer, name)(entry_id, user_id, timezone_str)
+                    outcome = 'ok'
+                except timer.TimerConflict:
+                    outcome = 'conflict'
+                except OperationalError:
+                    # SQLite's busy timeout ran out behind other writers
+                    db.session.rollback()
+                    outcome = 'busy'
+                with lock:
+                    outcomes[name][outcome] += 1
+                    if outcome == 'ok' and name in ('pause', 'resume'):
+                        paused_balance[entry_id] = paused_balance.get(entry_id, 0) + (1 if name == 'pause' else -1)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    def rollup_totals():
+        totals = {}
+        for row in DailyProjectRollup.query.filter_by(user_id=user_id):
+            key = (row.project_id, row.task_id, row.day)
+            totals[key] = totals.get(key, 0) + row.seconds
+        return {key: seconds for key, seconds in totals.items() if seconds}
+
+    incremental = rollup_totals()
+    rollups.rebuild(user_id)
+    entries = TimeEntry.query.filter_by(user_id=user_id).all()
+    allowed_balance = {'running': (0,), 'paused': (1,), 'completed': (0, 1)}
+    checks = {
+        'running_timers': sum(entry.status == 'running' for entry in entries),
+        'negative_durations': sum((entry.duration or 0) < 0 for entry in entries),
+        'entries_match_starts': len(entries) == seeded + outcomes['start']['ok'],
+        'lost_transitions': sum(paused_balance.get(entry.id, 0) not in allowed_balance[entry.status]
+                                for entry in entries),
+        'rollups_match_rebuild': incremental == rollup_totals(),
+    }
+    total_actions = args.threads * args.actions
+    return {
+        'threads': args.threads,
+        'actions': total_actions,
+        'actions_per_second': round(total_actions / elapsed, 1),
+        'statements_per_action': statements,
+        'outcomes': outcomes,
+        'checks': checks,
+        'failed': checks['running_timers'] > 1 or checks['negative_durations'] > 0
+                  or not checks['entries_match_starts'] or checks['lost_transitions'] > 0
+                  or not checks['rollups_match_rebuild'],
+    }
+
+
+def seed_organization(users, teams, days, entries_per_day=2, batch_size=10000):
+    """One organization of `users` people split across `teams`, with `days` days of entries and rollups"""
+    from models import DailyProjectRollup, Organization, OrganizationMember, Team, TeamMember
+    import timezones
+
+    organization = Organization(name='Bench Org')
+    db.session.add(organization)
+    db.session.flush()
+    team_rows = [Team(organization_id=organization.id, name=f'Team {t}') for t in range(teams)]
+    db.session.add_all(team_rows)
+    db.session.flush()
+
+    # One password hash for everyone; hashing thousands of passwords would dominate the seed
+    template = User(username='template', email='template@example.com')
+    template.set_password('benchmark')
+    zones = ['America/New_York', 'Europe/London', 'Asia/Kolkata', 'Asia/Tokyo', 'UTC']
+    db.session.execute(insert(User), [
+        {'username': f'member{u}', 'email': f'member{u}@example.com', 'password_hash': template.password_hash,
+         'timezone': zones[u % len(zones)]}
+        for u in range(users)
+    ])
+    members = db.session.execute(
+        db.select(User.id, User.timezone).where(User.username.like('member%')).order_by(User.id)
+    ).all()
+    db.session.execute(insert(OrganizationMember), [
+        {'organization_id': organization.id, 'user_id': user_id, 'role': 'member'} for user_id, _ in members
+    ])
+    db.session.execute(insert(TeamMember), [
+        {'team_id': team_rows[i % teams].id, 'user_id': user_id, 'role': 'member'}
+        for i, (user_id, _) in enumerate(members)
+    ])
+    db.session.execute(insert(Project), [
+        {'name': f'Project {p}', 'user_id': user_id, 'color': '#6c757d'} for user_id, _ in members for p in range(3)
+    ])
+    projects = {}
+    for project_id, user_id in db.session.execute(db.select(Project.id, Project.user_id)):
+        projects.setdefault(user_id, []).append(project_id)
+
+    rng = random.Random(users)
+    first_day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    rows = []
+    totals = {}
+    for user_id, timezone_str in members:
+        for day in range(days):
+            for _ in range(entries_per_day):
+                project_id = rng.choice(projects[user_id])
+                start = first_day + timedelta(days=day, seconds=rng.randint(0, 86399))
+                duration = rng.randint(600, 4 * 3600)
+                rows.append({'user_id': user_id, 'project_id': project_id, 'start_time': start,
+                             'end_time': start + timedelta(seconds=duration), 'duration': duration,
+                             'status': 'completed', 'created_at': start})
+                key = (user_id, project_id, timezones.local_date(start, timezone_str))
+                totals[key] = totals.get(key, 0) + duration
+            if len(rows) >= batch_size:
+                db.session.execute(insert(TimeEntry), rows)
+                rows = []
+    if rows:
+        db.session.execute(insert(TimeEntry), rows)
+    rollup_rows = [
+        {'user_id': user_id, 'project_id': project_id, 'task_id': None, 'day': day, 'seconds': seconds}
+        for (user_id, project_id, day), seconds in totals.items()
+    ]
+    for i in range(0, len(rollup_rows), batch_size):
+        db.session.execute(insert(DailyProjectRollup), rollup_rows[i:i + batch_size])
+    db.session.commit()
+    return organization.id, len(members) * days * entries_per_day, len(rollup_rows)
+
+
+def bench_team_report(args):
+    """Organization-wide report over the last month, per grouping and source, cold and cached"""
+    import cache
+    import teams
+
+    reset_database()
+    started = time.perf_counter()
+    organization_id, entries, rollup_rows = seed_organization(args.org_users, args.teams, 30)
+    seeded_in = round(time.perf_counter() - started, 1)
+    since, until = teams.default_range()
+
+    def run(group_by, source, page=1, cold=True):
+        def call():
+            if cold:
+                cache.report_cache.clear()
+            return teams.report('organization', organization_id, since, until, group_by, source, page, 50)
+        result, stats = timed(call, args.repeat)
+        return {'total_groups': result['total_groups'], 'total_hours': round(result['total_seconds'] / 3600),
+                **stats}
+
+    reports = {}
+    for group_by in ('team', 'user', 'project', 'day'):
+        reports[f'{group_by}_rollups'] = run(group_by, 'rollups')
+    for group_by in ('team', 'user', 'project'):
+        reports[f'{group_by}_entries'] = run(group_by, 'entries')
+    reports['user_rollups_last_page'] = run('user', 'rollups', page=args.org_users // 50)
+    reports['team_rollups_cached'] = run('team', 'rollups', cold=False)
+    return {
+        'dataset': {
+            'users': args.org_users,
+            'teams': args.teams,
+            'days': 30,
+            'entries': entries,
+            'rollup_rows': rollup_rows,
+            'seconds_to_seed': seeded_in,
+        },
+        'reports': reports,
+    }
+
+
+def bench_sweep(args):
+    """Auto-stop of forgotten timers: one sweep over every user against one stop() per timer"""
+    from models import DailyProjectRollup
+    import sweeper
+    import timer
+
+    reset_database()
+    seed_organization(args.org_users, args.teams, 7)
+    members = db.session.execute(
+        db.select(User.id, User.timezone).where(User.username.like('member%')).order_by(User.id)
+    ).all()
+    projects = dict(db.session.execute(db.select(Project.user_id, func.min(Project.id)).group_by(Project.user_id)).all())
+    now = datetime.utcnow()
+
+    def forget_timers():
+        # Every other user left a timer running 13 hours ago, past the 12 hour default
+        db.session.execute(insert(TimeEntry), [
+            {'user_id': user_id, 'project_id': projects[user_id], 'start_time': now - timedelta(hours=13),
+             'status': 'running', 'created_at': now - timedelta(hours=13)}
+            for user_id, _ in members[::2]
+        ])
+        db.session.commit()
+
+    def rollup_seconds():
+        return db.session.execute(db.select(func.sum(DailyProjectRollup.seconds))).scalar()
+
+    forget_timers()
+    before = rollup_seconds()
+    started = time.perf_counter()
+    with count_queries() as queries:
+        result = sweeper.sweep(batch_size=args.batch_size, now=now)
+    sweep_ms = (time.perf_counter() - started) * 1000
+    sweep = {'users': result.users, 'stopped': sum(result.stopped.values()), 'queries': queries.count,
+             'ms': round(sweep_ms, 1), 'rollup_hours_added': round((rollup_seconds() - before) / 3600)}
+
+    forget_timers()
+    running = db.session.execute(
+        db.select(TimeEntry.id, TimeEntry.user_id).where(TimeEntry.status == 'running')
+    ).all()
+    zones = dict(members)
+    started = time.perf_counter()
+    with count_queries() as queries:
+        for entry_id, user_id in running:
+            timer.stop(entry_id, user_id, zones[user_id])
+    per_row_ms = (time.perf_counter() - started) * 1000
+    return {
+        'users': len(members),
+        'sweep': sweep,
+        'stop_per_timer': {'stopped': len(running), 'queries': queries.count, 'ms': round(per_row_ms, 1)},
+    }
+
+
+def _latencies(fn, keep_going):
+    latencies = []
+    while keep_going():
+        started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {'requests': len(latencies), 'median_ms': percentile(latencies, 0.5), 'p95_ms': percentile(latencies, 0.95)}
+
+
+def bench_jobs(args):
+    """Dashboard latency while a job worker runs exports, against the same exports inline"""
+    import threading
+    import jobs
+
+    # The worker's spawned processes import this module again and must find the same database
+    os.environ['BENCH_DATABASE_URL'] = os.environ['DATABASE_URL']
+    results = []
+    for entries in args.entries:
+        reset_database()
+        user_id = seed_user(entries).id
+        client = login_client('bench')
+
+        started = time.perf_counter()
+        size = len(client.get('/export/time-entries?format=csv').data)
+        inline_ms = round((time.perf_counter() - started) * 1000, 1)
+
+        deadline = time.monotonic() + 2
+        idle = _latencies(lambda: client.get('/dashboard'), lambda: time.monotonic() < deadline)
+
+        submit = []
+        today = datetime.utcnow().date()
+        for n in range(args.jobs):
+            # A different range per job, so none is reused
+            params = {'format': 'csv', 'end': (today + timedelta(days=n + 1)).isoformat()}
+            t = time.perf_counter()
+            client.post('/api/v1/jobs', json={'kind': 'export', 'params': params})
+            submit.append((time.perf_counter() - t) * 1000)
+        submit.sort()
+
+        def run_worker():
+            with app.app_context():
+                jobs.work(processes=args.processes, poll_interval=0.1, once=True)
+
+        worker = threading.Thread(target=run_worker)
+        started = time.perf_counter()
+        worker.start()
+        busy = _latencies(lambda: client.get('/dashboard'), worker.is_alive)
+        worker.join()
+        db.session.rollback()
+        succeeded = db.session.query(jobs.Job).filter_by(user_id=user_id, status='succeeded').count()
+
+        results.append({
+            'entries': entries,
+            'export_bytes': size,
+            'inline_export_ms': inline_ms,
+            'jobs': args.jobs,
+            'succeeded': succeeded,
+            'jobs_wall_ms': round((time.perf_counter() - started) * 1000, 1),
+            'submit_median_ms': percentile(submit, 0.5),
+            'dashboard_idle': idle,
+            'dashboard_while_jobs_run': busy,
+        })
+    return results
+
+
+SCENARIOS = {
+    'convert_batch': bench_convert_batch,
+    'import': bench_import,
+    'jobs': bench_jobs,
+    'load': bench_load,
+    'nplusone': bench_nplusone,
+    'plans': bench_plans,
+    'planner': bench_planner,
+    'projects': bench_projects,
+    'routes': bench_routes,
+    'sweep': bench_sweep,
+    'team_report': bench_team_report,
+    'timer_stress': bench_timer_stress,
+    'timeseries': bench_timeseries,
+    'timezones': bench_timezones,
+    'weekly': bench_weekly,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--entries', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='dataset sizes to run the scenario at (routes: entries per user)')
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per dataset size')
+    parser.add_argument('--users', type=int, default=10, help='users sharing the dataset (plans, routes scenarios)')
+    parser.add_argument('--projects', type=int, default=5, help='projects per user (routes scenario)')
+    parser.add_argument('--tasks', type=int, default=4, help='tasks per project (routes scenario)')
+    parser.add_argument('--years', type=float, default=1, help='years of history per user (routes scenario)')
+    parser.add_argument('--cold', action='store_true', help='clear the caches before every request (routes scenario)')
+    parser.add_argument('--skip-http', action='store_true', help='test client only, no HTTP load (routes scenario)')
+    parser.add_argument('--rows', type=int, default=20, help='rows per list page (nplusone scenario)')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows per insert batch (import scenario), users per batch (sweep scenario)')
+    parser.add_argument('--modes', nargs='+', choices=['sync', 'async'], default=['sync', 'async'],
+                        help='server modes to compare (load, routes scenarios)')
+    parser.add_argument('--workers', type=int, default=2, help='server worker processes (load, routes scenarios)')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent clients (load, routes scenarios)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per endpoint (load, routes scenarios)')
+    parser.add_argument('--org-users', type=int, default=5000, help='organization members (team_report, sweep scenarios)')
+    parser.add_argument('--teams', type=int, default=50, help='teams in the organization (team_report, sweep scenarios)')
+    parser.add_argument('--threads', type=int, default=8, help='racing threads (timer_stress scenario)')
+    parser.add_argument('--actions', type=int, default=200, help='timer actions per thread (timer_stress scenario)')
+    parser.add_argument('--jobs', type=int, default=8, help='export jobs to queue (jobs scenario)')
+    parser.add_argument('--processes', type=int, default=2, help='job worker processes (jobs scenario)')
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        results = SCENARIOS[args.scenario](args)
+        backend = db.engine.url.get_backend_name()
+    json.dump({'scenario': args.scenario, 'database': backend, 'results': results}, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if isinstance(results, dict) and results.get('failed'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
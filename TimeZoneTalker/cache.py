@@ -0,0 +1,344 @@
+"""Per-user stats cache.
+
+Dashboard and report stats only change when a user's entries or projects are
+written, so they are cached per user (and per week for the weekly chart) and
+invalidated from SQLAlchemy session events once the write commits.
+
+The backend is chosen by STATS_CACHE_URL:
+
+    none://            caching disabled (default)
+    memory://          in-process LRU with TTL; one process only
+    redis://host/0     shared Redis, or anything with the same get/setex/delete/scan_iter API
+    fakeredis://       RedisCache over an in-process FakeRedis, for exercising that backend
+
+Invalidation happens in the process that commits the write. With memory://
+other gunicorn workers, and the CLI processes (`flask jobs work`, `flask
+timers sweep`, imports and rollup rebuilds), can't reach this process's
+cache, which keeps serving stale values for up to STATS_CACHE_TTL. Use it
+only when a single process serves requests and writes; otherwise configure
+Redis.
+
+The same backend also holds team report pages (teams.py). Session
+principals (principal.py) have their own PRINCIPAL_CACHE_URL, memory:// by
+default so that authenticated requests skip the user query even with the
+stats cache off. They are evicted when their User row is written; other
+processes pick up the change once PRINCIPAL_CACHE_TTL runs out.
+
+Values must be JSON-serialisable so every backend stores the same thing.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+import json
+import logging
+import threading
+import time
+from sqlalchemy import event, inspect
+from app import app, db
+from models import User, Project, TimeEntry, OrganizationMember, Team, TeamMember
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL"""
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Cache backed by a Redis client (or a compatible fake exposing get/setex/delete/scan_iter)"""
+
+    def __init__(self, client, ttl=300, namespace='timetracker:'):
+        self.client = client
+        self.ttl = ttl
+        self.namespace = namespace
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis  # optional dependency, only needed for this backend
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        raw = self.client.get(self.namespace + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.setex(self.namespace + key, self.ttl if ttl is None else ttl, json.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*(self.namespace + key for key in keys))
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=self.namespace + prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        self.delete_prefix('')
+
+
+class FakeRedis:
+    """In-process stand-in for the subset of the Redis client RedisCache uses"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is not None and item[0] < time.monotonic():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key)
+            return None if item is None else item[1]
+
+    def setex(self, key, ttl, value):
+        if isinstance(value, str):
+            value = value.encode()
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def scan_iter(self, match='*'):
+        with self._lock:
+            keys = [key for key in list(self._data) if self._live(key) and fnmatchcase(key, match)]
+        return iter(keys)
+
+
+class NullCache:
+    """Backend used when caching is switched off"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def delete_prefix(self, prefix):
+        pass
+
+    def clear(self):
+        pass
+
+
+def create_cache(url, ttl=300, max_entries=1024):
+    """Build a cache backend from a STATS_CACHE_URL or PRINCIPAL_CACHE_URL value"""
+    scheme = url.split('://', 1)[0] if url else 'none'
+    if scheme == 'memory':
+        return MemoryCache(max_entries=max_entries, ttl=ttl)
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisCache.from_url(url, ttl=ttl)
+    if scheme == 'fakeredis':
+        return RedisCache(FakeRedis(), ttl=ttl)
+    if scheme == 'none':
+        return NullCache()
+    raise ValueError(f"Unsupported cache URL scheme: {scheme}")
+
+
+stats_cache = create_cache(
+    app.config.get('STATS_CACHE_URL'),
+    ttl=app.config.get('STATS_CACHE_TTL', 300),
+    max_entries=app.config.get('STATS_CACHE_SIZE', 1024),
+)
+
+
+# Session principals (see principal.py), cached whether or not stats are
+principal_cache = create_cache(
+    app.config.get('PRINCIPAL_CACHE_URL', 'memory://'),
+    ttl=app.config.get('PRINCIPAL_CACHE_TTL', 300),
+    max_entries=app.config.get('STATS_CACHE_SIZE', 1024),
+)
+
+
+# Team and organization report pages (see teams.py), kept for their own TTL
+report_cache = create_cache(
+    app.config.get('STATS_CACHE_URL'),
+    ttl=app.config.get('REPORT_CACHE_TTL', 120),
+    max_entries=app.config.get('STATS_CACHE_SIZE', 1024),
+)
+
+
+def is_process_local():
+    """True when the configured backend lives in this process, so other processes can't invalidate it"""
+    return isinstance(stats_cache, MemoryCache)
+
+
+def principal_key(user_id):
+    # "identity" rather than the former "principal" key, whose entries lacked the idle setting
+    return f"identity:{user_id}"
+
+
+def weekly_key(user_id, week_start):
+    # "week" rather than the former "weekly" key, whose live entries had another shape
+    return f"stats:{user_id}:week:{week_start.isoformat()}"
+
+
+def projects_key(user_id):
+    return f"stats:{user_id}:projects"
+
+
+def report_prefix(scope, scope_id):
+    return f"report:{scope}:{scope_id}:"
+
+
+def report_key(scope, scope_id, since, until, group_by, source, page, per_page):
+    return (f"{report_prefix(scope, scope_id)}{since.isoformat()}:{until.isoformat()}:"
+            f"{group_by}:{source}:{page}:{per_page}")
+
+
+def invalidate_user(user_id):
+    """Drop every cached stat for a user, for writes that bypass the ORM"""
+    stats_cache.delete_prefix(f"stats:{user_id}:")
+
+
+def _weeks_touching(start_time, end_time=None):
+    # The local date can differ from the UTC date by a day either way, so clear
+    # every week that the neighbouring dates fall in. Time is split across the
+    # days an entry covers, so that runs through to the day it ends.
+    first = (start_time - timedelta(days=1)).date()
+    last = (max(start_time, end_time or start_time) + timedelta(days=1)).date()
+    week = first - timedelta(days=first.weekday())
+    weeks = set()
+    while week <= last:
+        weeks.add(week)
+        week += timedelta(days=7)
+    return weeks
+
+
+def entry_end(entry):
+    """When the time an entry covers ends, or now while it keeps growing"""
+    if entry.status != 'running' and entry.duration is not None:
+        return entry.start_time + timedelta(seconds=entry.duration)
+    if entry.status != 'running' and entry.end_time is not None:
+        return entry.end_time
+    return datetime.utcnow()
+
+
+def entry_keys(user_id, start_times, end_time=None):
+    """Keys of every stat an entry starting at any of `start_times` and ending at `end_time` feeds into"""
+    keys = {projects_key(user_id)}
+    for start_time in start_times:
+        if start_time is not None:
+            keys.update(weekly_key(user_id, week) for week in _weeks_touching(start_time, end_time))
+    return keys
+
+
+def _keys_for_entry(entry):
+    state = inspect(entry)
+    start_times = {entry.start_time}
+    start_times.update(state.attrs.start_time.history.deleted or ())
+    end_time = entry_end(entry) if entry.start_time is not None else None
+    # The end before this change, for entries whose duration or end was shortened
+    for duration in state.attrs.duration.history.deleted or ():
+        if duration is not None and entry.start_time is not None:
+            end_time = max(end_time, entry.start_time + timedelta(seconds=duration))
+    for previous_end in state.attrs.end_time.history.deleted or ():
+        if previous_end is not None and end_time is not None:
+            end_time = max(end_time, previous_end)
+    return entry_keys(entry.user_id, start_times, end_time)
+
+
+def mark_stale(session, keys):
+    """Invalidate keys when the session commits, for UPDATE statements the flush doesn't see"""
+    session.info.setdefault('stale_stats_keys', set()).update(keys)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_stale_keys(session, flush_context):
+    stale = session.info.setdefault('stale_stats_keys', set())
+    stale_users = session.info.setdefault('stale_stats_users', set())
+    stale_principals = session.info.setdefault('stale_principal_keys', set())
+    stale_reports = session.info.setdefault('stale_report_prefixes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, OrganizationMember):
+            stale_reports.add(report_prefix('organization', obj.organization_id))
+        elif isinstance(obj, Team):
+            stale_reports.update((report_prefix('team', obj.id), report_prefix('organization', obj.organization_id)))
+        elif isinstance(obj, TeamMember):
+            # The team's organization isn't loaded here; membership changes are rare enough to clear them all
+            stale_reports.update((report_prefix('team', obj.team_id), 'report:organization:'))
+        elif isinstance(obj, User) and obj.id is not None:
+            stale_principals.add(principal_key(obj.id))
+        elif isinstance(obj, TimeEntry) and obj.user_id is not None:
+            stale.update(_keys_for_entry(obj))
+        elif isinstance(obj, Project) and obj.user_id is not None:
+            # Names and colours appear in the stats; deleting a project removes its entries too
+            stale_users.add(obj.user_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_stale_keys(session):
+    stale = session.info.pop('stale_stats_keys', set())
+    stale_users = session.info.pop('stale_stats_users', set())
+    stale_principals = session.info.pop('stale_principal_keys', set())
+    stale_reports = session.info.pop('stale_report_prefixes', set())
+    try:
+        if stale:
+            stats_cache.delete(*stale)
+        for user_id in stale_users:
+            invalidate_user(user_id)
+        if stale_principals:
+            principal_cache.delete(*stale_principals)
+        for prefix in stale_reports:
+            report_cache.delete_prefix(prefix)
+    except Exception as e:
+        logger.error("Error invalidating stats cache: %s", e)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_stale_keys(session):
+    session.info.pop('stale_stats_keys', None)
+    session.info.pop('stale_stats_users', None)
+    session.info.pop('stale_principal_keys', None)
+    session.info.pop('stale_report_prefixes', None)
@@ -0,0 +1,257 @@
+import click
+from app import app
+
+
+def _warn_if_cache_is_process_local():
+    """Writes from this process can't evict a memory:// cache held by the web processes"""
+    import cache
+
+    if cache.is_process_local():
+        click.echo("Warning: STATS_CACHE_URL is memory://, so web processes keep serving stats cached "
+                   "before these changes for up to STATS_CACHE_TTL seconds", err=True)
+
+
+@app.cli.group()
+def db():
+    """Manage the database schema."""
+
+
+@db.command('upgrade')
+@click.option('--target', type=int, default=None, help='Stop after this migration version.')
+def upgrade_db(target):
+    """Apply pending schema migrations."""
+    import migrations
+
+    applied = migrations.upgrade(target=target)
+    if applied:
+        click.echo("Applied migrations: " + ", ".join(str(version) for version in applied))
+    else:
+        click.echo("Database schema is up to date")
+
+
+@db.command('status')
+def db_status():
+    """List schema migrations and whether they have been applied."""
+    import migrations
+
+    for version, description, applied in migrations.status():
+        click.echo(f"{'x' if applied else ' '} {version:4d}  {description}")
+
+
+@app.cli.group()
+def rollups():
+    """Maintain the daily project rollup table."""
+
+
+@rollups.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild rollups for this user.')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+def rebuild_rollups(user_id, batch_size):
+    """Backfill rollup rows from the full time entry history."""
+    import rollups as rollup_store
+
+    _warn_if_cache_is_process_local()
+    rows = rollup_store.rebuild(user_id=user_id, batch_size=batch_size)
+    click.echo(f"Rebuilt {rows} rollup rows")
+
+
+@app.cli.group()
+def entries():
+    """Bulk time entry operations."""
+
+
+@entries.command('import')
+@click.argument('path', type=click.File('r', encoding='utf-8'))
+@click.option('--user', 'username', required=True, help='Username that will own the entries.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Input format (defaults to the file extension).')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+def import_entries(path, username, fmt, batch_size):
+    """Import time entries from a CSV or NDJSON file ('-' reads stdin)."""
+    import importer
+    from models import User
+
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username!r}")
+    if fmt is None:
+        fmt = 'ndjson' if path.name.endswith(('.ndjson', '.jsonl')) else 'csv'
+    _warn_if_cache_is_process_local()
+
+    result = importer.import_entries(user.id, path, fmt=fmt, batch_size=batch_size)
+    click.echo(f"Imported {result.imported} entries, skipped {result.skipped}")
+    for error in result.errors:
+        click.echo(f"  line {error['line']}: {error['error']}", err=True)
+
+
+@entries.command('export')
+@click.option('--user', 'username', required=True, help='Username whose entries are exported.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv', show_default=True)
+@click.option('--start', default=None, help='First local date to include (YYYY-MM-DD).')
+@click.option('--end', default=None, help='Local date to stop before (YYYY-MM-DD).')
+@click.option('--project-id', type=int, default=None)
+@click.option('--task-id', type=int, default=None)
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', show_default=True)
+def export_entries(username, fmt, start, end, project_id, task_id, output):
+    """Stream a user's time entries to a CSV or NDJSON file."""
+    import exporter
+    from models import User
+
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username!r}")
+    try:
+        filters = {
+            'start': exporter.parse_date(start, user.timezone),
+            'end': exporter.parse_date(end, user.timezone),
+            'project_id': project_id,
+            'task_id': task_id,
+        }
+    except ValueError:
+        raise click.BadParameter('dates must be YYYY-MM-DD')
+
+    writer, _ = exporter.WRITERS[fmt]
+    for chunk in writer(exporter.export_records(user.id, user.timezone, **filters)):
+        output.write(chunk)
+
+
+@app.cli.group()
+def jobs():
+    """Run and maintain background jobs."""
+
+
+@jobs.command('work')
+@click.option('--processes', type=int, default=2, show_default=True, help='Jobs run at the same time.')
+@click.option('--poll-interval', type=float, default=1.0, show_default=True, help='Seconds between queue checks.')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty.')
+def work_jobs(processes, poll_interval, once):
+    """Run queued jobs in a process pool."""
+    import jobs as job_queue
+
+    _warn_if_cache_is_process_local()
+    try:
+        counts = job_queue.work(processes=processes, poll_interval=poll_interval, once=once)
+    except KeyboardInterrupt:
+        return
+    click.echo(f"Ran {counts['succeeded']} jobs, {counts['failed']} failed")
+
+
+@jobs.command('purge')
+def purge_jobs():
+    """Delete finished jobs older than JOB_RETENTION_HOURS."""
+    import jobs as job_queue
+
+    click.echo(f"Deleted {job_queue.purge()} finished jobs")
+
+
+@app.cli.group()
+def timers():
+    """Maintain running and paused timers."""
+
+
+@timers.command('sweep')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='Users checked per batch.')
+@click.option('--dry-run', is_flag=True, help='Report what would be stopped without changing anything.')
+def sweep_timers(batch_size, dry_run):
+    """Stop timers left running past their user's max-duration or idle limit."""
+    import sweeper
+
+    if not dry_run:
+        _warn_if_cache_is_process_local()
+    result = sweeper.sweep(batch_size=batch_size, dry_run=dry_run)
+    for entry in result.entries:
+        click.echo(
+            f"{entry['previous_status']:7s} entry {entry['id']} of {entry['username']}: "
+            f"{entry['reason']}, {entry['duration'] // 60} min from {entry['start_time']}"
+        )
+    stop, complete = ('Would stop', 'would complete') if dry_run else ('Stopped', 'completed')
+    reasons = ', '.join(f"{count} {reason}" for reason, count in result.stopped.items())
+    click.echo(f"{stop} {sum(result.stopped.values())} running timers ({reasons}), "
+               f"{complete} {result.completed} paused ones; checked {result.users} users")
+
+
+@app.cli.group()
+def orgs():
+    """Manage organizations, teams and their members."""
+
+
+def _find_user(username):
+    from models import User
+
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username!r}")
+    return user
+
+
+def _find_organization(name):
+    from models import Organization
+
+    organization = Organization.query.filter_by(name=name).first()
+    if organization is None:
+        raise click.ClickException(f"No organization named {name!r}")
+    return organization
+
+
+@orgs.command('create')
+@click.argument('name')
+def create_organization(name):
+    """Create an organization."""
+    from app import db
+    from models import Organization
+
+    organization = Organization(name=name)
+    db.session.add(organization)
+    db.session.commit()
+    click.echo(f"Created organization {organization.id}: {name}")
+
+
+@orgs.command('create-team')
+@click.argument('organization')
+@click.argument('name')
+def create_team(organization, name):
+    """Create a team in an organization."""
+    from app import db
+    from models import Team
+
+    team = Team(organization_id=_find_organization(organization).id, name=name)
+    db.session.add(team)
+    db.session.commit()
+    click.echo(f"Created team {team.id}: {name}")
+
+
+@orgs.command('add-member')
+@click.argument('organization')
+@click.argument('username')
+@click.option('--team', default=None, help='Also add the user to this team.')
+@click.option('--role', type=click.Choice(['member', 'manager', 'admin']), default='member', show_default=True,
+              help='admin applies to the organization, manager to the team.')
+def add_member(organization, username, team, role):
+    """Add a user to an organization, and optionally to one of its teams."""
+    from app import db
+    from models import OrganizationMember, Team, TeamMember
+
+    org = _find_organization(organization)
+    user = _find_user(username)
+    if role == 'manager' and team is None:
+        raise click.BadParameter('--role manager needs --team')
+
+    membership = OrganizationMember.query.filter_by(organization_id=org.id, user_id=user.id).first()
+    if membership is None:
+        membership = OrganizationMember(organization_id=org.id, user_id=user.id, role='member')
+        db.session.add(membership)
+    if role == 'admin':
+        membership.role = 'admin'
+
+    if team is not None:
+        team_row = Team.query.filter_by(organization_id=org.id, name=team).first()
+        if team_row is None:
+            raise click.ClickException(f"No team named {team!r} in {organization!r}")
+        team_membership = TeamMember.query.filter_by(team_id=team_row.id, user_id=user.id).first()
+        if team_membership is None:
+            team_membership = TeamMember(team_id=team_row.id, user_id=user.id, role='member')
+            db.session.add(team_membership)
+        if role == 'manager':
+            team_membership.role = 'manager'
+    db.session.commit()
+    click.echo(f"Added {username} to {organization}" + (f" / {team}" if team else ""))
@@ -0,0 +1,118 @@
+"""Streaming export of time entries as CSV or NDJSON.
+
+Rows are read in keyset-ordered chunks. Each chunk is fetched with a
+server-side cursor (yield_per) on its own short-lived connection, which is
+returned to the pool before the chunk is written out, so a slow client never
+holds a transaction open. Memory stays bounded by the chunk size.
+"""
+import csv
+from datetime import datetime
+import io
+import json
+from sqlalchemy import and_, or_, select
+from app import db
+import timezones
+from models import Project, Task, TimeEntry
+from utils import format_duration
+
+EXPORT_COLUMNS = (
+    'id', 'project', 'task', 'description', 'start_time', 'end_time', 'duration', 'duration_hms', 'status',
+)
+
+
+def _entry_rows(user_id, start=None, end=None, project_id=None, task_id=None, chunk_size=1000):
+    """Yield export rows in (start_time, id) order, one short query per chunk"""
+    columns = (
+        TimeEntry.id, TimeEntry.start_time, TimeEntry.end_time, TimeEntry.duration, TimeEntry.status,
+        TimeEntry.description, Project.name.label('project'), Task.name.label('task'),
+    )
+    base = select(*columns).join(Project, TimeEntry.project_id == Project.id).outerjoin(
+        Task, TimeEntry.task_id == Task.id
+    ).where(TimeEntry.user_id == user_id)
+    if start is not None:
+        base = base.where(TimeEntry.start_time >= start)
+    if end is not None:
+        base = base.where(TimeEntry.start_time < end)
+    if project_id is not None:
+        base = base.where(TimeEntry.project_id == project_id)
+    if task_id is not None:
+        base = base.where(TimeEntry.task_id == task_id)
+    base = base.order_by(TimeEntry.start_time, TimeEntry.id)
+
+    position = None
+    while True:
+        query = base
+        if position is not None:
+            last_start, last_id = position
+            query = query.where(or_(
+                TimeEntry.start_time > last_start,
+                and_(TimeEntry.start_time == last_start, TimeEntry.id > last_id),
+            ))
+        with db.engine.connect() as connection:
+            result = connection.execution_options(yield_per=chunk_size).execute(query.limit(chunk_size))
+            rows = result.all()
+        if not rows:
+            return
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        position = (rows[-1].start_time, rows[-1].id)
+
+
+def _local_iso(dt, timezone_str):
+    if dt is None:
+        return None
+    return timezones.utc_to_local(dt, timezone_str).isoformat()
+
+
+def export_records(user_id, timezone_str='UTC', now=None, **filters):
+    """Yield one dict per entry with times and durations in the user's timezone"""
+    for row in _entry_rows(user_id, **filters):
+        if row.status == 'running':
+            duration = max(int(((now or datetime.utcnow()) - row.start_time).total_seconds()), 0)
+        else:
+            duration = row.duration or 0
+        yield {
+            'id': row.id,
+            'project': row.project,
+            'task': row.task,
+            'description': row.description,
+            'start_time': _local_iso(row.start_time, timezone_str),
+            'end_time': _local_iso(row.end_time, timezone_str),
+            'duration': duration,
+            'duration_hms': format_duration(duration),
+            'status': row.status,
+        }
+
+
+def stream_csv(records):
+    """Yield CSV text chunks for an iterable of export records"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for count, record in enumerate(records, start=1):
+        writer.writerow(record)
+        if count % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_ndjson(records):
+    """Yield NDJSON lines for an iterable of export records"""
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+WRITERS = {
+    'csv': (stream_csv, 'text/csv'),
+    'ndjson': (stream_ndjson, 'application/x-ndjson'),
+}
+
+
+def parse_date(value, timezone_str='UTC'):
+    """Parse a YYYY-MM-DD local date into the naive UTC datetime of its midnight"""
+    if not value:
+        return None
+    return timezones.local_to_utc(datetime.strptime(value, '%Y-%m-%d'), timezone_str)
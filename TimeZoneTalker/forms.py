@@ -1,7 +1,7 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, TextAreaField, SelectField, HiddenField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
-import pytz
+from wtforms import StringField, PasswordField, SubmitField, TextAreaField, SelectField, HiddenField, IntegerField
+from wtforms.validators import DataRequired, Email, EqualTo, Length, NumberRange, ValidationError
+from timezones import TIMEZONE_CHOICES
 
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
@@ -13,7 +13,7 @@ class RegisterForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[DataRequired(), Length(min=6)])
     confirm_password = PasswordField('Confirm Password', validators=[DataRequired(), EqualTo('password')])
-    timezone = SelectField('Timezone', choices=[(tz, tz) for tz in pytz.common_timezones], default='UTC')
+    timezone = SelectField('Timezone', choices=TIMEZONE_CHOICES, default='UTC')
     submit = SubmitField('Register')
 
 class ProjectForm(FlaskForm):
@@ -47,7 +47,19 @@ class TimeEntryEditForm(FlaskForm):
     submit = SubmitField('Update')
 
 class TimezoneConverterForm(FlaskForm):
-    source_timezone = SelectField('From Timezone', choices=[(tz, tz) for tz in pytz.common_timezones], default='UTC')
-    target_timezone = SelectField('To Timezone', choices=[(tz, tz) for tz in pytz.common_timezones], default='UTC')
+    source_timezone = SelectField('From Timezone', choices=TIMEZONE_CHOICES, default='UTC')
+    target_timezone = SelectField('To Timezone', choices=TIMEZONE_CHOICES, default='UTC')
     date_time = StringField('Date and Time (YYYY-MM-DD HH:MM)', validators=[DataRequired()])
     submit = SubmitField('Convert')
+
+class MeetingPlannerForm(FlaskForm):
+    participant_timezones = TextAreaField('Participant Timezones (one per line)', validators=[DataRequired()])
+    work_start = StringField('Working Hours Start (HH:MM)', default='09:00', validators=[DataRequired()])
+    work_end = StringField('Working Hours End (HH:MM)', default='17:00', validators=[DataRequired()])
+    start_date = StringField('From Date (YYYY-MM-DD)', validators=[DataRequired()])
+    weeks = SelectField('Look Ahead', coerce=int, default=2, choices=[
+        (1, '1 week'), (2, '2 weeks'), (4, '4 weeks'), (8, '8 weeks'), (13, '13 weeks')
+    ])
+    min_minutes = IntegerField('Minimum Length (minutes)', default=30, validators=[NumberRange(min=5, max=600)])
+    submit = SubmitField('Find Windows')
+
@@ -0,0 +1,272 @@
+"""Bulk import of time entries from CSV or NDJSON.
+
+Input is streamed row by row and inserted in batches with executemany, so
+memory stays bounded by the batch size rather than the file size. Each row
+names its project and task either by id (project_id, task_id) or by name
+(project, task); both are checked against a lookup map of the user's own
+projects and tasks fetched once up front.
+
+Recognised columns: project_id/project, task_id/task, description,
+start_time, end_time, duration (seconds or HH:MM:SS) and status
+(completed or paused, default completed). Naive timestamps are read in the
+user's timezone.
+"""
+import csv
+from collections import defaultdict
+from datetime import datetime, timedelta
+import json
+from sqlalchemy import insert, select
+from app import db
+import timezones
+from models import Project, Task, TimeEntry
+import cache
+import rollups
+
+IMPORTABLE_STATUSES = ('completed', 'paused')
+MAX_REPORTED_ERRORS = 100
+# Longest single entry accepted, which also keeps durations within a 32-bit column
+MAX_DURATION = 366 * 24 * 3600
+
+
+class ImportRowError(ValueError):
+    """A single input row could not be imported"""
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []
+
+    def add_error(self, line, message):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def to_dict(self):
+        return {'imported': self.imported, 'skipped': self.skipped, 'errors': self.errors}
+
+
+def read_csv(stream):
+    """Yield (line number, row dict) from a CSV text stream with a header row"""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_ndjson(stream):
+    """Yield (line number, row dict) from a newline-delimited JSON text stream"""
+    for line_num, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_num, ImportRowError(f'invalid JSON: {e}')
+            continue
+        if not isinstance(row, dict):
+            yield line_num, ImportRowError('expected a JSON object')
+            continue
+        yield line_num, row
+
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+def _text(row, field):
+    """A field's stripped string value, '' when missing; NDJSON values of other types are rejected"""
+    value = row.get(field)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise ImportRowError(f'{field} must be a string')
+    return value.strip()
+
+
+def _integer(value, field):
+    if isinstance(value, bool):
+        raise ImportRowError(f'invalid {field} {value!r}')
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ImportRowError(f'invalid {field} {value!r}')
+
+
+def parse_hms(value):
+    """Seconds in an HH:MM:SS duration; anything else is an error rather than zero"""
+    parts = value.strip().split(':')
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        raise ImportRowError(f'invalid duration {value!r}, expected HH:MM:SS')
+    hours, minutes, seconds = (int(part) for part in parts)
+    if minutes > 59 or seconds > 59:
+        raise ImportRowError(f'invalid duration {value!r}, expected HH:MM:SS')
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class EntryLookup:
+    """The user's projects and tasks, by id and by name, fetched in two queries"""
+
+    def __init__(self, user_id):
+        self.projects = {}
+        self.project_names = {}
+        for project_id, name in db.session.execute(
+            select(Project.id, Project.name).where(Project.user_id == user_id)
+        ):
+            self.projects[project_id] = name
+            self.project_names.setdefault(name.strip().lower(), project_id)
+
+        self.tasks = {}
+        self.task_names = {}
+        for task_id, project_id, name in db.session.execute(
+            select(Task.id, Task.project_id, Task.name).join(Project).where(Project.user_id == user_id)
+        ):
+            self.tasks[task_id] = project_id
+            self.task_names.setdefault((project_id, name.strip().lower()), task_id)
+
+    def project_id(self, row):
+        value = row.get('project_id')
+        if value not in (None, ''):
+            project_id = _integer(value, 'project_id')
+            if project_id not in self.projects:
+                raise ImportRowError(f'unknown project_id {project_id}')
+            return project_id
+        name = _text(row, 'project').lower()
+        if not name:
+            raise ImportRowError('project or project_id is required')
+        if name not in self.project_names:
+            raise ImportRowError(f"unknown project {row.get('project')!r}")
+        return self.project_names[name]
+
+    def task_id(self, row, project_id):
+        value = row.get('task_id')
+        if value not in (None, '', 0, '0'):
+            task_id = _integer(value, 'task_id')
+            if self.tasks.get(task_id) != project_id:
+                raise ImportRowError(f'task_id {task_id} does not belong to the project')
+            return task_id
+        name = _text(row, 'task').lower()
+        if not name:
+            return None
+        if (project_id, name) not in self.task_names:
+            raise ImportRowError(f"unknown task {row.get('task')!r} for the project")
+        return self.task_names[(project_id, name)]
+
+
+def parse_timestamp(value, timezone_str):
+    """Parse an ISO 8601 timestamp to naive UTC, reading naive values in the given zone"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ImportRowError(f'invalid timestamp {value!r}')
+    try:
+        if not isinstance(value, str):
+            return datetime.utcfromtimestamp(value)
+        dt = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        if dt.tzinfo is None:
+            return timezones.local_to_utc(dt, timezone_str)
+        return dt.astimezone(timezones.UTC).replace(tzinfo=None)
+    except (ValueError, OverflowError, OSError):
+        # Out of range epochs overflow, and so do dates at the ends of the calendar
+        raise ImportRowError(f'invalid timestamp {value!r}')
+
+
+def parse_row(row, lookup, user_id, timezone_str):
+    """Validate one input row and return the TimeEntry column values"""
+    project_id = lookup.project_id(row)
+    task_id = lookup.task_id(row, project_id)
+
+    if not row.get('start_time'):
+        raise ImportRowError('start_time is required')
+    start_time = parse_timestamp(row['start_time'], timezone_str)
+    end_time = parse_timestamp(row['end_time'], timezone_str) if row.get('end_time') else None
+
+    duration = row.get('duration')
+    if duration in (None, ''):
+        if end_time is None:
+            raise ImportRowError('duration or end_time is required')
+        duration = int((end_time - start_time).total_seconds())
+    elif isinstance(duration, str) and ':' in duration:
+        duration = parse_hms(duration)
+    else:
+        duration = _integer(duration, 'duration')
+    if duration < 0:
+        raise ImportRowError('duration is negative')
+    if duration > MAX_DURATION:
+        raise ImportRowError(f'duration is longer than {MAX_DURATION // 86400} days')
+
+    status = _text(row, 'status').lower() or 'completed'
+    if status not in IMPORTABLE_STATUSES:
+        raise ImportRowError(f'status must be one of {", ".join(IMPORTABLE_STATUSES)}')
+    if status == 'completed' and end_time is None:
+        try:
+            end_time = start_time + timedelta(seconds=duration)
+        except OverflowError:
+            raise ImportRowError('end of the entry is out of range')
+
+    description = row.get('description')
+    if description is not None and not isinstance(description, str):
+        raise ImportRowError('description must be a string')
+
+    return {
+        'user_id': user_id,
+        'project_id': project_id,
+        'task_id': task_id,
+        'description': description or None,
+        'start_time': start_time,
+        'end_time': end_time,
+        'duration': duration,
+        'status': status,
+        'created_at': datetime.utcnow(),
+    }
+
+
+def _flush_batch(batch, timezone_str):
+    """Insert a batch with one executemany and fold it into the daily rollups"""
+    db.session.execute(insert(TimeEntry), batch)
+    totals = defaultdict(int)
+    for values in batch:
+        if values['duration']:
+            day = rollups.local_day(values['start_time'], timezone_str)
+            totals[(values['user_id'], values['project_id'], values['task_id'], day)] += values['duration']
+    for key, seconds in totals.items():
+        rollups.adjust(key, seconds)
+    db.session.commit()
+
+
+def import_entries(user_id, stream, fmt='csv', batch_size=5000, result=None):
+    """Import entries for a user from a text stream, committing every batch_size rows
+
+    Batches already committed stay in place if a later one fails. Pass an
+    ImportResult to see how many rows those were after an exception.
+    """
+    if fmt not in READERS:
+        raise ValueError(f'unsupported import format {fmt!r}')
+
+    timezone_str = rollups.get_user_timezone(user_id)
+    lookup = EntryLookup(user_id)
+    if result is None:
+        result = ImportResult()
+    batch = []
+
+    try:
+        for line_num, row in READERS[fmt](stream):
+            try:
+                if isinstance(row, ImportRowError):
+                    raise row
+                batch.append(parse_row(row, lookup, user_id, timezone_str))
+            except ImportRowError as e:
+                result.add_error(line_num, str(e))
+                continue
+            if len(batch) >= batch_size:
+                _flush_batch(batch, timezone_str)
+                result.imported += len(batch)
+                batch = []
+        if batch:
+            _flush_batch(batch, timezone_str)
+            result.imported += len(batch)
+    finally:
+        if result.imported:
+            cache.invalidate_user(user_id)
+    return result
@@ -0,0 +1,258 @@
+"""Per-request timing and query instrumentation.
+
+While app.config["INSTRUMENTATION"] is on, every request records:
+- its total time;
+- the number of SQL statements it ran and the time spent in them;
+- named spans, such as the stats helpers wrapped with @span.
+
+The measurements are reported in three places:
+- a Server-Timing response header, which browser dev tools display;
+- one structured log line per request on the "instrumentation" logger;
+- Prometheus text counters at /metrics.
+
+The flag is read on every request, so it can be flipped at runtime. /metrics
+and /metrics/instrumentation are only served when METRICS_TOKEN is set, and
+require "Authorization: Bearer <token>". POST {"enabled": true|false} to
+/metrics/instrumentation to switch instrumentation for the worker that
+receives the request. The counters are per process, so scrape each worker
+separately.
+
+Requests served outside Flask (the async handlers in asgi.py) set
+request_stats themselves and report through record().
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import hmac
+import json
+import logging
+import threading
+import time
+from flask import Response, abort, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+logger = logging.getLogger('instrumentation')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def enabled():
+    return bool(app.config.get('INSTRUMENTATION'))
+
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(DURATION_BUCKETS), 0, 0.0]
+            index = bisect_left(DURATION_BUCKETS, seconds)
+            if index < len(DURATION_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(b), c, s)) for key, (b, c, s) in self._histograms.items())
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{_labels(labels)} {value:g}')
+        for (name, labels), (buckets, count, total) in histograms:
+            header(name)
+            cumulative = 0
+            for bound, hits in zip(DURATION_BUCKETS, buckets):
+                cumulative += hits
+                lines.append(f'{name}_bucket{_labels(labels + (("le", f"{bound:g}"),))} {cumulative}')
+            lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+metrics = Metrics()
+metrics.describe('http_requests_total', 'counter', 'Requests handled, by endpoint, method and status')
+metrics.describe('http_request_duration_seconds', 'histogram', 'Request handling time, by endpoint')
+metrics.describe('db_queries_total', 'counter', 'SQL statements executed, by endpoint')
+metrics.describe('db_query_seconds_total', 'counter', 'Time spent in SQL statements, by endpoint')
+metrics.describe('span_duration_seconds', 'histogram', 'Time spent in named spans')
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.spans = {}
+
+
+# RequestStats of a request served outside Flask, see asgi.py
+request_stats = ContextVar('request_stats', default=None)
+
+
+def _current():
+    return g.get('_instrumentation') if has_request_context() else request_stats.get()
+
+
+@contextmanager
+def measure(name):
+    """Time a block as a named span of the current request"""
+    stats = _current()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stats.spans[name] = stats.spans.get(name, 0.0) + elapsed
+        metrics.observe('span_duration_seconds', (('span', name),), elapsed)
+
+
+def span(name):
+    """Decorator form of measure()"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapped(*args, **kwargs):
+            with measure(name):
+                return fn(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if _current() is not None:
+        conn.info.setdefault('instrumentation_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    stats = _current()
+    started = conn.info.get('instrumentation_started')
+    if stats is not None and started:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - started.pop()
+
+
+@app.before_request
+def _start_request():
+    if enabled():
+        g._instrumentation = RequestStats()
+
+
+def record(stats, method, path, endpoint, status):
+    """Count and log a finished request, returning its Server-Timing header value"""
+    elapsed = time.perf_counter() - stats.started
+    endpoint = endpoint or 'unmatched'
+
+    metrics.inc('http_requests_total', (('endpoint', endpoint), ('method', method), ('status', status)))
+    metrics.observe('http_request_duration_seconds', (('endpoint', endpoint),), elapsed)
+    metrics.inc('db_queries_total', (('endpoint', endpoint),), stats.queries)
+    metrics.inc('db_query_seconds_total', (('endpoint', endpoint),), stats.db_seconds)
+
+    logger.info('%s', json.dumps({
+        'event': 'request',
+        'method': method,
+        'path': path,
+        'endpoint': endpoint,
+        'status': status,
+        'duration_ms': round(elapsed * 1000, 2),
+        'queries': stats.queries,
+        'db_ms': round(stats.db_seconds * 1000, 2),
+        'spans': {name: round(seconds * 1000, 2) for name, seconds in stats.spans.items()},
+    }))
+
+    timings = [f'app;dur={elapsed * 1000:.1f}', f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries"']
+    timings.extend(f'{name};dur={seconds * 1000:.1f}' for name, seconds in stats.spans.items())
+    return ', '.join(timings)
+
+
+@app.after_request
+def _finish_request(response):
+    stats = g.pop('_instrumentation', None)
+    if stats is None:
+        return response
+    response.headers['Server-Timing'] = record(
+        stats, request.method, request.path, request.endpoint, response.status_code
+    )
+    return response
+
+
+def _authorized():
+    supplied = request.headers.get('Authorization', '')
+    return hmac.compare_digest(supplied, f'Bearer {app.config["METRICS_TOKEN"]}')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus counters; not served without METRICS_TOKEN"""
+    if not app.config.get('METRICS_TOKEN'):
+        abort(404)
+    if not _authorized():
+        return Response('unauthorized\n', status=401, mimetype='text/plain')
+    body = metrics.render() + (
+        '# HELP instrumentation_enabled Whether this worker is recording requests\n'
+        '# TYPE instrumentation_enabled gauge\n'
+        f'instrumentation_enabled {int(enabled())}\n'
+    )
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/instrumentation', methods=['POST'])
+def toggle_instrumentation():
+    """Switch instrumentation on or off in this worker; not served without METRICS_TOKEN"""
+    if not app.config.get('METRICS_TOKEN'):
+        abort(404)
+    if not _authorized():
+        return jsonify({'error': 'unauthorized'}), 401
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('enabled'), bool):
+        return jsonify({'error': 'enabled must be true or false'}), 400
+    app.config['INSTRUMENTATION'] = data['enabled']
+    return jsonify({'enabled': enabled()})
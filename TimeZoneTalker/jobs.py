@@ -0,0 +1,478 @@
+"""Background jobs for heavy reports, exports and imports.
+
+The queue is the job table, so nothing runs beyond the database. The web app
+submits a job and answers at once; clients poll the job and download its
+result when it has succeeded:
+
+    POST /api/v1/jobs                 {"kind": "export", "params": {...}}
+    GET  /api/v1/jobs/<id>            status, and result_url once done
+    GET  /api/v1/jobs/<id>/result     the CSV, NDJSON or JSON it produced
+
+`flask jobs work` runs them. It claims queued jobs with a conditional UPDATE,
+so several workers can share one queue, and runs each in a process pool so
+CPU-heavy work doesn't hold up the claiming loop. A claim is a lease of
+JOB_LEASE_SECONDS that the worker renews while the job runs. If a worker
+dies, the lease lapses and another worker retries the job, up to
+JOB_MAX_ATTEMPTS times.
+
+Submitting the same report or export again within JOB_REUSE_TTL seconds
+returns the existing job instead of queueing another one. Imports are never
+reused. Finished jobs and their results are deleted after
+JOB_RETENTION_HOURS.
+
+Small results are kept on the job row. Exports are streamed chunk by chunk
+to a file under JOB_RESULT_DIR, and the row keeps only its path and size,
+so the worker's memory and the database stay bounded whatever the export's
+size. The web processes serve those files, so they must see the same
+directory as the job workers.
+"""
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from sqlalchemy import bindparam, delete, or_, select, update
+from app import app, db
+from models import Job, Project, Task
+import rollups
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINISHED_STATUSES = ('succeeded', 'failed')
+
+JobKind = namedtuple('JobKind', 'name prepare run reusable')
+KINDS = {}
+
+
+class JobError(ValueError):
+    pass
+
+
+def job_kind(name, prepare, reusable=True):
+    """Register the function that runs jobs of a kind
+
+    prepare(user_id, params) validates request parameters and returns them
+    normalised, so equal requests hash alike. The runner takes the Job and
+    returns (body, content type, download file name), where body is bytes or,
+    for results too large to hold in memory, an iterable of byte chunks
+    that is written to a file.
+    """
+    def register(fn):
+        KINDS[name] = JobKind(name, prepare, fn, reusable)
+        return fn
+    return register
+
+
+def _json_result(value, name):
+    return json.dumps(value).encode('utf-8'), 'application/json', name
+
+
+def _day(params, name, default=None):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return date.fromisoformat(str(value)).isoformat()
+    except ValueError:
+        raise JobError(f'{name} must be YYYY-MM-DD')
+
+
+def _owned_id(params, name, statement):
+    """An optional id parameter, checked with `statement` (selecting the row by :id) to belong to the user"""
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit():
+        raise JobError(f'{name} must be an integer')
+    if db.session.execute(statement.params(id=int(value))).first() is None:
+        raise JobError(f'{name} not found')
+    return int(value)
+
+
+def _prepare_export(user_id, params):
+    import exporter
+
+    fmt = params.get('format', 'csv')
+    if fmt not in exporter.WRITERS:
+        raise JobError(f'unsupported format {fmt}')
+    project_id = _owned_id(params, 'project_id', select(Project.id).where(
+        Project.id == bindparam('id'), Project.user_id == user_id,
+    ))
+    task = select(Task.id).join(Project, Task.project_id == Project.id).where(
+        Task.id == bindparam('id'), Project.user_id == user_id,
+    )
+    if project_id is not None:
+        task = task.where(Task.project_id == project_id)
+    return {
+        'format': fmt,
+        'start': _day(params, 'start'),
+        'end': _day(params, 'end'),
+        'project_id': project_id,
+        'task_id': _owned_id(params, 'task_id', task),
+        'timezone': rollups.get_user_timezone(user_id),
+    }
+
+
+@job_kind('export', _prepare_export)
+def run_export(job):
+    import exporter
+
+    params = json.loads(job.params)
+    timezone_str = params['timezone']
+    writer, content_type = exporter.WRITERS[params['format']]
+    records = exporter.export_records(
+        job.user_id, timezone_str,
+        start=exporter.parse_date(params['start'], timezone_str),
+        end=exporter.parse_date(params['end'], timezone_str),
+        project_id=params['project_id'],
+        task_id=params['task_id'],
+    )
+    chunks = (chunk.encode('utf-8') for chunk in writer(records))
+    return chunks, content_type, f"time-entries.{params['format']}"
+
+
+def _prepare_import(user_id, params):
+    import importer
+
+    fmt = params.get('format', 'csv')
+    if fmt not in importer.READERS:
+        raise JobError(f'unsupported format {fmt}')
+    return {'format': fmt}
+
+
+@job_kind('import', _prepare_import, reusable=False)
+def run_import(job):
+    import importer
+
+    stream = io.StringIO(job.payload.decode('utf-8'), newline='')
+    result = importer.ImportResult()
+    try:
+        importer.import_entries(
+            job.user_id, stream, fmt=json.loads(job.params)['format'],
+            batch_size=app.config['IMPORT_BATCH_SIZE'], result=result,
+        )
+    except Exception as e:
+        # Committed batches stay, so rerunning the whole file would import them twice
+        raise JobError(f'{e or type(e).__name__} ({result.imported} entries were already imported)') from e
+    return _json_result(result.to_dict(), 'import.json')
+
+
+def _prepare_report(user_id, params):
+    import reporting
+
+    timezone_str = rollups.get_user_timezone(user_id)
+    start, end = reporting.default_range(timezone_str)
+    group_by = params.get('group_by') or ()
+    if isinstance(group_by, str):
+        group_by = reporting.parse_group_by(group_by)
+    prepared = {
+        'start': _day(params, 'start', start.isoformat()),
+        'end': _day(params, 'end', end.isoformat()),
+        'granularity': params.get('granularity', 'day'),
+        'group_by': list(group_by),
+        'timezone': timezone_str,
+    }
+    try:
+        # Bad ranges and groupings fail here rather than in the worker
+        reporting.TimeSeries(reporting.buckets(
+            date.fromisoformat(prepared['start']), date.fromisoformat(prepared['end']),
+            prepared['granularity'], timezone_str,
+        ), group_by)
+    except reporting.ReportError as e:
+        raise JobError(str(e))
+    return prepared
+
+
+@job_kind('report', _prepare_report)
+def run_report(job):
+    import reporting
+
+    params = json.loads(job.params)
+    result = reporting.time_series(
+        job.user_id, date.fromisoformat(params['start']), date.fromisoformat(params['end']),
+        granularity=params['granularity'], group_by=params['group_by'], timezone_str=params['timezone'],
+    )
+    return _json_result(result, 'report.json')
+
+
+def _prepare_team_report(user_id, params):
+    import teams
+
+    scope, scope_id = params.get('scope'), params.get('id')
+    if scope not in teams.SCOPES or not isinstance(scope_id, int):
+        raise JobError(f"scope must be one of {', '.join(teams.SCOPES)} and id an integer")
+    if not teams.can_view(user_id, scope, scope_id):
+        raise JobError(f'{scope} not found')
+    since, until = teams.default_range()
+    since = date.fromisoformat(_day(params, 'since', since.isoformat()))
+    until = date.fromisoformat(_day(params, 'until', until.isoformat()))
+    if not 0 < (until - since).days <= 366:
+        raise JobError('until must be after since and at most a year later')
+    try:
+        page, per_page = max(int(params.get('page', 1)), 1), teams.page_size(int(params.get('per_page', 0)))
+    except (TypeError, ValueError):
+        raise JobError('page and per_page must be integers')
+    group_by, source = params.get('group_by', 'team'), params.get('source', 'rollups')
+    try:
+        # Builds the query without running it, to check the grouping and source
+        teams.report_statement(scope, scope_id, since, until, group_by, source)
+    except teams.ReportError as e:
+        raise JobError(str(e))
+    return {
+        'scope': scope, 'id': scope_id, 'since': since.isoformat(), 'until': until.isoformat(),
+        'group_by': group_by, 'source': source, 'page': page, 'per_page': per_page,
+    }
+
+
+@job_kind('team_report', _prepare_team_report)
+def run_team_report(job):
+    import teams
+
+    params = json.loads(job.params)
+    result = teams.report(
+        params['scope'], params['id'], date.fromisoformat(params['since']), date.fromisoformat(params['until']),
+        group_by=params['group_by'], source=params['source'], page=params['page'], per_page=params['per_page'],
+    )
+    return _json_result(result, 'team-report.json')
+
+
+def params_hash(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def submit(user_id, kind, params=None, payload=None):
+    """Queue a job, or return a recent one with the same parameters; returns (job, reused)"""
+    if kind not in KINDS:
+        raise JobError(f"kind must be one of {', '.join(sorted(KINDS))}")
+    job_type = KINDS[kind]
+    params = job_type.prepare(user_id, params or {})
+    digest = params_hash(params)
+
+    if job_type.reusable:
+        now = datetime.utcnow()
+        existing = db.session.execute(select(Job).where(
+            Job.user_id == user_id,
+            Job.kind == kind,
+            Job.params_hash == digest,
+            or_(
+                Job.status.in_(ACTIVE_STATUSES),
+                Job.finished_at >= now - timedelta(seconds=app.config.get('JOB_REUSE_TTL', 600)),
+            ),
+            Job.status != 'failed',
+        ).order_by(Job.created_at.desc()).limit(1)).scalar()
+        if existing is not None:
+            return existing, True
+
+    job = Job(user_id=user_id, kind=kind, params=json.dumps(params), params_hash=digest, payload=payload,
+              status='queued')
+    db.session.add(job)
+    db.session.commit()
+    return job, False
+
+
+def serialize_job(job):
+    data = {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'params': json.loads(job.params),
+        'attempts': job.attempts,
+        'created_at': job.created_at.isoformat() + 'Z',
+        'started_at': job.started_at.isoformat() + 'Z' if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() + 'Z' if job.finished_at else None,
+        'error': job.error,
+    }
+    if job.status == 'succeeded':
+        data['result_url'] = f'/api/v1/jobs/{job.id}/result'
+        if job.result_size is not None:
+            data['result_size'] = job.result_size
+    return data
+
+
+def claim(limit, worker):
+    """Lease up to `limit` runnable jobs to a worker, returning their (id, attempt)"""
+    now = datetime.utcnow()
+    candidates = db.session.execute(select(Job.id, Job.attempts).where(or_(
+        Job.status == 'queued',
+        # A worker that stopped renewing its lease has died
+        (Job.status == 'running') & (Job.locked_until < now),
+    )).order_by(Job.created_at).limit(limit * 2)).all()
+
+    claimed = []
+    for job_id, attempts in candidates:
+        if len(claimed) >= limit:
+            break
+        if attempts >= app.config.get('JOB_MAX_ATTEMPTS', 3):
+            db.session.execute(update(Job).where(Job.id == job_id, Job.attempts == attempts).values(
+                status='failed', error='worker stopped while running the job', finished_at=now, locked_until=None,
+            ))
+            continue
+        # Only one worker's UPDATE still matches the attempt count it read
+        won = db.session.execute(update(Job).where(Job.id == job_id, Job.attempts == attempts).values(
+            status='running', attempts=attempts + 1, worker=worker, started_at=now,
+            locked_until=now + timedelta(seconds=app.config.get('JOB_LEASE_SECONDS', 300)),
+        )).rowcount
+        if won:
+            claimed.append((job_id, attempts + 1))
+    db.session.commit()
+    return claimed
+
+
+def renew(job_ids, worker):
+    """Extend the leases of the jobs a worker is still running"""
+    if job_ids:
+        db.session.execute(update(Job).where(
+            Job.id.in_(job_ids), Job.worker == worker, Job.status == 'running'
+        ).values(locked_until=datetime.utcnow() + timedelta(seconds=app.config.get('JOB_LEASE_SECONDS', 300))))
+        db.session.commit()
+
+
+def _finish(job_id, attempt, **values):
+    """Record a run's outcome, returning False if the job was retried or deleted meanwhile"""
+    # Conditional on the attempt, so a run whose lease lapsed can't overwrite its retry
+    finished = db.session.execute(update(Job).where(
+        Job.id == job_id, Job.attempts == attempt, Job.status == 'running'
+    ).values(finished_at=datetime.utcnow(), locked_until=None, **values)).rowcount
+    db.session.commit()
+    return bool(finished)
+
+
+def _remove_result(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _store_result(job_id, attempt, body):
+    """The result columns for a body: bytes on the row, chunks written to a file"""
+    if isinstance(body, bytes):
+        return {'result': body}
+    directory = app.config['JOB_RESULT_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'job-{job_id}-{attempt}')
+    size = 0
+    try:
+        with open(path + '.part', 'wb') as f:
+            for chunk in body:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(path + '.part', path)
+    except BaseException:
+        _remove_result(path + '.part')
+        raise
+    return {'result_path': path, 'result_size': size}
+
+
+def run_job(job_id, attempt):
+    """Run one claimed job and store its result or error; returns the final status"""
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        if job is None or job.attempts != attempt:
+            # Deleted, or retried elsewhere after this claim's lease lapsed
+            return 'skipped'
+        started = time.perf_counter()
+        try:
+            body, content_type, name = KINDS[job.kind].run(job)
+            stored = _store_result(job_id, attempt, body)
+        except Exception as e:
+            db.session.rollback()
+            logger.exception("Job %s (%s) failed", job_id, job.kind)
+            _finish(job_id, attempt, status='failed', error=str(e) or type(e).__name__)
+            return 'failed'
+        finally:
+            logger.info("Job %s (%s) ran for %.1fs", job_id, job.kind, time.perf_counter() - started)
+        if not _finish(job_id, attempt, status='succeeded', result_type=content_type, result_name=name,
+                       payload=None, **stored):
+            if stored.get('result_path'):
+                _remove_result(stored['result_path'])
+            return 'skipped'
+        return 'succeeded'
+
+
+def purge(now=None):
+    """Delete jobs that finished more than JOB_RETENTION_HOURS ago, returning how many"""
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(hours=app.config.get('JOB_RETENTION_HOURS', 24))
+    expired = (Job.status.in_(FINISHED_STATUSES), Job.finished_at < cutoff)
+    paths = db.session.execute(select(Job.result_path).where(*expired, Job.result_path.is_not(None))).scalars().all()
+    deleted = db.session.execute(delete(Job).where(*expired)).rowcount
+    db.session.commit()
+    for path in paths:
+        _remove_result(path)
+    return deleted
+
+
+def _init_process():
+    # Web workers on the same host get the CPU first
+    niceness = app.config.get('JOB_NICE', 10)
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+    logger.debug("Job process %s ready", os.getpid())
+
+
+def _release(job_id, attempt):
+    """Put a job whose process died back on the queue, for claim() to retry or fail"""
+    db.session.execute(update(Job).where(
+        Job.id == job_id, Job.attempts == attempt, Job.status == 'running'
+    ).values(status='queued', worker=None, locked_until=None))
+    db.session.commit()
+
+
+def work(processes=2, poll_interval=1.0, once=False, worker=None):
+    """Claim and run jobs in a pool of `processes` until interrupted (or the queue is empty, with once)"""
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    # Spawned rather than forked, so each process opens its own connections and log queue
+    context = multiprocessing.get_context('spawn')
+    counts = {'succeeded': 0, 'failed': 0, 'skipped': 0}
+    running = {}
+    last_purge = 0
+    pool = None
+    try:
+        while True:
+            if pool is None:
+                pool = ProcessPoolExecutor(processes, mp_context=context, initializer=_init_process)
+            for future in [future for future in running if future.done()]:
+                job_id, attempt = running.pop(future)
+                try:
+                    counts[future.result()] += 1
+                except BrokenProcessPool as e:
+                    # A process died (killed, out of memory) and took the pool with it
+                    logger.error("Job %s lost its process: %s", job_id, e)
+                    _release(job_id, attempt)
+                    if pool is not None:
+                        pool.shutdown(wait=False)
+                        pool = None
+
+            if pool is not None and len(running) < processes:
+                claimed = claim(processes - len(running), worker)
+            else:
+                claimed = []
+            for job_id, attempt in claimed:
+                running[pool.submit(run_job, job_id, attempt)] = (job_id, attempt)
+            renew([job_id for job_id, _ in running.values()], worker)
+
+            if time.monotonic() - last_purge > 3600:
+                purged = purge()
+                if purged:
+                    logger.info("Purged %d finished jobs", purged)
+                last_purge = time.monotonic()
+
+            if once and pool is not None and not running and not claimed:
+                return counts
+            if not claimed:
+                if running:
+                    wait(list(running), timeout=poll_interval, return_when=FIRST_COMPLETED)
+                elif pool is not None:
+                    time.sleep(poll_interval)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,144 @@
+"""Logging setup for the app and its command-line tools.
+
+    LOG_LEVEL=INFO                      root level (DEBUG while developing)
+    LOG_LEVELS=sqlalchemy.engine=INFO   per-logger overrides, comma separated
+    LOG_DEBUG_SAMPLE=10                 keep 1 in 10 repeats of each debug message
+    LOG_QUEUE=0                         write from the calling thread
+
+Request threads only put records on a queue. A listener thread does the
+formatting and the writes, so slow stderr or log shipping never stalls a
+request. Records below the configured level are dropped by the level check,
+before any message is built, so call sites use %-style arguments rather than
+f-strings.
+
+SQLAlchemy logs every statement at INFO, so its loggers default to WARNING.
+Set them in LOG_LEVELS to see queries.
+
+An unknown LOG_LEVEL falls back to INFO and a malformed LOG_LEVELS is
+ignored, each with a warning, so a typo can't stop the app from starting.
+"""
+import atexit
+import itertools
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+DEFAULT_LEVELS = {'sqlalchemy': logging.WARNING}
+
+# Argument types that can't change between the log call and the listener formatting it
+IMMUTABLE_ARGS = (str, int, float, bool, type(None))
+
+_listener = None
+
+
+def parse_level(value):
+    """A level name or number as an int, or None if it isn't one"""
+    text = str(value).strip().upper()
+    if text.isdigit():
+        return int(text)
+    level = logging.getLevelName(text)
+    return level if isinstance(level, int) else None
+
+
+def parse_levels(value):
+    """Parse "name=LEVEL,name=LEVEL" into {name: level}"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, _, level = item.partition('=')
+        if not level:
+            raise ValueError(f"Expected logger=LEVEL in LOG_LEVELS, got {item!r}")
+        levels[name.strip()] = parse_level(level)
+        if levels[name.strip()] is None:
+            raise ValueError(f"Unknown level in LOG_LEVELS: {item!r}")
+    return levels
+
+
+class DebugSampler(logging.Filter):
+    """Pass one in every `every` DEBUG records per message template"""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.name, record.msg)
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, itertools.count())
+        return next(counter) % self.every == 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread
+
+    The stock handler formats every record before queueing it. This one only
+    does so when an argument could change before the listener gets to it,
+    such as an ORM object.
+    """
+
+    def prepare(self, record):
+        if record.args and not all(isinstance(arg, IMMUTABLE_ARGS) for arg in _args(record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def _args(args):
+    return args.values() if isinstance(args, dict) else args
+
+
+def configure_logging(level='INFO', overrides='', debug_sample=1, use_queue=True):
+    """Install the root handler; safe to call more than once"""
+    global _listener
+    root = logging.getLogger()
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    if use_queue:
+        records = queue.SimpleQueue()
+        handler = DeferredQueueHandler(records)
+        _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+        _listener.start()
+    else:
+        handler = output
+    if debug_sample > 1:
+        handler.addFilter(DebugSampler(debug_sample))
+    root.addHandler(handler)
+
+    problems = []
+    root_level = parse_level(level)
+    if root_level is None:
+        problems.append(f"Unknown LOG_LEVEL {level!r}, using INFO")
+        root_level = logging.INFO
+    root.setLevel(root_level)
+
+    try:
+        levels = parse_levels(overrides)
+    except ValueError as e:
+        problems.append(f"{e}; ignoring LOG_LEVELS")
+        levels = {}
+    for name, logger_level in {**DEFAULT_LEVELS, **levels}.items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    for problem in problems:
+        logging.getLogger(__name__).warning('%s', problem)
+
+
+@atexit.register
+def _flush():
+    # Drain queued records before the interpreter exits
+    if _listener is not None:
+        _listener.stop()
@@ -0,0 +1,228 @@
+"""Versioned schema migrations.
+
+Each migration is a function registered with @migration(version, description)
+and is applied once, in version order, inside its own transaction. Applied
+versions are recorded in the schema_migrations table. Run pending migrations
+with `flask db upgrade`; `flask db status` lists what has been applied.
+Every worker upgrades on startup unless AUTO_MIGRATE=0, so upgrade() holds
+a cross-process lock and only the first one applies anything.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import logging
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table, delete, func, inspect, select, text, update
+)
+from sqlalchemy.schema import CreateIndex
+from app import db
+from models import (
+    User, Project, Task, TimeEntry, DailyProjectRollup, Organization, OrganizationMember, Team, TeamMember, Job
+)
+import rollups
+
+logger = logging.getLogger(__name__)
+
+_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+MIGRATIONS = []
+
+# Names of the cross-process lock held by upgrade()
+LOCK_NAME = 'timetracker_schema_migrations'
+LOCK_KEY = 7364917205
+
+
+def migration(version, description):
+    """Register a migration function taking an open connection"""
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return fn
+    return register
+
+
+def _create_index(connection, table, name):
+    index = next(index for index in table.indexes if index.name == name)
+    index.create(connection, checkfirst=True)
+
+
+@migration(1, 'baseline schema')
+def baseline(connection):
+    # Tables as they existed before versioned migrations; idempotent so that
+    # databases created by db.create_all() adopt the migration history
+    for model in (User, Project, Task, TimeEntry, DailyProjectRollup):
+        model.__table__.create(connection, checkfirst=True)
+    # The rollups start out empty on databases that already have entries
+    rows = rollups.backfill(connection)
+    if rows:
+        logger.info("Backfilled %d daily rollup rows", rows)
+
+
+@migration(2, 'time entry hot-path indexes')
+def time_entry_indexes(connection):
+    table = TimeEntry.__table__
+    for name in ('ix_time_entry_user_status', 'ix_time_entry_user_start_time', 'ix_time_entry_user_created_at'):
+        _create_index(connection, table, name)
+
+    if connection.dialect.name not in ('postgresql', 'sqlite'):
+        return
+
+    # Stop all but the newest running timer per user before enforcing uniqueness
+    duplicated = connection.execute(
+        select(TimeEntry.user_id).where(TimeEntry.status == 'running')
+        .group_by(TimeEntry.user_id).having(func.count() > 1)
+    ).scalars().all()
+    now = datetime.utcnow()
+    for user_id in duplicated:
+        running = connection.execute(
+            select(TimeEntry.id, TimeEntry.start_time).where(
+                TimeEntry.user_id == user_id, TimeEntry.status == 'running'
+            ).order_by(TimeEntry.start_time.desc(), TimeEntry.id.desc())
+        ).all()
+        for entry_id, start_time in running[1:]:
+            connection.execute(update(TimeEntry).where(TimeEntry.id == entry_id).values(
+                status='completed', end_time=now, duration=int((now - start_time).total_seconds())
+            ))
+        logger.warning("Stopped %d duplicate running timers for user %s", len(running) - 1, user_id)
+    if duplicated:
+        # The stopped timers' time now belongs in the rollups migration 1 filled
+        rollups.rebuild_users(connection, duplicated)
+
+    _create_index(connection, table, 'uq_time_entry_one_running_per_user')
+
+
+@migration(3, 'organizations and teams')
+def organizations(connection):
+    for model in (Organization, OrganizationMember, Team, TeamMember):
+        model.__table__.create(connection, checkfirst=True)
+
+
+@migration(4, 'background jobs')
+def jobs(connection):
+    Job.__table__.create(connection, checkfirst=True)
+
+
+def _add_columns(connection, table, names):
+    """Add the model's nullable columns that an existing table lacks"""
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    preparer = connection.dialect.identifier_preparer
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        connection.exec_driver_sql(
+            f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN "
+            f"{preparer.format_column(column)} {column.type.compile(connection.dialect)}"
+        )
+
+
+@migration(5, 'timer sweeper settings and user activity')
+def timer_sweeper(connection):
+    _add_columns(connection, User.__table__, ('timer_max_hours', 'timer_idle_minutes', 'last_active_at'))
+
+
+@migration(6, 'daily rollup key that covers rows without a task')
+def rollup_key(connection):
+    # The old constraint let rows without a task repeat; fold each repeat into its first row
+    key = rollups.ROLLUP_KEY
+    repeated = connection.execute(
+        select(*key, func.min(DailyProjectRollup.id), func.sum(DailyProjectRollup.seconds))
+        .group_by(*key).having(func.count() > 1)
+    ).all()
+    for *values, keep_id, seconds in repeated:
+        connection.execute(update(DailyProjectRollup).where(DailyProjectRollup.id == keep_id).values(seconds=seconds))
+        connection.execute(delete(DailyProjectRollup).where(
+            *(column == value for column, value in zip(key, values)), DailyProjectRollup.id != keep_id,
+        ))
+    if repeated:
+        logger.info("Merged %d repeated daily rollup keys", len(repeated))
+
+    index = next(index for index in DailyProjectRollup.__table__.indexes if index.name == 'uq_daily_project_rollup_key')
+    if connection.dialect.name in ('postgresql', 'sqlite'):
+        # Reflection skips expression indexes, so checkfirst can't see this one
+        connection.execute(CreateIndex(index, if_not_exists=True))
+    else:
+        index.create(connection, checkfirst=True)
+    if connection.dialect.name == 'postgresql':
+        # SQLite can't drop a table constraint; there the old one stays alongside
+        connection.execute(text('ALTER TABLE daily_project_rollup DROP CONSTRAINT IF EXISTS uq_daily_project_rollup'))
+
+
+@migration(7, 'job results stored as files')
+def job_result_files(connection):
+    _add_columns(connection, Job.__table__, ('result_path', 'result_size'))
+
+
+def applied_versions(connection):
+    _metadata.create_all(connection, checkfirst=True)
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+@contextmanager
+def upgrade_lock():
+    """Hold a lock across processes while migrating, so workers starting together don't race
+
+    PostgreSQL and MySQL use a session-level named lock. A SQLite database
+    is locked through a file beside it; other databases aren't locked.
+    """
+    url = db.engine.url
+    dialect = url.get_backend_name()
+    if dialect == 'postgresql':
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': LOCK_KEY})
+            try:
+                yield
+            finally:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': LOCK_KEY})
+                connection.commit()
+    elif dialect in ('mysql', 'mariadb'):
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT GET_LOCK(:name, -1)'), {'name': LOCK_NAME})
+            try:
+                yield
+            finally:
+                connection.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': LOCK_NAME})
+                connection.commit()
+    elif dialect == 'sqlite' and url.database and url.database != ':memory:':
+        with open(url.database + '.migrate.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        yield
+
+
+def upgrade(target=None):
+    """Apply pending migrations up to `target` (default: latest), returning the versions applied"""
+    with upgrade_lock():
+        # Read under the lock, so migrations another process just applied are skipped
+        with db.engine.begin() as connection:
+            done = applied_versions(connection)
+
+        applied = []
+        for version, description, fn in MIGRATIONS:
+            if version in done or (target is not None and version > target):
+                continue
+            with db.engine.begin() as connection:
+                logger.info("Applying migration %d: %s", version, description)
+                fn(connection)
+                connection.execute(schema_migrations.insert().values(
+                    version=version, description=description, applied_at=datetime.utcnow()
+                ))
+            applied.append(version)
+    return applied
+
+
+def status():
+    """Return (version, description, applied) for every known migration"""
+    with db.engine.begin() as connection:
+        done = applied_versions(connection)
+    return [(version, description, version in done) for version, description, _ in MIGRATIONS]
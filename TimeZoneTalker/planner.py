@@ -0,0 +1,94 @@
+"""Meeting planner: find the times every participant is within working hours.
+
+Each participant's working hours are expanded, one local day at a time, into
+UTC intervals. The days are converted in one batch through the zone's
+transition table, so DST transitions shift the intervals exactly as they
+shift the wall clock. The intervals of all participants are then intersected
+with a single sweep over their sorted endpoints, O(n log n) in the number of
+intervals.
+"""
+from datetime import datetime, time, timedelta
+import timezones
+
+WORKDAYS = (0, 1, 2, 3, 4)
+MAX_PARTICIPANTS = 100
+MAX_WEEKS = 26
+
+
+class Participant:
+    """Someone's timezone and local working hours"""
+
+    def __init__(self, timezone, start=time(9), end=time(17), weekdays=WORKDAYS):
+        timezones.get_zone(timezone)
+        if start == end:
+            raise ValueError('working hours must not be empty')
+        self.timezone = timezone
+        self.start = start
+        self.end = end
+        self.weekdays = frozenset(weekdays)
+
+    def key(self):
+        return self.timezone, self.start, self.end, self.weekdays
+
+    def utc_intervals(self, window_start, window_end):
+        """Working hours as naive UTC (start, end) pairs, clipped to the window"""
+        first = timezones.local_date(window_start, self.timezone) - timedelta(days=1)
+        last = timezones.local_date(window_end, self.timezone)
+        # Hours ending at or before they start run past midnight
+        overnight = timedelta(days=1) if self.end <= self.start else timedelta(0)
+        local_times = []
+        day = first
+        while day <= last:
+            if day.weekday() in self.weekdays:
+                local_times.append(datetime.combine(day, self.start))
+                local_times.append(datetime.combine(day + overnight, self.end))
+            day += timedelta(days=1)
+
+        utc_times = [utc for utc, _ in timezones.convert_batch(local_times, self.timezone, 'UTC')]
+        intervals = []
+        for i in range(0, len(utc_times), 2):
+            start, end = max(utc_times[i], window_start), min(utc_times[i + 1], window_end)
+            if start < end:
+                intervals.append((start, end))
+        return intervals
+
+def common_windows(interval_lists, min_duration=timedelta(0)):
+    """Intersect several lists of intervals with one sweep over their endpoints
+
+    Each list must be free of overlaps. Returns the (start, end) pairs covered
+    by every list and lasting at least min_duration.
+    """
+    needed = len(interval_lists)
+    if not needed:
+        return []
+    # At equal times ends (-1) sort before starts (+1), so touching intervals don't count as overlap
+    events = sorted(
+        (point, delta)
+        for intervals in interval_lists
+        for start, end in intervals
+        for point, delta in ((start, 1), (end, -1))
+    )
+    windows = []
+    active = 0
+    opened = None
+    for point, delta in events:
+        active += delta
+        if active == needed:
+            opened = point
+        elif opened is not None:
+            if point - opened >= min_duration and point > opened:
+                windows.append((opened, point))
+            opened = None
+    return windows
+
+
+def find_meeting_windows(participants, start, end, min_duration=timedelta(minutes=30)):
+    """UTC windows between start and end when every participant is working"""
+    # Participants sharing a zone and hours constrain the result only once
+    distinct = {p.key(): p for p in participants}.values()
+    return common_windows([p.utc_intervals(start, end) for p in distinct], min_duration)
+
+
+def parse_hours(value):
+    """Parse HH:MM into a time"""
+    return datetime.strptime(value.strip(), '%H:%M').time()
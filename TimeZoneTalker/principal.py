@@ -0,0 +1,73 @@
+"""Cached session principal for Flask-Login.
+
+Most views only read current_user.id and .timezone. Flask-Login's user
+loader gets a Principal instead: id, username, timezone and the idle timer
+setting (which decides whether requests record activity, see sweeper.py)
+from a small cache, so an authenticated request costs no query. Reading any other
+attribute, or assigning any attribute, loads the full User row on first
+use. Writes to a User evict its cache entry once they commit; see cache.py
+and PRINCIPAL_CACHE_URL.
+"""
+from flask_login import UserMixin
+from sqlalchemy import select
+from app import db
+from models import User
+import cache
+
+PRINCIPAL_FIELDS = ('id', 'username', 'timezone', 'timer_idle_minutes')
+
+
+class Principal(UserMixin):
+    """The logged-in user's cached identity, standing in for the User row"""
+
+    def __init__(self, id, username, timezone, timer_idle_minutes=None):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'username', username)
+        object.__setattr__(self, 'timezone', timezone)
+        object.__setattr__(self, 'timer_idle_minutes', timer_idle_minutes)
+        object.__setattr__(self, '_user', None)
+
+    @property
+    def user(self):
+        """The full User row, loaded on first use"""
+        if self._user is None:
+            object.__setattr__(self, '_user', db.session.get(User, self.id))
+        return self._user
+
+    def __getattr__(self, name):
+        # Only reached for attributes the principal doesn't carry itself
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def __setattr__(self, name, value):
+        # Writes go to the row, so they are saved and evict the cache on commit
+        setattr(self.user, name, value)
+        if name in PRINCIPAL_FIELDS:
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return f'<Principal {self.username}>'
+
+
+def principal_statement(user_id):
+    """The narrow query for a user's PRINCIPAL_FIELDS"""
+    return select(*(getattr(User, field) for field in PRINCIPAL_FIELDS)).where(User.id == user_id)
+
+
+def principal_data(user_id):
+    """The PRINCIPAL_FIELDS of a user, from the cache or one narrow query"""
+    key = cache.principal_key(user_id)
+    data = cache.principal_cache.get(key)
+    if data is None:
+        row = db.session.execute(principal_statement(user_id)).first()
+        if row is None:
+            return None
+        data = row._asdict()
+        cache.principal_cache.set(key, data)
+    return data
+
+
+def load_principal(user_id):
+    data = principal_data(user_id)
+    return Principal(**data) if data else None
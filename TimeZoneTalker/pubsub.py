@@ -0,0 +1,205 @@
+"""Timer state events for live clients.
+
+Every committed change to a time entry is published on its user's channel,
+and /api/v1/timer/events relays the channel to the browser as Server-Sent
+Events, so open tabs and other devices update the timer widget without
+polling or reloading.
+
+The broker is chosen by TIMER_EVENTS_URL:
+
+    none://            events disabled (default)
+    memory://          in-process fan-out (one worker process only)
+    redis://host/0     Redis pub/sub, shared by every worker process
+
+Each open stream holds a worker thread, so run gunicorn with threaded or
+gevent workers when this is in use. Pages only subscribe when events are
+enabled (the timer_events_enabled template global).
+"""
+import calendar
+import json
+import logging
+import queue
+import threading
+from sqlalchemy import event
+from app import app, db
+from models import TimeEntry
+
+logger = logging.getLogger(__name__)
+
+
+class MemorySubscription:
+    def __init__(self, broker, channel, max_pending):
+        self.broker = broker
+        self.channel = channel
+        self.messages = queue.Queue(maxsize=max_pending)
+
+    def get(self, timeout):
+        """Next message, or None after `timeout` seconds without one"""
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker._unsubscribe(self)
+
+
+class MemoryBroker:
+    """Thread-safe in-process fan-out to every subscriber of a channel"""
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.messages.put_nowait(message)
+            except queue.Full:
+                # A stalled client misses events rather than holding up writers
+                pass
+
+    def subscribe(self, channel):
+        subscription = MemorySubscription(self, channel, self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+
+class RedisSubscription:
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        if message is None:
+            return None
+        return json.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker:
+    """Broker backed by Redis pub/sub, for several worker processes"""
+
+    def __init__(self, client, namespace='timetracker:'):
+        self.client = client
+        self.namespace = namespace
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis  # optional dependency, only needed for this backend
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def publish(self, channel, message):
+        self.client.publish(self.namespace + channel, json.dumps(message))
+
+    def subscribe(self, channel):
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(self.namespace + channel)
+        return RedisSubscription(pubsub)
+
+
+class NullSubscription:
+    def __init__(self):
+        self._closed = threading.Event()
+
+    def get(self, timeout):
+        self._closed.wait(timeout)
+        return None
+
+    def close(self):
+        self._closed.set()
+
+
+class NullBroker:
+    """Broker used when events are switched off"""
+
+    def publish(self, channel, message):
+        pass
+
+    def subscribe(self, channel):
+        return NullSubscription()
+
+
+def create_broker(url, max_pending=100):
+    """Build a broker from a TIMER_EVENTS_URL value"""
+    scheme = url.split('://', 1)[0] if url else 'none'
+    if scheme == 'memory':
+        return MemoryBroker(max_pending=max_pending)
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisBroker.from_url(url)
+    if scheme == 'none':
+        return NullBroker()
+    raise ValueError(f"Unsupported TIMER_EVENTS_URL scheme: {scheme}")
+
+
+timer_events = create_broker(app.config.get('TIMER_EVENTS_URL'))
+
+
+def events_enabled():
+    """Whether timer events are published, so clients should subscribe"""
+    return not isinstance(timer_events, NullBroker)
+
+
+app.jinja_env.globals['timer_events_enabled'] = events_enabled
+
+
+def timer_channel(user_id):
+    return f"timer:{user_id}"
+
+
+def _entry_event(entry, deleted=False):
+    # Built from column attributes only, so no SQL is needed inside the flush hook
+    return {
+        'id': entry.id,
+        'status': 'deleted' if deleted else entry.status,
+        'project_id': entry.project_id,
+        'task_id': entry.task_id,
+        'description': entry.description,
+        'started_at': calendar.timegm(entry.start_time.utctimetuple()) if entry.start_time else None,
+        'duration': entry.duration or 0,
+    }
+
+
+def record_entry(session, entry):
+    """Publish an entry's state when the session commits, for UPDATE statements the flush doesn't see"""
+    session.info.setdefault('timer_events', {})[entry.id] = (entry.user_id, _entry_event(entry))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_timer_events(session, flush_context):
+    pending = session.info.setdefault('timer_events', {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, TimeEntry) and obj.user_id is not None and obj.id is not None:
+            pending[obj.id] = (obj.user_id, _entry_event(obj))
+    for obj in session.deleted:
+        if isinstance(obj, TimeEntry) and obj.user_id is not None:
+            pending[obj.id] = (obj.user_id, _entry_event(obj, deleted=True))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_timer_events(session):
+    pending = session.info.pop('timer_events', {})
+    for user_id, payload in pending.values():
+        try:
+            timer_events.publish(timer_channel(user_id), payload)
+        except Exception as e:
+            logger.error("Error publishing timer event: %s", e)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_timer_events(session):
+    session.info.pop('timer_events', None)
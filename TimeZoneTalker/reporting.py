@@ -0,0 +1,259 @@
+"""Time series reports over any range of local dates.
+
+A report covers [start, end) in the user's timezone. It is cut into hour,
+day, week (starting Monday) or month buckets at local wall-clock boundaries,
+so days are 23 or 25 hours long across DST changes. Time can be grouped by
+project, task and #tags in the description. An entry with several tags
+counts once under each of them.
+
+Each entry counts as the interval it covers:
+- settled entries: start_time plus their duration;
+- running entries: start_time up to now.
+An entry that crosses a bucket boundary, such as one running past midnight,
+is split between the buckets at that boundary.
+
+Entries are read as a single stream ordered by the (user_id, start_time)
+index and folded in one pass. Because the starts arrive in order, the
+bucket an entry starts in only moves forward.
+
+The index can only bound start times, so an entry that began more than
+REPORT_LOOKBACK_HOURS before the range is not counted. The running timer
+always is.
+"""
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+import re
+from sqlalchemy import select
+from app import app, db
+from models import Project, Task, TimeEntry
+import timezones
+
+GRANULARITIES = ('hour', 'day', 'week', 'month')
+DIMENSIONS = ('project', 'task', 'tag')
+MAX_BUCKETS = 2000
+
+TAG_PATTERN = re.compile(r'(?<![\w#])#(\w[\w-]*)')
+
+Bucket = namedtuple('Bucket', 'local_start utc_start')
+
+
+class ReportError(ValueError):
+    pass
+
+
+def tags(description):
+    """Lower-cased #tags in a description, in order of appearance, without repeats"""
+    found = []
+    for tag in TAG_PATTERN.findall(description or ''):
+        tag = tag.lower()
+        if tag not in found:
+            found.append(tag)
+    return found
+
+
+def _next_start(local, granularity):
+    if granularity == 'hour':
+        return local + timedelta(hours=1)
+    if granularity == 'day':
+        return local + timedelta(days=1)
+    if granularity == 'week':
+        return local + timedelta(days=7 - local.weekday())
+    return local.replace(year=local.year + local.month // 12, month=local.month % 12 + 1, day=1)
+
+
+def buckets(start, end, granularity, timezone_str='UTC'):
+    """Buckets from local date `start` up to `end`, plus a closing one at `end`
+
+    The first bucket starts at `start` even when that is mid-week or
+    mid-month, so each bucket is clipped to the range.
+    """
+    if granularity not in GRANULARITIES:
+        raise ReportError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    if end <= start:
+        raise ReportError('end must be after start')
+
+    local = datetime.combine(start, datetime.min.time())
+    stop = datetime.combine(end, datetime.min.time())
+    local_starts = []
+    while local < stop:
+        local_starts.append(local)
+        if len(local_starts) > MAX_BUCKETS:
+            raise ReportError(f'at most {MAX_BUCKETS} buckets per report')
+        local = _next_start(local, granularity)
+    local_starts.append(stop)
+
+    utc_starts = [utc for utc, _ in timezones.convert_batch(local_starts, timezone_str, 'UTC')]
+    return [Bucket(local_start, utc_start) for local_start, utc_start in zip(local_starts, utc_starts)]
+
+
+def entries_statement(user_id, since, until):
+    """Entries starting in [since, until), in index order, with their project and task names"""
+    return select(
+        TimeEntry.start_time,
+        TimeEntry.end_time,
+        TimeEntry.duration,
+        TimeEntry.status,
+        TimeEntry.description,
+        TimeEntry.project_id,
+        Project.name.label('project_name'),
+        Project.color.label('project_color'),
+        TimeEntry.task_id,
+        Task.name.label('task_name'),
+    ).join(Project, Project.id == TimeEntry.project_id).outerjoin(Task, Task.id == TimeEntry.task_id).where(
+        TimeEntry.user_id == user_id,
+        TimeEntry.start_time >= since,
+        TimeEntry.start_time < until,
+    ).order_by(TimeEntry.start_time)
+
+
+def interval(row, now):
+    """The naive UTC (start, end) an entry covers, or None if it covers no time"""
+    if row.status == 'running':
+        end = now
+    elif row.duration is not None:
+        end = row.start_time + timedelta(seconds=row.duration)
+    elif row.end_time is not None:
+        end = row.end_time
+    else:
+        return None
+    return (row.start_time, end) if end > row.start_time else None
+
+
+class TimeSeries:
+    """Accumulates entry intervals into per-group, per-bucket seconds"""
+
+    def __init__(self, bucket_list, group_by=()):
+        for dimension in group_by:
+            if dimension not in DIMENSIONS:
+                raise ReportError(f"group_by must be made of {', '.join(DIMENSIONS)}")
+        self.buckets = bucket_list
+        self.bounds = [bucket.utc_start for bucket in bucket_list]
+        self.group_by = tuple(group_by)
+        self.series = {}
+        self.labels = {}
+        self.totals = [0.0] * (len(bucket_list) - 1)
+        self._cursor = 0
+
+    def _keys(self, row):
+        keys = [()]
+        for dimension in self.group_by:
+            if dimension == 'project':
+                values = [row.project_id]
+                self.labels[('project', row.project_id)] = {
+                    'id': row.project_id, 'name': row.project_name, 'color': row.project_color or '#6c757d'
+                }
+            elif dimension == 'task':
+                values = [row.task_id]
+                self.labels[('task', row.task_id)] = (
+                    {'id': row.task_id, 'name': row.task_name} if row.task_id is not None else None
+                )
+            else:
+                # Untagged time is grouped under a null tag
+                values = tags(row.description) or [None]
+            keys = [key + (value,) for key in keys for value in values]
+        return keys
+
+    def add(self, row, start, end):
+        """Add an interval; starts must arrive in ascending order"""
+        bounds = self.bounds
+        if end <= bounds[0] or start >= bounds[-1]:
+            return
+        start = max(start, bounds[0])
+        # Only ever moves forward, because starts arrive in order
+        while self._cursor < len(bounds) - 2 and bounds[self._cursor + 1] <= start:
+            self._cursor += 1
+
+        parts = []
+        index = self._cursor
+        while start < end and index < len(bounds) - 1:
+            part_end = min(end, bounds[index + 1])
+            if part_end > start:
+                parts.append((index, (part_end - start).total_seconds()))
+            start = part_end
+            index += 1
+
+        for index, part in parts:
+            self.totals[index] += part
+        for key in self._keys(row):
+            seconds = self.series.get(key)
+            if seconds is None:
+                seconds = self.series[key] = [0.0] * (len(bounds) - 1)
+            for index, part in parts:
+                seconds[index] += part
+
+    def add_unordered(self, row, start, end):
+        """Add an interval that may start before the ones already added"""
+        cursor = self._cursor
+        self._cursor = max(bisect_right(self.bounds, start) - 1, 0)
+        self.add(row, start, end)
+        self._cursor = cursor
+
+    def _key_json(self, key):
+        result = {}
+        for dimension, value in zip(self.group_by, key):
+            result[dimension] = value if dimension == 'tag' else self.labels[(dimension, value)]
+        return result
+
+    def result(self, granularity):
+        fmt = {'hour': '%Y-%m-%dT%H:%M', 'day': '%Y-%m-%d', 'week': '%Y-%m-%d', 'month': '%Y-%m'}[granularity]
+        series = [
+            {'key': self._key_json(key), 'seconds': [round(value) for value in seconds], 'total': round(sum(seconds))}
+            for key, seconds in self.series.items()
+        ]
+        series.sort(key=lambda item: -item['total'])
+        # Taken from the intervals rather than the series, where a multi-tag entry counts more than once
+        totals = [round(value) for value in self.totals]
+        return {
+            'buckets': [bucket.local_start.strftime(fmt) for bucket in self.buckets[:-1]],
+            'series': series,
+            'totals': totals,
+            'total': round(sum(self.totals)),
+        }
+
+
+def time_series(user_id, start, end, granularity='day', group_by=(), timezone_str='UTC', now=None):
+    """Seconds per bucket and group for a user's entries between local dates start and end"""
+    if now is None:
+        now = datetime.utcnow()
+    bucket_list = buckets(start, end, granularity, timezone_str)
+    accumulator = TimeSeries(bucket_list, group_by)
+    since = bucket_list[0].utc_start - timedelta(hours=app.config.get('REPORT_LOOKBACK_HOURS', 24))
+    until = bucket_list[-1].utc_start
+
+    # A running timer can have started any time before the lookback window
+    running = db.session.execute(
+        entries_statement(user_id, datetime.min, since).where(TimeEntry.status == 'running')
+    ).first()
+    if running is not None:
+        span = interval(running, now)
+        if span:
+            accumulator.add_unordered(running, *span)
+
+    rows = db.session.execute(entries_statement(user_id, since, until).execution_options(yield_per=1000))
+    for row in rows:
+        span = interval(row, now)
+        if span:
+            accumulator.add(row, *span)
+
+    result = accumulator.result(granularity)
+    result.update({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'granularity': granularity,
+        'group_by': list(accumulator.group_by),
+        'timezone': timezone_str,
+    })
+    return result
+
+
+def parse_group_by(value):
+    """Split "project,tag" into a tuple of dimensions"""
+    return tuple(part.strip() for part in (value or '').split(',') if part.strip())
+
+
+def default_range(timezone_str='UTC'):
+    """The user's current week, Monday to Sunday"""
+    today = timezones.local_date(datetime.utcnow(), timezone_str)
+    monday = today - timedelta(days=today.weekday())
+    return monday, monday + timedelta(days=7)
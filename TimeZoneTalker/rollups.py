@@ -0,0 +1,178 @@
+from collections import defaultdict
+from sqlalchemy import delete, func, insert, literal_column, select, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from models import User, Project, TimeEntry, DailyProjectRollup
+from app import db
+import timezones
+
+# Entries in these states have a settled duration that belongs in the rollup
+SETTLED_STATUSES = ('completed', 'paused')
+
+# The expressions of the uq_daily_project_rollup_key index, as upserts name them
+ROLLUP_KEY = (
+    DailyProjectRollup.user_id,
+    DailyProjectRollup.project_id,
+    func.coalesce(DailyProjectRollup.task_id, literal_column('0')),
+    DailyProjectRollup.day,
+)
+UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def get_user_timezone(user_id):
+    """Look up a user's timezone name, defaulting to UTC"""
+    timezone_str = db.session.execute(
+        select(User.timezone).where(User.id == user_id)
+    ).scalar()
+    return timezone_str or 'UTC'
+
+
+def local_day(start_time, timezone_str):
+    """Local calendar date of a naive UTC timestamp in the given timezone"""
+    return timezones.local_date(start_time, timezone_str)
+
+
+def contribution(entry, timezone_str=None):
+    """Return the rollup key and seconds an entry currently contributes, or None"""
+    if entry.status not in SETTLED_STATUSES or not entry.duration or entry.start_time is None:
+        return None
+    if timezone_str is None:
+        timezone_str = get_user_timezone(entry.user_id)
+    key = (entry.user_id, entry.project_id, entry.task_id, local_day(entry.start_time, timezone_str))
+    return key, entry.duration
+
+
+def adjust(key, seconds):
+    """Add seconds (possibly negative) to a rollup row inside the current transaction
+
+    One upsert on databases that have one, so concurrent writers can't both
+    insert the row.
+    """
+    if not seconds:
+        return
+    user_id, project_id, task_id, day = key
+    values = {'user_id': user_id, 'project_id': project_id, 'task_id': task_id, 'day': day, 'seconds': seconds}
+    dialect = db.session.get_bind().dialect.name
+    if dialect in UPSERT_INSERTS:
+        statement = UPSERT_INSERTS[dialect](DailyProjectRollup).values(values)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=ROLLUP_KEY, set_={'seconds': DailyProjectRollup.seconds + statement.excluded.seconds},
+        ))
+        return
+    if dialect in ('mysql', 'mariadb'):
+        statement = mysql.insert(DailyProjectRollup).values(values)
+        db.session.execute(statement.on_duplicate_key_update(
+            seconds=DailyProjectRollup.seconds + statement.inserted.seconds,
+        ))
+        return
+
+    task_match = DailyProjectRollup.task_id.is_(None) if task_id is None else DailyProjectRollup.task_id == task_id
+    result = db.session.execute(
+        update(DailyProjectRollup).where(
+            DailyProjectRollup.user_id == user_id,
+            DailyProjectRollup.project_id == project_id,
+            task_match,
+            DailyProjectRollup.day == day,
+        ).values(seconds=DailyProjectRollup.seconds + seconds).execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.session.add(DailyProjectRollup(**values))
+
+
+def record_change(before, entry, timezone_str=None):
+    """Move an entry's contribution from `before` (see contribution()) to its current state"""
+    after = contribution(entry, timezone_str) if entry is not None else None
+    if before == after:
+        return
+    if before:
+        adjust(before[0], -before[1])
+    if after:
+        adjust(after[0], after[1])
+
+
+def _rebuild_user(executor, uid, timezone_str, batch_size):
+    """Replace one user's rollup rows through a session or connection, returning how many were written"""
+    totals = defaultdict(int)
+    entries = executor.execute(
+        select(TimeEntry.project_id, TimeEntry.task_id, TimeEntry.start_time, TimeEntry.duration).where(
+            TimeEntry.user_id == uid,
+            TimeEntry.status.in_(SETTLED_STATUSES),
+            TimeEntry.duration > 0,
+        ).execution_options(yield_per=batch_size)
+    )
+    for project_id, task_id, start_time, duration in entries:
+        totals[(project_id, task_id, local_day(start_time, timezone_str))] += duration
+
+    executor.execute(delete(DailyProjectRollup).where(DailyProjectRollup.user_id == uid))
+    rows = [
+        {'user_id': uid, 'project_id': project_id, 'task_id': task_id, 'day': day, 'seconds': seconds}
+        for (project_id, task_id, day), seconds in totals.items()
+    ]
+    for i in range(0, len(rows), batch_size):
+        executor.execute(insert(DailyProjectRollup), rows[i:i + batch_size])
+    return len(rows)
+
+
+def rebuild(user_id=None, batch_size=5000):
+    """Recompute rollup rows from the raw time entries, for one user or everyone"""
+    users = select(User.id, User.timezone)
+    if user_id is not None:
+        users = users.where(User.id == user_id)
+
+    rebuilt = 0
+    for uid, timezone_str in db.session.execute(users).all():
+        rebuilt += _rebuild_user(db.session, uid, timezone_str, batch_size)
+        db.session.commit()
+    return rebuilt
+
+
+def rebuild_users(connection, user_ids=None, batch_size=5000):
+    """Recompute rollup rows for some users, or everyone, inside a migration's transaction"""
+    users = select(User.id, User.timezone)
+    if user_ids is not None:
+        users = users.where(User.id.in_(user_ids))
+    rebuilt = 0
+    for uid, timezone_str in connection.execute(users).all():
+        rebuilt += _rebuild_user(connection, uid, timezone_str or 'UTC', batch_size)
+    return rebuilt
+
+
+def backfill(connection, batch_size=5000):
+    """Fill an empty rollup table from the time entries inside a migration's transaction
+
+    Does nothing once the table has rows, so it is safe to run again.
+    Returns the number of rows written.
+    """
+    if connection.execute(select(DailyProjectRollup.id).limit(1)).first() is not None:
+        return 0
+    return rebuild_users(connection, batch_size=batch_size)
+
+
+def project_totals_statement(user_id, since_day=None, until_day=None):
+    """The rollup query behind project_totals(), for sync or async execution"""
+    query = select(
+        Project.id,
+        Project.name,
+        Project.color,
+        func.sum(DailyProjectRollup.seconds).label('seconds'),
+    ).join(DailyProjectRollup, DailyProjectRollup.project_id == Project.id).where(
+        DailyProjectRollup.user_id == user_id,
+    ).group_by(Project.id, Project.name, Project.color).order_by(Project.id)
+
+    if since_day is not None:
+        query = query.where(DailyProjectRollup.day >= since_day)
+    if until_day is not None:
+        query = query.where(DailyProjectRollup.day < until_day)
+    return query
+
+
+def fold_project_rows(rows):
+    return [
+        {'id': row.id, 'name': row.name, 'color': row.color or '#6c757d', 'seconds': int(row.seconds or 0)}
+        for row in rows
+        if row.seconds
+    ]
+
+
+def project_totals(user_id, since_day=None, until_day=None):
+    """Settled seconds per project read from the rollup table"""
+    return fold_project_rows(db.session.execute(project_totals_statement(user_id, since_day, until_day)))
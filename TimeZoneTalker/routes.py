@@ -1,19 +1,34 @@
 from datetime import datetime, timedelta
 import pytz
-from flask import render_template, redirect, url_for, flash, request, jsonify
+from flask import (
+    render_template, stream_template, stream_with_context, redirect, url_for, flash,
+    request, jsonify, Response, abort
+)
 from flask_login import login_user, logout_user, login_required, current_user
 from urllib.parse import urlparse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload
 from app import app, db
 from models import User, Project, Task, TimeEntry
 from forms import (
     LoginForm, RegisterForm, ProjectForm, TaskForm, 
-    TimeEntryForm, TimeEntryEditForm, TimezoneConverterForm
+    TimeEntryForm, TimeEntryEditForm, TimezoneConverterForm, MeetingPlannerForm
 )
 from utils import (
     get_current_time_in_timezone, convert_timezone, 
-    start_timer, pause_timer, resume_timer, stop_timer,
-    get_weekly_stats, get_project_stats, parse_duration_string
+    get_weekly_stats, get_project_stats, parse_duration_string,
+    get_time_entries_page
 )
+from stats import project_totals as stats_project_totals
+import rollups
+import exporter
+import timer
+import planner
+import timezones
+
+def entry_list_options():
+    """Templates listing entries show their project and task, load them in the same query"""
+    return joinedload(TimeEntry.project), joinedload(TimeEntry.task)
 
 @app.route('/')
 def index():
@@ -28,13 +43,13 @@ def index():
                     return render_template('index.html', error="Please log in again")
                 return redirect(url_for('dashboard'))
             except Exception as e:
-                app.logger.error(f"Error in index redirect: {str(e)}")
+                app.logger.error("Error in index redirect: %s", e)
                 logout_user()  # Force logout if user data is invalid
                 flash("Session expired. Please log in again.", "warning")
                 return render_template('index.html')
         return render_template('index.html')
     except Exception as e:
-        app.logger.error(f"Unexpected error in index: {str(e)}")
+        app.logger.error("Unexpected error in index: %s", e)
         return render_template('index.html')
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -46,7 +61,7 @@ def login():
         
         if form.validate_on_submit():
             try:
-                app.logger.debug(f"Attempting login for username: {form.username.data}")
+                app.logger.debug("Attempting login for username: %s", form.username.data)
                 user = User.query.filter_by(username=form.username.data).first()
                 
                 if user is None:
@@ -56,7 +71,7 @@ def login():
                     
                 app.logger.debug("User found, checking password")
                 password_check = user.check_password(form.password.data)
-                app.logger.debug(f"Password check result: {password_check}")
+                app.logger.debug("Password check result: %s", password_check)
                 
                 if not password_check:
                     flash('Invalid username or password', 'danger')
@@ -67,14 +82,14 @@ def login():
                 next_page = request.args.get('next')
                 if not next_page or urlparse(next_page).netloc != '':
                     next_page = url_for('index')  # Use index to avoid direct dashboard redirect
-                app.logger.debug(f"Redirecting to: {next_page}")
+                app.logger.debug("Redirecting to: %s", next_page)
                 return redirect(next_page)
             except Exception as e:
-                app.logger.error(f"Login error: {str(e)}")
+                app.logger.error("Login error: %s", e)
                 flash('An error occurred during login. Please try again.', 'danger')
                 return render_template('login.html', form=form)
     except Exception as e:
-        app.logger.error(f"Unexpected error in login view: {str(e)}")
+        app.logger.error("Unexpected error in login view: %s", e)
         flash('An unexpected error occurred. Please try again.', 'danger')
     
     return render_template('login.html', form=form)
@@ -118,37 +133,37 @@ def logout():
 @login_required
 def dashboard():
     try:
-        app.logger.debug("Entering dashboard view for user ID: " + str(current_user.id))
+        app.logger.debug("Entering dashboard view for user ID: %s", current_user.id)
         
         # Get current time in user's timezone
         user_tz = current_user.timezone
-        app.logger.debug(f"User timezone: {user_tz}")
+        app.logger.debug("User timezone: %s", user_tz)
         current_time = get_current_time_in_timezone(user_tz)
         
         # Get active time entry (if any)
-        active_entry = TimeEntry.query.filter_by(
+        active_entry = TimeEntry.query.options(*entry_list_options()).filter_by(
             user_id=current_user.id, 
             status='running'
         ).first()
-        app.logger.debug(f"Active entry: {active_entry}")
+        app.logger.debug("Active entry: %s", active_entry)
         
         # Get recent time entries
-        recent_entries = TimeEntry.query.filter_by(
+        recent_entries = TimeEntry.query.options(*entry_list_options()).filter_by(
             user_id=current_user.id
         ).order_by(TimeEntry.created_at.desc()).limit(5).all()
-        app.logger.debug(f"Recent entries count: {len(recent_entries)}")
+        app.logger.debug("Recent entries count: %s", len(recent_entries))
         
         # Get weekly stats and project stats (with error handling)
         try:
-            weekly_stats = get_weekly_stats(current_user.id)
+            weekly_stats = get_weekly_stats(current_user.id, current_user.timezone)
         except Exception as e:
-            app.logger.error(f"Error getting weekly stats: {str(e)}")
+            app.logger.error("Error getting weekly stats: %s", e)
             weekly_stats = {"days": [], "labels": [], "values": []}
             
         try:
             project_stats = get_project_stats(current_user.id)
         except Exception as e:
-            app.logger.error(f"Error getting project stats: {str(e)}")
+            app.logger.error("Error getting project stats: %s", e)
             project_stats = {"labels": [], "values": [], "colors": []}
         
         # Prepare timer form
@@ -156,7 +171,7 @@ def dashboard():
         
         # Get user projects
         user_projects = Project.query.filter_by(user_id=current_user.id).all()
-        app.logger.debug(f"User projects count: {len(user_projects)}")
+        app.logger.debug("User projects count: %s", len(user_projects))
         
         timer_form.project_id.choices = [
             (p.id, p.name) for p in user_projects
@@ -196,7 +211,7 @@ def dashboard():
             timer_form=timer_form
         )
     except Exception as e:
-        app.logger.error(f"Dashboard error: {str(e)}")
+        app.logger.error("Dashboard error: %s", e)
         flash('An error occurred while loading the dashboard. Please try again.', 'danger')
         # Prevent redirect loop by sending to a simple page
         return render_template('error.html', message="Error loading dashboard. Try again later.")
@@ -270,7 +285,7 @@ def tasks():
         return redirect(url_for('tasks'))
     
     # Get tasks with project information
-    tasks = Task.query.join(Project).filter(Project.user_id == current_user.id).all()
+    tasks = Task.query.join(Project).options(contains_eager(Task.project)).filter(Project.user_id == current_user.id).all()
     return render_template('tasks.html', form=form, tasks=tasks)
 
 @app.route('/task/<int:task_id>/edit', methods=['GET', 'POST'])
@@ -296,7 +311,7 @@ def edit_task(task_id):
         flash('Task updated successfully', 'success')
         return redirect(url_for('tasks'))
     
-    tasks = Task.query.join(Project).filter(Project.user_id == current_user.id).all()
+    tasks = Task.query.join(Project).options(contains_eager(Task.project)).filter(Project.user_id == current_user.id).all()
     return render_template('tasks.html', form=form, edit_mode=True, tasks=tasks)
 
 @app.route('/task/<int:task_id>/delete', methods=['POST'])
@@ -308,11 +323,24 @@ def delete_task(task_id):
     flash('Task deleted successfully', 'success')
     return redirect(url_for('tasks'))
 
+def _render_time_entries(**context):
+    """Render one keyset page of the current user's entries, streamed if requested"""
+    per_page = request.args.get('per_page', type=int) or app.config['TIME_ENTRIES_PAGE_SIZE']
+    per_page = max(1, min(per_page, app.config['TIME_ENTRIES_MAX_PAGE_SIZE']))
+    cursor = request.args.get('cursor')
+    # Rows are loaded up front: a streamed template renders after the session is closed
+    query = TimeEntry.query.options(*entry_list_options())
+    entries, next_cursor = get_time_entries_page(current_user.id, cursor, per_page, query=query)
+    
+    context.update(entries=entries, next_cursor=next_cursor, cursor=cursor, per_page=per_page)
+    if request.args.get('stream', type=int, default=int(app.config['TIME_ENTRIES_STREAM'])):
+        return stream_template('time_entries.html', **context)
+    return render_template('time_entries.html', **context)
+
 @app.route('/time-entries')
 @login_required
 def time_entries():
-    entries = TimeEntry.query.filter_by(user_id=current_user.id).order_by(TimeEntry.start_time.desc()).all()
-    return render_template('time_entries.html', entries=entries)
+    return _render_time_entries()
 
 @app.route('/time-entry/<int:entry_id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -340,6 +368,11 @@ def edit_time_entry(entry_id):
             flash('Invalid project selected', 'danger')
             return redirect(url_for('time_entries'))
         
+        # Only one timer runs at a time, as when starting one
+        if form.status.data == 'running' and entry.status != 'running':
+            timer.stop_running(current_user.id, current_user.timezone or 'UTC')
+
+        before = rollups.contribution(entry)
         entry.project_id = form.project_id.data
         entry.task_id = form.task_id.data if form.task_id.data != 0 else None
         entry.description = form.description.data
@@ -353,16 +386,24 @@ def edit_time_entry(entry_id):
             if entry.status == 'completed' and entry.start_time:
                 entry.end_time = entry.start_time + timedelta(seconds=duration_seconds)
         
-        db.session.commit()
+        try:
+            rollups.record_change(before, entry)
+            db.session.commit()
+        except IntegrityError:
+            # Another timer was started at the same time
+            db.session.rollback()
+            flash('Another timer is already running', 'danger')
+            return redirect(url_for('time_entries'))
         flash('Time entry updated successfully', 'success')
         return redirect(url_for('time_entries'))
     
-    return render_template('time_entries.html', form=form, edit_mode=True, entry_id=entry_id, entries=TimeEntry.query.filter_by(user_id=current_user.id).order_by(TimeEntry.start_time.desc()).all())
+    return _render_time_entries(form=form, edit_mode=True, entry_id=entry_id)
 
 @app.route('/time-entry/<int:entry_id>/delete', methods=['POST'])
 @login_required
 def delete_time_entry(entry_id):
     entry = TimeEntry.query.filter_by(id=entry_id, user_id=current_user.id).first_or_404()
+    rollups.record_change(rollups.contribution(entry), None)
     db.session.delete(entry)
     db.session.commit()
     flash('Time entry deleted successfully', 'success')
@@ -390,11 +431,12 @@ def timer_start():
             if not task:
                 task_id = None
         
-        entry = start_timer(
+        timer.start(
             user_id=current_user.id,
             project_id=form.project_id.data,
             task_id=task_id,
-            description=form.description.data
+            description=form.description.data,
+            timezone_str=current_user.timezone or 'UTC'
         )
         
         flash('Timer started', 'success')
@@ -406,12 +448,12 @@ def timer_start():
 @app.route('/timer/<int:entry_id>/pause', methods=['POST'])
 @login_required
 def timer_pause(entry_id):
-    entry = TimeEntry.query.filter_by(id=entry_id, user_id=current_user.id).first_or_404()
-    
-    if entry.status == 'running':
-        pause_timer(entry_id)
+    try:
+        timer.pause(entry_id, current_user.id, current_user.timezone or 'UTC')
         flash('Timer paused', 'info')
-    else:
+    except timer.TimerNotFound:
+        abort(404)
+    except timer.TimerConflict:
         flash('Timer is not running', 'warning')
     
     return redirect(url_for('dashboard'))
@@ -419,12 +461,12 @@ def timer_pause(entry_id):
 @app.route('/timer/<int:entry_id>/resume', methods=['POST'])
 @login_required
 def timer_resume(entry_id):
-    entry = TimeEntry.query.filter_by(id=entry_id, user_id=current_user.id).first_or_404()
-    
-    if entry.status == 'paused':
-        resume_timer(entry_id)
+    try:
+        timer.resume(entry_id, current_user.id, current_user.timezone or 'UTC')
         flash('Timer resumed', 'success')
-    else:
+    except timer.TimerNotFound:
+        abort(404)
+    except timer.TimerConflict:
         flash('Timer is not paused', 'warning')
     
     return redirect(url_for('dashboard'))
@@ -432,12 +474,12 @@ def timer_resume(entry_id):
 @app.route('/timer/<int:entry_id>/stop', methods=['POST'])
 @login_required
 def timer_stop(entry_id):
-    entry = TimeEntry.query.filter_by(id=entry_id, user_id=current_user.id).first_or_404()
-    
-    if entry.status in ['running', 'paused']:
-        stop_timer(entry_id)
+    try:
+        timer.stop(entry_id, current_user.id, current_user.timezone or 'UTC')
         flash('Timer stopped', 'success')
-    else:
+    except timer.TimerNotFound:
+        abort(404)
+    except timer.TimerConflict:
         flash('Timer is already completed', 'warning')
     
     return redirect(url_for('dashboard'))
@@ -446,6 +488,7 @@ def timer_stop(entry_id):
 @login_required
 def timezone_converter():
     form = TimezoneConverterForm()
+    form.source_timezone.choices = form.target_timezone.choices = timezones.offset_choices()
     result = None
     
     if form.validate_on_submit():
@@ -472,11 +515,56 @@ def timezone_converter():
                 flash('Please enter a date and time', 'warning')
             
         except Exception as e:
-            app.logger.error(f'Timezone conversion error: {str(e)}')
+            app.logger.error('Timezone conversion error: %s', e)
             flash('Error converting time. Please check the format (YYYY-MM-DD HH:MM)', 'danger')
     
     return render_template('timezone_converter.html', form=form, result=result)
 
+@app.route('/meeting-planner', methods=['GET', 'POST'])
+@login_required
+def meeting_planner():
+    """Find times when everyone is within their working hours"""
+    user_tz = current_user.timezone or 'UTC'
+    form = MeetingPlannerForm()
+    if request.method == 'GET':
+        form.participant_timezones.data = user_tz
+        form.start_date.data = get_current_time_in_timezone(user_tz).strftime('%Y-%m-%d')
+
+    windows = None
+    zones = []
+    if form.validate_on_submit():
+        zones = list(dict.fromkeys(
+            line.strip() for line in form.participant_timezones.data.splitlines() if line.strip()
+        ))
+        try:
+            if len(zones) > planner.MAX_PARTICIPANTS:
+                raise ValueError(f'at most {planner.MAX_PARTICIPANTS} timezones')
+            work_start = planner.parse_hours(form.work_start.data)
+            work_end = planner.parse_hours(form.work_end.data)
+            participants = [planner.Participant(zone, work_start, work_end) for zone in zones]
+            start = timezones.local_to_utc(datetime.strptime(form.start_date.data.strip(), '%Y-%m-%d'), user_tz)
+            found = planner.find_meeting_windows(
+                participants, start, start + timedelta(weeks=form.weeks.data),
+                min_duration=timedelta(minutes=form.min_minutes.data)
+            )
+            windows = [{
+                'start': timezones.utc_to_local(window_start, user_tz),
+                'end': timezones.utc_to_local(window_end, user_tz),
+                'minutes': int((window_end - window_start).total_seconds()) // 60,
+                'local_starts': [(zone, timezones.utc_to_local(window_start, zone)) for zone in zones],
+            } for window_start, window_end in found]
+        except timezones.UnknownTimezoneError as e:
+            flash(f'Unknown timezone: {e.args[0]}', 'danger')
+        except (ValueError, OverflowError) as e:
+            app.logger.error('Meeting planner error: %s', e)
+            flash('Please check the hours (HH:MM), the date (YYYY-MM-DD) and the timezones', 'danger')
+
+    offsets = [
+        (zone, timezones.format_offset(int(timezones.current_utc_offset(zone).total_seconds())))
+        for zone in zones if windows is not None
+    ]
+    return render_template('meeting_planner.html', form=form, windows=windows, user_tz=user_tz, offsets=offsets)
+
 @app.route('/reports')
 @login_required
 def reports():
@@ -490,55 +578,37 @@ def reports():
     try:
         # Try to get weekly stats
         try:
-            weekly_stats = get_weekly_stats(current_user.id)
+            weekly_stats = get_weekly_stats(current_user.id, current_user.timezone)
         except Exception as e:
-            app.logger.error(f"Error getting weekly stats: {str(e)}")
+            app.logger.error("Error getting weekly stats: %s", e)
             
         # Try to get project stats
         try:
             project_stats = get_project_stats(current_user.id)
         except Exception as e:
-            app.logger.error(f"Error getting project stats: {str(e)}")
+            app.logger.error("Error getting project stats: %s", e)
             
         # Get time entries for the last 30 days
         thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        entries = TimeEntry.query.filter(
+        entries = TimeEntry.query.options(*entry_list_options()).filter(
             TimeEntry.user_id == current_user.id,
             TimeEntry.start_time >= thirty_days_ago
         ).order_by(TimeEntry.start_time.desc()).all()
         
-        # Calculate total time by project
+        # Calculate total time by project in the database
         project_totals = {}
-        for entry in entries:
-            project_id = entry.project_id
-            project_name = entry.project.name
-            
-            if project_id not in project_totals:
-                project_totals[project_id] = {
-                    'name': project_name,
-                    'total_seconds': 0,
-                    'color': entry.project.color
-                }
-            
-            if hasattr(entry, 'is_running') and callable(entry.is_running) and entry.is_running():
-                # Calculate duration for running entries
-                duration = (datetime.utcnow() - entry.start_time).total_seconds()
-            elif hasattr(entry, 'duration') and entry.duration:
-                duration = entry.duration
-            else:
-                duration = 0
-                
-            project_totals[project_id]['total_seconds'] += duration
-        
-        # Format the duration for display
-        for project_id in project_totals:
-            seconds = project_totals[project_id]['total_seconds']
-            hours, remainder = divmod(seconds, 3600)
+        for project in stats_project_totals(current_user.id, since=thirty_days_ago):
+            hours, remainder = divmod(project['seconds'], 3600)
             minutes, _ = divmod(remainder, 60)
-            project_totals[project_id]['formatted_time'] = f"{int(hours)}h {int(minutes)}m"
+            project_totals[project['id']] = {
+                'name': project['name'],
+                'total_seconds': project['seconds'],
+                'color': project['color'],
+                'formatted_time': f"{int(hours)}h {int(minutes)}m"
+            }
             
     except Exception as e:
-        app.logger.error(f"Error in reports view: {str(e)}")
+        app.logger.error("Error in reports view: %s", e)
         flash("An error occurred while loading reports. Please try again.", "danger")
     
     return render_template(
@@ -549,6 +619,32 @@ def reports():
         entries=entries
     )
 
+@app.route('/export/time-entries')
+@login_required
+def export_time_entries():
+    """Stream the user's entries as CSV or NDJSON, filtered by date range, project and task"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in exporter.WRITERS:
+        return jsonify({'error': f'unsupported format {fmt}'}), 400
+    user_tz = current_user.timezone
+    try:
+        filters = {
+            'start': exporter.parse_date(request.args.get('start'), user_tz),
+            'end': exporter.parse_date(request.args.get('end'), user_tz),
+            'project_id': request.args.get('project_id', type=int),
+            'task_id': request.args.get('task_id', type=int),
+        }
+    except ValueError:
+        return jsonify({'error': 'dates must be YYYY-MM-DD'}), 400
+    
+    writer, mimetype = exporter.WRITERS[fmt]
+    records = exporter.export_records(current_user.id, user_tz, **filters)
+    return Response(
+        stream_with_context(writer(records)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=time-entries.{fmt}'}
+    )
+
 @app.route('/get-tasks/<int:project_id>')
 @login_required
 def get_tasks(project_id):
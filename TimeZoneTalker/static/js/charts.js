@@ -186,6 +186,99 @@ function generateColors(count) {
     return colors;
 }
 
+// Fetch a time series report: {start, end, granularity, group_by}
+function fetchReport(params) {
+    const query = new URLSearchParams();
+    Object.entries(params || {}).forEach(([key, value]) => {
+        if (value !== undefined && value !== null && value !== '') {
+            query.set(key, Array.isArray(value) ? value.join(',') : value);
+        }
+    });
+    return fetch(`/api/v1/reports/timeseries?${query}`, {
+        credentials: 'same-origin',
+        headers: { 'Accept': 'application/json' }
+    }).then(response => response.json().then(body => {
+        if (!response.ok) {
+            throw new Error(body.error || `Report request failed (${response.status})`);
+        }
+        return body;
+    }));
+}
+
+// Label of one report series, e.g. "Website / Design / #meeting"
+function reportSeriesLabel(key) {
+    const parts = [];
+    if ('project' in key) parts.push(key.project.name);
+    if ('task' in key) parts.push(key.task ? key.task.name : 'No task');
+    if ('tag' in key) parts.push(key.tag ? `#${key.tag}` : 'Untagged');
+    return parts.length ? parts.join(' / ') : 'Total';
+}
+
+let reportChart = null;
+
+// Stacked bars of a report from fetchReport(), one dataset per series
+function renderReportChart(canvasId, report) {
+    const canvas = document.getElementById(canvasId);
+    if (!canvas) {
+        console.error('Canvas element not found:', canvasId);
+        return;
+    }
+
+    if (!report || !Array.isArray(report.buckets) || !Array.isArray(report.series)) {
+        console.error('Invalid report data');
+        return;
+    }
+
+    const colors = generateColors(report.series.length);
+    const datasets = report.series.map((series, i) => ({
+        label: reportSeriesLabel(series.key),
+        data: series.seconds.map(seconds => Math.round(seconds / 36) / 100),
+        backgroundColor: series.key.project && !('task' in series.key) && !('tag' in series.key)
+            ? series.key.project.color
+            : colors[i],
+        borderWidth: 1
+    }));
+
+    // Tagged entries can count in several series, so only stack when they can't
+    const stacked = !(report.group_by || []).includes('tag');
+
+    if (reportChart) {
+        reportChart.destroy();
+    }
+    reportChart = new Chart(canvas.getContext('2d'), {
+        type: 'bar',
+        data: {
+            labels: report.buckets,
+            datasets: datasets.length ? datasets : [{ label: 'Hours', data: report.buckets.map(() => 0) }]
+        },
+        options: {
+            responsive: true,
+            scales: {
+                x: { stacked: stacked },
+                y: {
+                    stacked: stacked,
+                    beginAtZero: true,
+                    title: {
+                        display: true,
+                        text: 'Hours'
+                    }
+                }
+            },
+            plugins: {
+                tooltip: {
+                    callbacks: {
+                        label: function(context) {
+                            return `${context.dataset.label}: ${context.raw} hours`;
+                        }
+                    }
+                }
+            }
+        }
+    });
+}
+
 // Export functions
 window.renderWeeklyChart = renderWeeklyChart;
 window.renderProjectChart = renderProjectChart;
+window.fetchReport = fetchReport;
+window.renderReportChart = renderReportChart;
@@ -1,6 +1,7 @@
 // Handle timer functionality
 let timerInterval;
 let timerElement;
+let shownEntry = null;
 
 function startTimer(startTimestamp) {
     timerElement = document.getElementById('timer-display');
@@ -24,34 +25,34 @@ function updateTimer(startTimestamp) {
     if (!timerElement) return;
     
     const now = Math.floor(Date.now() / 1000);
-    const elapsedSeconds = now - startTimestamp;
+    const elapsedSeconds = Math.max(now - startTimestamp, 0);
     
     // Format time as HH:MM:SS
-    const hours = Math.floor(elapsedSeconds / 3600);
-    const minutes = Math.floor((elapsedSeconds % 3600) / 60);
-    const seconds = elapsedSeconds % 60;
-    
-    timerElement.textContent = `${hours.toString().padStart(2, '0')}:${minutes.toString().padStart(2, '0')}:${seconds.toString().padStart(2, '0')}`;
+    timerElement.textContent = formatDuration(elapsedSeconds);
+}
+
+function formatDuration(totalSeconds) {
+    const hours = Math.floor(totalSeconds / 3600);
+    const minutes = Math.floor((totalSeconds % 3600) / 60);
+    const seconds = totalSeconds % 60;
+    return `${hours.toString().padStart(2, '0')}:${minutes.toString().padStart(2, '0')}:${seconds.toString().padStart(2, '0')}`;
 }
 
 function updateTimerDisplay(element) {
     // This function is used to display the current duration for paused timers
     if (!element) return;
     
-    // Get the data from the element
-    const startTime = parseInt(element.dataset.startTime);
     const status = element.dataset.status;
     
     if (status === 'paused') {
-        // For paused timers, we assume the duration is already calculated and stored
-        // So we just display it correctly by making an AJAX call to get the current duration
+        // Paused timers don't tick, so ask the API for the stored duration
         const entryId = document.getElementById('entry-id').value;
         if (entryId) {
-            fetch(`/timer/${entryId}/duration`)
+            fetch(`/api/v1/timer/${entryId}`)
                 .then(response => response.json())
                 .then(data => {
-                    if (data.duration) {
-                        element.textContent = data.duration;
+                    if (data.entry) {
+                        element.textContent = formatDuration(data.entry.duration);
                     }
                 })
                 .catch(error => {
@@ -61,6 +62,140 @@ function updateTimerDisplay(element) {
     }
 }
 
+// JSON timer API: one small request per action, no redirect or page rebuild
+function timerRequest(url, body) {
+    const token = document.querySelector('meta[name="csrf-token"]');
+    return fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': token ? token.content : ''
+        },
+        body: JSON.stringify(body || {})
+    }).then(response => response.json().then(data => {
+        if (!response.ok && !data.entry) {
+            throw new Error(data.error || `Timer request failed (${response.status})`);
+        }
+        return data.entry;
+    }));
+}
+
+// Show a timer entry (or no timer) in the dashboard widget
+function renderTimerState(entry) {
+    const widget = document.getElementById('active-timer');
+    const startForm = document.getElementById('timer-start-form');
+    if (!widget) return;
+    
+    const done = !entry || entry.status === 'completed';
+    shownEntry = done ? null : entry;
+    widget.classList.toggle('d-none', done);
+    if (startForm) startForm.classList.toggle('d-none', !done);
+    
+    if (done) {
+        stopTimer();
+        document.getElementById('entry-id').value = '';
+        return;
+    }
+    
+    document.getElementById('entry-id').value = entry.id;
+    const project = document.getElementById('active-project');
+    project.textContent = entry.project.name;
+    project.style.color = entry.project.color;
+    document.getElementById('active-task').textContent = entry.task ? entry.task.name : '';
+    document.getElementById('active-description').textContent = entry.description || 'No description';
+    
+    const display = document.getElementById('timer-display');
+    display.dataset.status = entry.status;
+    display.dataset.startTime = entry.started_at;
+    if (entry.status === 'running') {
+        startTimer(Math.floor(Date.now() / 1000) - entry.duration);
+    } else {
+        stopTimer();
+        display.textContent = formatDuration(entry.duration);
+    }
+    
+    widget.querySelectorAll('[data-timer-action]').forEach(button => {
+        const action = button.dataset.timerAction;
+        const visible = action === 'stop'
+            || (action === 'pause' && entry.status === 'running')
+            || (action === 'resume' && entry.status === 'paused');
+        button.classList.toggle('d-none', !visible);
+    });
+}
+
+function initTimerControls() {
+    const widget = document.getElementById('active-timer');
+    if (widget) {
+        widget.querySelectorAll('[data-timer-action]').forEach(button => {
+            button.addEventListener('click', () => {
+                const entryId = document.getElementById('entry-id').value;
+                button.disabled = true;
+                timerRequest(`/api/v1/timer/${entryId}/${button.dataset.timerAction}`)
+                    .then(renderTimerState)
+                    .catch(error => console.error('Timer action failed:', error))
+                    .finally(() => { button.disabled = false; });
+            });
+        });
+    }
+    
+    const startForm = document.getElementById('timer-start-form');
+    if (startForm) {
+        startForm.addEventListener('submit', event => {
+            event.preventDefault();
+            const data = new FormData(startForm);
+            timerRequest('/api/v1/timer/start', {
+                project_id: data.get('project_id'),
+                task_id: data.get('task_id'),
+                description: data.get('description')
+            })
+                .then(renderTimerState)
+                .catch(error => console.error('Could not start timer:', error));
+        });
+    }
+}
+
+// Apply a timer change pushed by the server (from this or another tab or device)
+function applyTimerEvent(change) {
+    const shownId = document.getElementById('entry-id').value;
+    const isShown = shownId !== '' && String(change.id) === shownId;
+    
+    if (change.status === 'completed' || change.status === 'deleted') {
+        if (isShown) renderTimerState(null);
+        return;
+    }
+    
+    const duration = change.status === 'running'
+        ? Math.max(Math.floor(Date.now() / 1000) - change.started_at, 0)
+        : change.duration;
+    const sameLabels = isShown && shownEntry
+        && shownEntry.project.id === change.project_id
+        && (shownEntry.task ? shownEntry.task.id : null) === change.task_id;
+    if (sameLabels) {
+        renderTimerState(Object.assign({}, shownEntry, {
+            status: change.status,
+            description: change.description,
+            started_at: change.started_at,
+            duration: duration
+        }));
+        return;
+    }
+    
+    // A different timer or new labels: fetch the names once
+    fetch(`/api/v1/timer/${change.id}`)
+        .then(response => response.json())
+        .then(data => { if (data.entry) renderTimerState(data.entry); })
+        .catch(error => console.error('Error loading timer:', error));
+}
+
+function subscribeTimerEvents() {
+    const widget = document.getElementById('active-timer');
+    // The server renders data-events="on" only when events are published
+    if (!window.EventSource || !widget || widget.dataset.events !== 'on') return null;
+    const source = new EventSource('/api/v1/timer/events');
+    source.addEventListener('timer', event => applyTimerEvent(JSON.parse(event.data)));
+    return source;
+}
+
 // Function to stop timer
 function stopTimer() {
     if (timerInterval) {
@@ -73,3 +208,6 @@ function stopTimer() {
 window.startTimer = startTimer;
 window.stopTimer = stopTimer;
 window.updateTimerDisplay = updateTimerDisplay;
+window.initTimerControls = initTimerControls;
+window.renderTimerState = renderTimerState;
+window.subscribeTimerEvents = subscribeTimerEvents;
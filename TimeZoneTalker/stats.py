@@ -0,0 +1,216 @@
+from bisect import bisect_left, bisect_right
+import calendar
+from datetime import datetime, time, timedelta
+import timezones
+from sqlalchemy import BigInteger, case, func, null, or_, select, union_all
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from models import Project, TimeEntry
+from app import app, db
+
+
+def local_day_bounds(timezone_str, first_day, days):
+    """Return UTC (naive) midnights for `days` consecutive local days starting at first_day"""
+    return [
+        timezones.local_to_utc(datetime.combine(first_day + timedelta(days=i), time()), timezone_str)
+        for i in range(days + 1)
+    ]
+
+
+class epoch_seconds(FunctionElement):
+    """Whole seconds since 1970-01-01 of a naive UTC timestamp"""
+    type = BigInteger()
+    inherit_cache = True
+
+
+@compiles(epoch_seconds)
+def _epoch_seconds(element, compiler, **kw):
+    return f"CAST(FLOOR(EXTRACT(EPOCH FROM {compiler.process(element.clauses, **kw)})) AS BIGINT)"
+
+
+@compiles(epoch_seconds, 'sqlite')
+def _epoch_seconds_sqlite(element, compiler, **kw):
+    return f"CAST(strftime('%s', {compiler.process(element.clauses, **kw)}) AS INTEGER)"
+
+
+@compiles(epoch_seconds, 'mysql')
+@compiles(epoch_seconds, 'mariadb')
+def _epoch_seconds_mysql(element, compiler, **kw):
+    # UNIX_TIMESTAMP() would read the value in the session time zone
+    return f"TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', {compiler.process(element.clauses, **kw)})"
+
+
+def to_epoch(naive_utc):
+    return calendar.timegm(naive_utc.utctimetuple())
+
+
+def clip_intervals(intervals, bounds):
+    """Seconds of (start, end) intervals falling between each pair of consecutive bounds.
+
+    Intervals and bounds are epoch seconds, bounds ascending. Each interval is
+    clipped to the range and split at every bound it crosses, so time is
+    counted in the bucket it was spent in rather than the one it started in.
+    An interval costs two bisections whatever its length: the buckets it
+    covers completely are counted in a difference array that is summed once
+    for the whole batch at the end.
+    """
+    buckets = len(bounds) - 1
+    totals = [0] * buckets
+    covered = [0] * (buckets + 1)
+    first, last = bounds[0], bounds[-1]
+    for start, end in intervals:
+        start, end = max(start, first), min(end, last)
+        if end <= start:
+            continue
+        i = bisect_right(bounds, start) - 1
+        j = bisect_left(bounds, end) - 1
+        if i == j:
+            totals[i] += end - start
+            continue
+        totals[i] += bounds[i + 1] - start
+        totals[j] += end - bounds[j]
+        covered[i + 1] += 1
+        covered[j] -= 1
+
+    spanning = 0
+    for k in range(buckets):
+        spanning += covered[k]
+        if spanning:
+            totals[k] += spanning * (bounds[k + 1] - bounds[k])
+    return totals
+
+
+def daily_totals_statement(user_id, bounds):
+    """The single query behind split_daily_totals(), for sync or async execution
+
+    Returns (start, end, status) in epoch seconds for every entry overlapping
+    the bounds, with a null end for time that is still growing. That includes
+    entries that start up to REPORT_LOOKBACK_HOURS before the first bound and
+    run into it, and the running timer however long ago it started.
+    """
+    start = epoch_seconds(TimeEntry.start_time).label('start')
+    end = case(
+        (TimeEntry.status == 'running', null()),
+        (TimeEntry.duration.isnot(None), epoch_seconds(TimeEntry.start_time) + TimeEntry.duration),
+        else_=epoch_seconds(TimeEntry.end_time),
+    )
+    since = bounds[0] - timedelta(hours=app.config.get('REPORT_LOOKBACK_HOURS', 24))
+
+    settled = select(start, end.label('end'), TimeEntry.status).where(
+        TimeEntry.user_id == user_id,
+        TimeEntry.start_time >= since,
+        TimeEntry.start_time < bounds[-1],
+        TimeEntry.status != 'running',
+        or_(TimeEntry.start_time >= bounds[0], end > to_epoch(bounds[0])),
+    )
+    # Not bounded by start time, so that the (user_id, status) index is used
+    running = select(start, end.label('end'), TimeEntry.status).where(
+        TimeEntry.user_id == user_id,
+        TimeEntry.status == 'running',
+    )
+    return union_all(settled, running)
+
+
+def fold_daily_rows(rows, bounds):
+    """Turn daily_totals_statement() rows into (settled totals, live)
+
+    live lists the start, in epoch seconds, of each entry whose duration keeps
+    growing and must be added at read time.
+    """
+    intervals = []
+    live = []
+    for row in rows:
+        if row.end is not None:
+            intervals.append((row.start, row.end))
+        elif row.status != 'paused':
+            live.append(row.start)
+    return clip_intervals(intervals, [to_epoch(bound) for bound in bounds]), live
+
+
+def split_daily_totals(user_id, bounds):
+    """Settled seconds per bucket between consecutive UTC bounds, from a single query.
+
+    Entries are split at the bounds they cross. Returns (settled totals, live)
+    as fold_daily_rows() does.
+    """
+    return fold_daily_rows(db.session.execute(daily_totals_statement(user_id, bounds)), bounds)
+
+
+def add_live_time(totals, live, bounds, now=None):
+    """Return totals with each live entry's time from its start until now added, split at the bounds"""
+    if now is None:
+        now = datetime.utcnow()
+    now = to_epoch(now)
+    clipped = clip_intervals([(start, now) for start in live], [to_epoch(bound) for bound in bounds])
+    return [total + seconds for total, seconds in zip(totals, clipped)]
+
+
+def daily_totals(user_id, bounds, now=None):
+    """Tracked seconds per bucket between consecutive UTC bounds, live entries included"""
+    if now is None:
+        now = datetime.utcnow()
+    totals, live = split_daily_totals(user_id, bounds)
+    return add_live_time(totals, live, bounds, now=now)
+
+
+def current_week(timezone_str='UTC', now=None):
+    """Return (local days, UTC bounds) of the current week in the given timezone"""
+    if now is None:
+        now = datetime.utcnow()
+    local_today = timezones.local_date(now, timezone_str)
+    start_of_week = local_today - timedelta(days=local_today.weekday())
+
+    days = [start_of_week + timedelta(days=i) for i in range(7)]
+    return days, local_day_bounds(timezone_str, start_of_week, 7)
+
+
+def weekly_totals(user_id, timezone_str='UTC', now=None):
+    """Return (local days, seconds per day) for the current week in the user's timezone"""
+    days, bounds = current_week(timezone_str, now=now)
+    return days, daily_totals(user_id, bounds, now=now)
+
+
+def project_totals_statement(user_id, since=None, statuses=None):
+    """The single join behind project_totals(), for sync or async execution"""
+    query = select(
+        Project.id,
+        Project.name,
+        Project.color,
+        func.sum(case((TimeEntry.status == 'running', 0), else_=func.coalesce(TimeEntry.duration, 0))).label('seconds'),
+        func.min(case((TimeEntry.status == 'running', TimeEntry.start_time))).label('running_since'),
+    ).join(TimeEntry, TimeEntry.project_id == Project.id).where(
+        TimeEntry.user_id == user_id,
+    ).group_by(Project.id, Project.name, Project.color).order_by(Project.id)
+
+    if since is not None:
+        query = query.where(TimeEntry.start_time >= since)
+    if statuses is not None:
+        query = query.where(TimeEntry.status.in_(statuses))
+    return query
+
+
+def fold_project_rows(rows, now=None):
+    """Turn project_totals_statement() rows into dicts, adding live time of running entries"""
+    if now is None:
+        now = datetime.utcnow()
+    totals = []
+    for row in rows:
+        seconds = int(row.seconds or 0)
+        if row.running_since is not None:
+            seconds += max(int((now - row.running_since).total_seconds()), 0)
+        totals.append({
+            'id': row.id,
+            'name': row.name,
+            'color': row.color or '#6c757d',
+            'seconds': seconds,
+        })
+    return totals
+
+
+def project_totals(user_id, since=None, statuses=None, now=None):
+    """Total tracked seconds per project, summed in the database with a single join.
+
+    Returns a list of dicts with id, name, color and seconds, one per project
+    that has matching entries. Running entries contribute their live duration.
+    """
+    return fold_project_rows(db.session.execute(project_totals_statement(user_id, since, statuses)), now=now)
@@ -0,0 +1,210 @@
+"""Auto-stop for forgotten timers.
+
+A timer left running keeps adding time to the dashboard, the weekly chart
+and every report until someone stops it. `flask timers sweep`, run from
+cron, stops such timers by two per-user rules:
+
+- max duration: a running timer is stopped at its start plus
+  timer_max_hours;
+- idle: once a user has made no request for timer_idle_minutes, their
+  running timer is stopped at their last activity.
+
+A paused timer that either rule would stop is completed with the time it
+has settled. A null user setting falls back to TIMER_MAX_HOURS or
+TIMER_IDLE_MINUTES, and 0 turns the rule off.
+
+Users are read in batches by id. Their running and paused entries come from
+the (user_id, status) index, and each batch is stopped with one UPDATE per
+state (see timer.stop_stale) and committed on its own.
+
+Activity is recorded from requests at most once per TIMER_ACTIVITY_INTERVAL
+seconds per user and process, so the idle rule can cut a timer short by up
+to that much. Nothing is recorded for users the idle rule doesn't apply to.
+"""
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+from flask import request
+from flask_login import current_user
+from sqlalchemy import select, update
+from app import app, db
+from models import User, TimeEntry
+import timer
+
+logger = logging.getLogger(__name__)
+
+REASONS = ('max_hours', 'idle')
+
+# Requests a page makes on its own, which don't show that anyone is there
+PASSIVE_ENDPOINTS = (None, 'static', 'api_timer_events')
+
+_recorded = {}
+_recorded_lock = threading.Lock()
+
+
+def activity_due(user_id):
+    """Claim the user's next activity write, unless one was made in the last TIMER_ACTIVITY_INTERVAL seconds"""
+    interval = app.config.get('TIMER_ACTIVITY_INTERVAL', 300)
+    moment = time.monotonic()
+    with _recorded_lock:
+        last = _recorded.get(user_id)
+        if last is not None and moment - last < interval:
+            return False
+        _recorded[user_id] = moment
+    return True
+
+
+def activity_statement(user_id, now=None):
+    # A Core UPDATE, so the cached session principal is kept
+    return (
+        update(User).where(User.id == user_id).values(last_active_at=now or datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def record_activity(user_id, now=None):
+    """Save the user's last activity, unless it was saved in the last TIMER_ACTIVITY_INTERVAL seconds"""
+    if not activity_due(user_id):
+        return False
+    # Called before the view runs, so committing here can't take any of its changes along
+    db.session.execute(activity_statement(user_id, now))
+    db.session.commit()
+    return True
+
+
+@app.before_request
+def _record_request_activity():
+    # The principal carries the idle setting, so this check costs no query
+    if request.endpoint in PASSIVE_ENDPOINTS or not current_user.is_authenticated or not idle_limit(current_user):
+        return
+    try:
+        record_activity(current_user.id)
+    except Exception:
+        db.session.rollback()
+        logger.exception("Could not record activity for user %s", current_user.id)
+
+
+def idle_limit(user):
+    """The idle minutes that apply to a user row or principal, 0 meaning off"""
+    idle_minutes = user.timer_idle_minutes
+    if idle_minutes is None:
+        idle_minutes = app.config.get('TIMER_IDLE_MINUTES', 0)
+    return idle_minutes
+
+
+def limits(user):
+    """The (max hours, idle minutes) that apply to a user row, 0 meaning off"""
+    max_hours = user.timer_max_hours
+    if max_hours is None:
+        max_hours = app.config.get('TIMER_MAX_HOURS', 12)
+    return max_hours, idle_limit(user)
+
+
+def stop_time(entry, user, now):
+    """(end time, reason) at which a rule stops an entry, or None if none applies yet"""
+    max_hours, idle_minutes = limits(user)
+    candidates = []
+    if max_hours and now - entry.start_time >= timedelta(hours=max_hours):
+        candidates.append((entry.start_time + timedelta(hours=max_hours), 'max_hours'))
+    if idle_minutes:
+        # Starting a timer is activity too, even if it fell within the recording interval
+        last_active = max(user.last_active_at or entry.start_time, entry.start_time)
+        if now - last_active >= timedelta(minutes=idle_minutes):
+            candidates.append((last_active, 'idle'))
+    return min(candidates) if candidates else None
+
+
+class SweepResult:
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.users = 0
+        self.stopped = {reason: 0 for reason in REASONS}
+        self.completed = 0
+        self.entries = []
+
+    def add(self, entry, user, end_time, reason):
+        if entry.status == 'running':
+            self.stopped[reason] += 1
+            duration = int((end_time - entry.start_time).total_seconds())
+        else:
+            self.completed += 1
+            end_time, duration = None, entry.duration or 0
+        self.entries.append({
+            'id': entry.id,
+            'user_id': entry.user_id,
+            'username': user.username,
+            'previous_status': entry.status,
+            'reason': reason,
+            'start_time': entry.start_time.isoformat(),
+            'end_time': end_time.isoformat() if end_time else None,
+            'duration': duration,
+        })
+
+    def to_dict(self):
+        return {
+            'dry_run': self.dry_run,
+            'users': self.users,
+            'stopped': dict(self.stopped),
+            'completed': self.completed,
+            'entries': self.entries,
+        }
+
+
+def sweep(batch_size=500, dry_run=False, now=None):
+    """Stop stale running timers and complete stale paused ones, returning a SweepResult"""
+    if now is None:
+        now = datetime.utcnow()
+    result = SweepResult(dry_run=dry_run)
+    last_id = 0
+    while True:
+        users = db.session.execute(
+            select(
+                User.id, User.username, User.timezone,
+                User.timer_max_hours, User.timer_idle_minutes, User.last_active_at,
+            ).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        ).all()
+        if not users:
+            break
+        last_id = users[-1].id
+        result.users += len(users)
+        by_id = {user.id: user for user in users if any(limits(user))}
+        if not by_id:
+            continue
+
+        entries = db.session.execute(
+            select(
+                TimeEntry.id, TimeEntry.user_id, TimeEntry.status, TimeEntry.start_time, TimeEntry.duration,
+            ).where(
+                TimeEntry.user_id.in_(by_id),
+                TimeEntry.status.in_(('running', 'paused')),
+            )
+        ).all()
+
+        running, paused, planned = {}, {}, {}
+        for entry in entries:
+            stop = stop_time(entry, by_id[entry.user_id], now)
+            if stop is None:
+                continue
+            end_time, reason = stop
+            if entry.status == 'running':
+                running[entry.id] = (entry.start_time, end_time)
+            else:
+                paused[entry.id] = entry.start_time
+            planned[entry.id] = (entry, end_time, reason)
+
+        if dry_run:
+            changed = list(planned)
+        else:
+            user_timezones = {user.id: user.timezone or 'UTC' for user in by_id.values()}
+            changed = [entry.id for entry in timer.stop_stale(running, paused, user_timezones)]
+            db.session.commit()
+        for entry_id in changed:
+            entry, end_time, reason = planned[entry_id]
+            result.add(entry, by_id[entry.user_id], end_time, reason)
+
+    logger.info(
+        "Timer sweep%s: %d users, stopped %s, completed %d paused",
+        ' (dry run)' if dry_run else '', result.users, result.stopped, result.completed,
+    )
+    return result
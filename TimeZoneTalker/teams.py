@@ -0,0 +1,196 @@
+"""Team and organization reports.
+
+A report sums the settled time of every member of a team or an organization
+over a range of local days. It is grouped by team, user, project or day, and
+runs as one grouped query however many users are in scope. The window
+functions in the same query also give the total number of groups and the
+total seconds, so a page of groups needs no separate count query.
+
+Grouped by team, someone in two teams counts toward both, and organization
+members in no team form a "No team" group. The total still counts each
+person's time once.
+
+Reports read the daily rollup table by default. Pass source='entries' to sum
+the raw time entries instead, for example after a bulk import and before
+`flask rollups rebuild`. Entries are selected by UTC start time, so day
+grouping is only available from the rollups, whose days are local to each
+user.
+
+Pages are cached in report_cache for REPORT_CACHE_TTL seconds. A membership
+change clears its organization's and team's pages at once. New time shows up
+once the TTL runs out.
+"""
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, literal, select
+from app import app, db
+from models import (
+    User, Project, TimeEntry, DailyProjectRollup, OrganizationMember, Team, TeamMember
+)
+from rollups import SETTLED_STATUSES
+import cache
+
+SCOPES = ('organization', 'team')
+GROUPINGS = ('team', 'user', 'project', 'day')
+SOURCES = ('rollups', 'entries')
+NO_TEAM = 'No team'
+
+
+class ReportError(ValueError):
+    pass
+
+
+def organization_role(user_id, organization_id):
+    return db.session.execute(select(OrganizationMember.role).where(
+        OrganizationMember.organization_id == organization_id, OrganizationMember.user_id == user_id
+    )).scalar()
+
+
+def can_view(user_id, scope, scope_id):
+    """Organization admins see every report in their organization; team managers see their team's"""
+    if scope == 'organization':
+        return organization_role(user_id, scope_id) == 'admin'
+    team = db.session.execute(select(Team.organization_id).where(Team.id == scope_id)).scalar()
+    if team is None:
+        return False
+    role = db.session.execute(select(TeamMember.role).where(
+        TeamMember.team_id == scope_id, TeamMember.user_id == user_id
+    )).scalar()
+    return role == 'manager' or organization_role(user_id, team) == 'admin'
+
+
+def _members(scope, scope_id):
+    if scope == 'organization':
+        return select(OrganizationMember.user_id).where(OrganizationMember.organization_id == scope_id)
+    return select(TeamMember.user_id).where(TeamMember.team_id == scope_id)
+
+
+def _facts(source, members, since, until):
+    """(user_id, project_id, day, seconds) rows of the members' settled time"""
+    if source == 'rollups':
+        return select(
+            DailyProjectRollup.user_id,
+            DailyProjectRollup.project_id,
+            DailyProjectRollup.day,
+            DailyProjectRollup.seconds,
+        ).where(
+            DailyProjectRollup.user_id.in_(members),
+            DailyProjectRollup.day >= since,
+            DailyProjectRollup.day < until,
+        ).subquery('facts')
+    return select(
+        TimeEntry.user_id,
+        TimeEntry.project_id,
+        literal(None).label('day'),
+        TimeEntry.duration.label('seconds'),
+    ).where(
+        TimeEntry.user_id.in_(members),
+        TimeEntry.status.in_(SETTLED_STATUSES),
+        TimeEntry.duration > 0,
+        TimeEntry.start_time >= datetime.combine(since, datetime.min.time()),
+        TimeEntry.start_time < datetime.combine(until, datetime.min.time()),
+    ).subquery('facts')
+
+
+def report_statement(scope, scope_id, since, until, group_by='team', source='rollups', page=1, per_page=50):
+    """The grouped query behind report(), one row per group on the page"""
+    if scope not in SCOPES:
+        raise ReportError(f"scope must be one of {', '.join(SCOPES)}")
+    if group_by not in GROUPINGS:
+        raise ReportError(f"group_by must be one of {', '.join(GROUPINGS)}")
+    if source not in SOURCES:
+        raise ReportError(f"source must be one of {', '.join(SOURCES)}")
+    if group_by == 'day' and source != 'rollups':
+        raise ReportError('day grouping needs the rollup source')
+
+    facts = _facts(source, _members(scope, scope_id), since, until)
+    seconds = func.sum(facts.c.seconds)
+    total_seconds = func.sum(seconds).over()
+    if group_by == 'team':
+        teams = select(Team.id, Team.name, TeamMember.user_id).join(TeamMember, TeamMember.team_id == Team.id)
+        if scope == 'organization':
+            teams = teams.where(Team.organization_id == scope_id)
+        else:
+            teams = teams.where(Team.id == scope_id)
+        teams = teams.subquery('teams')
+        key, label, extra = teams.c.id, func.coalesce(teams.c.name, NO_TEAM), None
+        query = select(key, label).select_from(facts).outerjoin(teams, teams.c.user_id == facts.c.user_id)
+        # The join repeats the time of people in several teams, so sum the facts on their own
+        total_seconds = select(func.sum(facts.c.seconds)).correlate(None).scalar_subquery()
+    elif group_by == 'user':
+        key, label, extra = User.id, User.username, None
+        query = select(key, label).select_from(facts).join(User, User.id == facts.c.user_id)
+    elif group_by == 'project':
+        key, label, extra = Project.id, Project.name, Project.color
+        query = select(key, label, extra).select_from(facts).join(Project, Project.id == facts.c.project_id)
+    else:
+        key, label, extra = facts.c.day, None, None
+        query = select(key).select_from(facts)
+
+    grouping = [column for column in (key, label, extra) if column is not None]
+    return query.add_columns(
+        seconds.label('seconds'),
+        func.count().over().label('total_groups'),
+        total_seconds.label('total_seconds'),
+    ).group_by(*grouping).order_by(seconds.desc(), key).limit(per_page).offset((page - 1) * per_page)
+
+
+def _group(row, group_by):
+    if group_by == 'day':
+        day = row[0]
+        group = {'key': day.isoformat() if isinstance(day, date) else day, 'label': str(day)}
+    else:
+        group = {'key': row[0], 'label': row[1]}
+        if group_by == 'project':
+            group['color'] = row[2] or '#6c757d'
+    group['seconds'] = int(row.seconds or 0)
+    group['hours'] = round(group['seconds'] / 3600, 2)
+    return group
+
+
+def report(scope, scope_id, since, until, group_by='team', source='rollups', page=1, per_page=50):
+    """One page of a team or organization report, from the cache or one grouped query"""
+    key = cache.report_key(scope, scope_id, since, until, group_by, source, page, per_page)
+    result = cache.report_cache.get(key)
+    if result is not None:
+        return result
+
+    statement = report_statement(scope, scope_id, since, until, group_by, source, page, per_page)
+    rows = db.session.execute(statement).all()
+    if rows:
+        total_groups, total_seconds = rows[0].total_groups, int(rows[0].total_seconds or 0)
+    elif page > 1:
+        # Past the last page, so the window totals came back empty
+        first = db.session.execute(
+            report_statement(scope, scope_id, since, until, group_by, source, 1, 1)
+        ).first()
+        total_groups, total_seconds = (first.total_groups, int(first.total_seconds or 0)) if first else (0, 0)
+    else:
+        total_groups, total_seconds = 0, 0
+
+    result = {
+        'scope': scope,
+        'id': scope_id,
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'group_by': group_by,
+        'source': source,
+        'page': page,
+        'per_page': per_page,
+        'total_groups': total_groups,
+        'total_seconds': total_seconds,
+        'groups': [_group(row, group_by) for row in rows],
+    }
+    cache.report_cache.set(key, result)
+    return result
+
+
+def default_range(today=None):
+    """The last 30 days, ending with today"""
+    today = today or datetime.utcnow().date()
+    return today - timedelta(days=29), today + timedelta(days=1)
+
+
+def page_size(value):
+    """Clamp a requested page size to the configured limits"""
+    default = app.config.get('TEAM_REPORT_PAGE_SIZE', 50)
+    return max(1, min(value or default, app.config.get('TEAM_REPORT_MAX_PAGE_SIZE', 500)))
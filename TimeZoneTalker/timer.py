@@ -0,0 +1,288 @@
+"""Timer state machine with atomic transitions.
+
+    start             stop the user's running timer, then insert a running one
+    pause             running -> paused
+    resume            paused  -> running
+    stop              running or paused -> completed
+    stop_running      the user's running timer -> completed, before another
+                      entry is made running outside these transitions
+    stop_stale        many running or paused -> completed, for the sweeper
+
+Each transition is a single conditional UPDATE:
+
+    UPDATE time_entry SET ... WHERE id = ? AND user_id = ? AND status = ?
+
+It returns the new row where the database supports RETURNING. The database
+computes the elapsed time from the stored start time, so nothing has to be
+read first. When two devices act on the same timer at once, only one
+statement matches the row. The other raises TimerConflict instead of writing
+over the first.
+
+Resume is the exception: its rollup day comes from the start time being
+replaced, and RETURNING can't report old values. It reads that start time
+first and makes the UPDATE conditional on it.
+
+Starting or resuming a timer stops the running one in the same transaction.
+The unique index on running entries rejects a concurrent second one, and the
+transition is retried.
+
+Rollups are adjusted in the same transaction. The stats cache and live timer
+events follow on commit, as they do for ORM writes.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, Integer, case, literal, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from app import db
+from models import TimeEntry
+import cache
+import pubsub
+import rollups
+
+ATTEMPTS = 3
+
+
+class TimerError(Exception):
+    pass
+
+
+class TimerNotFound(TimerError, LookupError):
+    """No such entry, or it belongs to someone else"""
+
+
+class TimerConflict(TimerError):
+    """The entry isn't in a state the transition starts from"""
+
+    def __init__(self, entry):
+        super().__init__(f"timer is {entry.status}")
+        self.entry = entry
+
+
+class elapsed_seconds(FunctionElement):
+    """Whole seconds from one timestamp to another, truncated like calculate_duration_seconds()
+
+    Never negative: a transition computed at `now` can land after a
+    concurrent resume that set a later start time, and counts no time then.
+    """
+    type = Integer()
+    inherit_cache = True
+
+
+@compiles(elapsed_seconds)
+def _elapsed_seconds(element, compiler, **kw):
+    start, end = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f"GREATEST(CAST(FLOOR(EXTRACT(EPOCH FROM ({end} - {start}))) AS INTEGER), 0)"
+
+
+@compiles(elapsed_seconds, 'sqlite')
+def _elapsed_seconds_sqlite(element, compiler, **kw):
+    start, end = (compiler.process(clause, **kw) for clause in element.clauses)
+    # Rounded to the millisecond first so float error can't drop a whole second
+    return f"MAX(CAST(ROUND((julianday({end}) - julianday({start})) * 86400, 3) AS INTEGER), 0)"
+
+
+@compiles(elapsed_seconds, 'mysql')
+@compiles(elapsed_seconds, 'mariadb')
+def _elapsed_seconds_mysql(element, compiler, **kw):
+    start, end = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f"GREATEST(TIMESTAMPDIFF(SECOND, {start}, {end}), 0)"
+
+
+def _owned(statement, entry_id, user_id):
+    statement = statement.where(TimeEntry.id == entry_id)
+    if user_id is not None:
+        statement = statement.where(TimeEntry.user_id == user_id)
+    return statement
+
+
+def _execute(statement):
+    """Run an UPDATE of time entries and return the entries it changed"""
+    statement = statement.execution_options(synchronize_session=False)
+    if db.session.get_bind().dialect.update_returning:
+        result = db.session.execute(statement.returning(TimeEntry), execution_options={'populate_existing': True})
+        return result.scalars().all()
+    # Without RETURNING: lock the matching rows, update them, then read them back
+    ids = db.session.execute(
+        select(TimeEntry.id).where(statement.whereclause).with_for_update()
+    ).scalars().all()
+    if not ids:
+        return []
+    db.session.execute(statement)
+    return db.session.execute(
+        select(TimeEntry).where(TimeEntry.id.in_(ids)).execution_options(populate_existing=True)
+    ).scalars().all()
+
+
+def _notify(entry, start_times=()):
+    """Stats cache and timer events, once the transaction commits"""
+    cache.mark_stale(db.session, cache.entry_keys(
+        entry.user_id, {entry.start_time, *start_times}, cache.entry_end(entry)
+    ))
+    pubsub.record_entry(db.session, entry)
+
+
+def _settle(entry, before, timezone_str, start_times=()):
+    rollups.record_change(before, entry, timezone_str)
+    _notify(entry, start_times)
+
+
+def _refuse(entry_id, user_id):
+    entry = db.session.execute(_owned(select(TimeEntry), entry_id, user_id)).scalar()
+    db.session.rollback()
+    if entry is None:
+        raise TimerNotFound(entry_id)
+    raise TimerConflict(entry)
+
+
+def _stop_statement(now):
+    return update(TimeEntry).where(TimeEntry.status == 'running').values(
+        status='completed',
+        end_time=now,
+        duration=elapsed_seconds(TimeEntry.start_time, literal(now, DateTime)),
+    )
+
+
+def _stop_running(user_id, now, timezone_str):
+    for stopped in _execute(_stop_statement(now).where(TimeEntry.user_id == user_id)):
+        _settle(stopped, None, timezone_str)
+
+
+def _retrying(transition, *args):
+    """Run a transition that leaves a timer running, again if a concurrent one took the unique index first"""
+    for attempt in range(ATTEMPTS):
+        try:
+            return transition(*args)
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == ATTEMPTS - 1:
+                raise
+
+
+def start(user_id, project_id, task_id=None, description=None, timezone_str=None):
+    """Start a running timer for the user, stopping any that is already running"""
+    return _retrying(_start, user_id, project_id, task_id, description, timezone_str)
+
+
+def _start(user_id, project_id, task_id, description, timezone_str):
+    now = datetime.utcnow()
+    _stop_running(user_id, now, timezone_str)
+    entry = TimeEntry(
+        user_id=user_id, project_id=project_id, task_id=task_id, description=description,
+        start_time=now, status='running',
+    )
+    db.session.add(entry)
+    db.session.commit()
+    return entry
+
+
+def pause(entry_id, user_id=None, timezone_str=None):
+    """Pause a running timer, settling its time so far"""
+    now = datetime.utcnow()
+    statement = update(TimeEntry).where(TimeEntry.status == 'running').values(
+        status='paused',
+        duration=elapsed_seconds(TimeEntry.start_time, literal(now, DateTime)),
+    )
+    entries = _execute(_owned(statement, entry_id, user_id))
+    if not entries:
+        _refuse(entry_id, user_id)
+    _settle(entries[0], None, timezone_str)
+    db.session.commit()
+    return entries[0]
+
+
+def resume(entry_id, user_id=None, timezone_str=None):
+    """Resume a paused timer, backdating its start by the time already settled"""
+    return _retrying(_resume, entry_id, user_id, timezone_str)
+
+
+def _resume(entry_id, user_id, timezone_str):
+    prior = db.session.execute(_owned(
+        select(
+            TimeEntry.user_id, TimeEntry.project_id, TimeEntry.task_id,
+            TimeEntry.start_time, TimeEntry.duration, TimeEntry.status,
+        ).where(TimeEntry.status == 'paused'), entry_id, user_id
+    )).first()
+    if prior is None:
+        _refuse(entry_id, user_id)
+
+    now = datetime.utcnow()
+    # Only one timer runs at a time, as when starting one
+    _stop_running(prior.user_id, now, timezone_str)
+    unchanged = TimeEntry.duration.is_(None) if prior.duration is None else TimeEntry.duration == prior.duration
+    statement = update(TimeEntry).where(
+        TimeEntry.status == 'paused', TimeEntry.start_time == prior.start_time, unchanged,
+    ).values(
+        status='running',
+        start_time=now - timedelta(seconds=prior.duration or 0),
+    )
+    entries = _execute(_owned(statement, entry_id, user_id))
+    if not entries:
+        _refuse(entry_id, user_id)
+    # The paused time leaves the rollups until the timer settles again
+    _settle(entries[0], rollups.contribution(prior, timezone_str), timezone_str, start_times=(prior.start_time,))
+    db.session.commit()
+    return entries[0]
+
+
+def stop(entry_id, user_id=None, timezone_str=None):
+    """Complete a running or paused timer"""
+    # Running timers are the usual case; a paused one keeps its settled duration
+    entries = _execute(_owned(_stop_statement(datetime.utcnow()), entry_id, user_id))
+    if entries:
+        _settle(entries[0], None, timezone_str)
+    else:
+        statement = update(TimeEntry).where(TimeEntry.status == 'paused').values(status='completed')
+        entries = _execute(_owned(statement, entry_id, user_id))
+        if not entries:
+            _refuse(entry_id, user_id)
+        # Its settled time is already in the rollups
+        _notify(entries[0])
+    db.session.commit()
+    return entries[0]
+
+
+def stop_running(user_id, timezone_str=None):
+    """Complete the user's running timer before another entry becomes running; the caller commits"""
+    _stop_running(user_id, datetime.utcnow(), timezone_str)
+
+
+def stop_stale(running, paused, user_timezones):
+    """Complete many timers with one UPDATE per state, as read by the sweeper
+
+    running maps entry id to (start_time, end_time) and stops each running
+    entry at its end_time; paused maps entry id to start_time and completes
+    those entries with the duration they have settled. An entry is only
+    changed if it is still in the state, with the start time, it was read
+    with, so a timer stopped, paused or resumed in the meantime is left
+    alone. user_timezones maps user id to the timezone for rollups. Returns the
+    entries changed; the caller commits.
+    """
+    changed = []
+    if running:
+        statement = update(TimeEntry).where(
+            TimeEntry.id.in_(running),
+            TimeEntry.status == 'running',
+            TimeEntry.start_time == case({id: start for id, (start, _) in running.items()}, value=TimeEntry.id),
+        ).values(
+            status='completed',
+            end_time=case({id: end for id, (_, end) in running.items()}, value=TimeEntry.id),
+            duration=case(
+                {id: int((end - start).total_seconds()) for id, (start, end) in running.items()},
+                value=TimeEntry.id,
+            ),
+        )
+        for entry in _execute(statement):
+            _settle(entry, None, user_timezones.get(entry.user_id))
+            changed.append(entry)
+    if paused:
+        statement = update(TimeEntry).where(
+            TimeEntry.id.in_(paused),
+            TimeEntry.status == 'paused',
+            TimeEntry.start_time == case(paused, value=TimeEntry.id),
+        ).values(status='completed')
+        for entry in _execute(statement):
+            # Its settled time is already in the rollups
+            _notify(entry)
+            changed.append(entry)
+    return changed
@@ -0,0 +1,305 @@
+"""Shared timezone registry.
+
+Zone objects are built once per name and reused, the select-field choices are
+one immutable tuple shared by every form, and current UTC offsets for the
+common zones are computed in one pass and reused until the next quarter hour
+(DST transitions happen on quarter-hour boundaries). The converter and
+meeting planner pages show those offsets.
+
+Zones come from the standard library's zoneinfo. pytz is only used as a
+fallback for names the system tz database doesn't know, and for its curated
+list of common zone names.
+
+Batch conversions skip tzinfo objects altogether: each zone's UTC offsets
+are flattened once into a transition table and every timestamp is resolved
+with a binary search over it. The tables are read from the same zone objects
+as get_zone(), so batch and single conversions agree. They cover
+TABLE_YEARS; times outside that range, and zones a batch mentions too few
+times to be worth a table, go through the zone objects.
+"""
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import threading
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import pytz
+
+UTC = timezone.utc
+
+COMMON_TIMEZONES = tuple(pytz.common_timezones)
+TIMEZONE_CHOICES = tuple((tz, tz) for tz in COMMON_TIMEZONES)
+
+
+class UnknownTimezoneError(KeyError):
+    """Raised for a timezone name neither zoneinfo nor pytz knows"""
+
+
+@lru_cache(maxsize=None)
+def get_zone(name):
+    """Return the tzinfo for a zone name, cached for the life of the process"""
+    if not name:
+        name = 'UTC'
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        pass
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        raise UnknownTimezoneError(name)
+
+
+def localize(naive, name):
+    """Attach a zone to a naive local datetime"""
+    zone = get_zone(name)
+    if hasattr(zone, 'localize'):
+        # pytz zones need localize() to pick the right offset
+        return zone.localize(naive)
+    return naive.replace(tzinfo=zone)
+
+
+def utc_to_local(naive_utc, name):
+    """Aware local time for a naive UTC datetime"""
+    return naive_utc.replace(tzinfo=UTC).astimezone(get_zone(name))
+
+
+def local_to_utc(naive_local, name):
+    """Naive UTC datetime for a naive local datetime in the given zone"""
+    return localize(naive_local, name).astimezone(UTC).replace(tzinfo=None)
+
+
+def local_date(naive_utc, name):
+    """Local calendar date of a naive UTC datetime"""
+    return utc_to_local(naive_utc, name).date()
+
+
+_offsets_lock = threading.Lock()
+_offsets = {'bucket': None, 'offsets': {}, 'choices': TIMEZONE_CHOICES}
+
+
+def _current_offsets():
+    now = datetime.now(UTC)
+    bucket = now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0)
+    with _offsets_lock:
+        if _offsets['bucket'] != bucket:
+            offsets = {
+                name: int(bucket.astimezone(get_zone(name)).utcoffset().total_seconds())
+                for name in COMMON_TIMEZONES
+            }
+            _offsets['offsets'] = offsets
+            _offsets['choices'] = tuple(
+                (name, f'{name} (UTC{format_offset(offsets[name])})') for name in COMMON_TIMEZONES
+            )
+            _offsets['bucket'] = bucket
+        return _offsets
+
+
+def current_utc_offsets():
+    """Current UTC offset in seconds of every common zone, recomputed every 15 minutes"""
+    return _current_offsets()['offsets']
+
+
+def current_utc_offset(name):
+    """Current UTC offset of a zone, from the precomputed table when it is a common zone"""
+    offsets = current_utc_offsets()
+    if name in offsets:
+        return timedelta(seconds=offsets[name])
+    return datetime.now(get_zone(name)).utcoffset()
+
+
+def offset_choices():
+    """Select-field choices labelled with each common zone's current UTC offset"""
+    return _current_offsets()['choices']
+
+
+_EPOCH = datetime(1970, 1, 1)
+_SECOND = timedelta(seconds=1)
+
+
+class TransitionTable:
+    """Sorted UTC offset transitions of one zone, in epoch seconds"""
+
+    __slots__ = ('utc_starts', 'local_starts', 'offsets')
+
+    def __init__(self, utc_starts, offsets):
+        self.utc_starts = utc_starts
+        self.offsets = offsets
+        # A local time inside a gap or an overlap keeps the offset from before
+        # the transition, matching zoneinfo's fold=0
+        self.local_starts = [utc_starts[0]] + [
+            start + max(offsets[i - 1], offsets[i]) for i, start in enumerate(utc_starts) if i
+        ]
+
+    def utc_offset(self, utc_seconds):
+        """Offset in effect at a UTC instant"""
+        return self.offsets[max(bisect_right(self.utc_starts, utc_seconds) - 1, 0)]
+
+    def local_offset(self, local_seconds):
+        """Offset in effect at a wall-clock time in the zone"""
+        return self.offsets[max(bisect_right(self.local_starts, local_seconds) - 1, 0)]
+
+
+# Years the transition tables cover, and the step they are sampled at: no zone
+# changes its offset twice within a week in this range
+TABLE_YEARS = (1970, 2100)
+_TABLE_START = (datetime(TABLE_YEARS[0], 1, 1) - _EPOCH) // _SECOND
+_TABLE_END = (datetime(TABLE_YEARS[1], 1, 1) - _EPOCH) // _SECOND
+_TABLE_STEP = 7 * 24 * 3600
+# Local times this close to the ends of the tables are converted directly
+_TABLE_MARGIN = 2 * 24 * 3600
+
+
+# A zone's table is built once a batch converts this many of its times;
+# building one costs about as much as converting a few thousand directly
+TABLE_MIN_ITEMS = 500
+
+_tables = {}
+
+
+def has_transition_table(name):
+    return name in _tables
+
+
+def transition_table(name):
+    """The transition table of a zone, built once per process"""
+    table = _tables.get(name)
+    if table is None:
+        table = _tables[name] = _build_transition_table(name)
+    return table
+
+
+def _build_transition_table(name):
+    # The offset get_zone() gives is sampled weekly across TABLE_YEARS, and
+    # each change is narrowed down to the second by bisection
+    zone = get_zone(name)
+
+    def offset(utc_seconds):
+        return int(datetime.fromtimestamp(utc_seconds, zone).utcoffset().total_seconds())
+
+    utc_starts = [_TABLE_START]
+    offsets = [offset(_TABLE_START)]
+    previous = _TABLE_START
+    for sample in range(_TABLE_START + _TABLE_STEP, _TABLE_END + _TABLE_STEP, _TABLE_STEP):
+        current = offset(sample)
+        if current != offsets[-1]:
+            low, high = previous, sample
+            while high - low > 1:
+                middle = (low + high) // 2
+                if offset(middle) == offsets[-1]:
+                    low = middle
+                else:
+                    high = middle
+            utc_starts.append(high)
+            offsets.append(current)
+        previous = sample
+    return TransitionTable(utc_starts, offsets)
+
+
+def in_table_range(local_seconds):
+    return _TABLE_START + _TABLE_MARGIN <= local_seconds < _TABLE_END - _TABLE_MARGIN
+
+
+def convert_one(value, source_name, target_name):
+    """Convert one naive local datetime through the zone objects, as (local time, offset seconds)"""
+    converted = localize(value, source_name).astimezone(get_zone(target_name))
+    return converted.replace(tzinfo=None), int(converted.utcoffset().total_seconds())
+
+
+def broadcast_zones(zones, count):
+    """One zone name per value, from either a single name or a sequence"""
+    if isinstance(zones, str):
+        return [zones] * count
+    if len(zones) != count:
+        raise ValueError('expected one zone per timestamp')
+    return zones
+
+
+# Pairs converted at least this many times in one batch get a merged table
+PAIR_TABLE_MIN_ITEMS = 64
+
+
+class PairTable:
+    """Shift from source wall-clock time to target wall-clock time, by source local seconds"""
+
+    __slots__ = ('starts', 'shifts')
+
+    def __init__(self, source, target):
+        # The shift can only change where either zone's offset changes
+        breakpoints = set(source.local_starts)
+        breakpoints.update(start + source.utc_offset(start) for start in target.utc_starts)
+        self.starts = [float('-inf')] + sorted(breakpoints)
+        self.shifts = []
+        for i, start in enumerate(self.starts):
+            local = self.starts[1] if i == 0 else start
+            source_offset = source.local_offset(local)
+            target_offset = target.utc_offset(local - source_offset)
+            self.shifts.append((timedelta(seconds=target_offset - source_offset), target_offset))
+
+
+@lru_cache(maxsize=1024)
+def pair_table(source_name, target_name):
+    return PairTable(transition_table(source_name), transition_table(target_name))
+
+
+def convert_batch(values, source_zones, target_zones):
+    """Convert naive local datetimes between zones in one pass
+
+    source_zones and target_zones are either one zone name for every value or
+    a sequence with one name per value. Returns a list of (naive local time in
+    the target zone, target UTC offset in seconds).
+    """
+    sources = broadcast_zones(source_zones, len(values))
+    targets = broadcast_zones(target_zones, len(values))
+    if isinstance(source_zones, str) and isinstance(target_zones, str):
+        groups = {(source_zones, target_zones): range(len(values))}
+    else:
+        groups = {}
+        for index, pair in enumerate(zip(sources, targets)):
+            groups.setdefault(pair, []).append(index)
+
+    if isinstance(source_zones, str) and isinstance(target_zones, str):
+        counts = Counter({source_zones: len(values)})
+        counts[target_zones] += len(values)
+    else:
+        counts = Counter(sources)
+        counts.update(targets)
+
+    results = [None] * len(values)
+    for (source, target), indices in groups.items():
+        if not all(has_transition_table(name) or counts[name] >= TABLE_MIN_ITEMS for name in (source, target)):
+            # Too few times in these zones to pay for building their tables
+            for i in indices:
+                results[i] = convert_one(values[i], source, target)
+        elif len(indices) >= PAIR_TABLE_MIN_ITEMS:
+            table = pair_table(source, target)
+            starts, shifts = table.starts, table.shifts
+            for i in indices:
+                value = values[i]
+                local_seconds = (value - _EPOCH) // _SECOND
+                if not in_table_range(local_seconds):
+                    results[i] = convert_one(value, source, target)
+                    continue
+                shift, offset = shifts[bisect_right(starts, local_seconds) - 1]
+                results[i] = (value + shift, offset)
+        else:
+            source_table, target_table = transition_table(source), transition_table(target)
+            local_starts, source_offsets = source_table.local_starts, source_table.offsets
+            utc_starts, target_offsets = target_table.utc_starts, target_table.offsets
+            for i in indices:
+                value = values[i]
+                local_seconds = (value - _EPOCH) // _SECOND
+                if not in_table_range(local_seconds):
+                    results[i] = convert_one(value, source, target)
+                    continue
+                source_offset = source_offsets[max(bisect_right(local_starts, local_seconds) - 1, 0)]
+                offset = target_offsets[max(bisect_right(utc_starts, local_seconds - source_offset) - 1, 0)]
+                results[i] = (value + timedelta(seconds=offset - source_offset), offset)
+    return results
+
+
+def format_offset(seconds):
+    """Render an offset in seconds as +HH:MM"""
+    sign = '-' if seconds < 0 else '+'
+    minutes = abs(seconds) // 60
+    return f'{sign}{minutes // 60:02d}:{minutes % 60:02d}'
@@ -1,31 +1,36 @@
 from datetime import datetime, timedelta
-import pytz
+import logging
+import timezones
+from sqlalchemy import and_, or_
 from models import TimeEntry
 from app import db
+from stats import current_week, split_daily_totals, add_live_time
+import rollups
+import cache
+import timer
+from instrumentation import span
+
+logger = logging.getLogger(__name__)
 
 def get_current_time_in_timezone(timezone_str):
     """Get the current time in the specified timezone"""
     try:
         if not timezone_str:
             timezone_str = 'UTC'
-        timezone = pytz.timezone(timezone_str)
-        return datetime.now(timezone)
+        return datetime.now(timezones.get_zone(timezone_str))
     except Exception as e:
-        import logging
-        logging.error(f"Error getting current time in timezone {timezone_str}: {str(e)}")
+        logger.error("Error getting current time in timezone %s: %s", timezone_str, e)
         # Return UTC time as fallback
-        return datetime.now(pytz.UTC)
+        return datetime.now(timezones.UTC)
 
 def convert_timezone(dt, from_tz, to_tz):
     """Convert a datetime from one timezone to another"""
     # If dt doesn't have tzinfo, assume it's in from_tz
     if dt.tzinfo is None:
-        source_tz = pytz.timezone(from_tz)
-        dt = source_tz.localize(dt)
+        dt = timezones.localize(dt, from_tz)
     
     # Convert to target timezone
-    target_tz = pytz.timezone(to_tz)
-    return dt.astimezone(target_tz)
+    return dt.astimezone(timezones.get_zone(to_tz))
 
 def calculate_duration_seconds(start_time, end_time=None):
     """Calculate duration between start and end time in seconds"""
@@ -34,9 +39,9 @@ def calculate_duration_seconds(start_time, end_time=None):
     
     # Ensure both times are timezone-aware or naive
     if start_time.tzinfo is not None and end_time.tzinfo is None:
-        end_time = pytz.UTC.localize(end_time)
+        end_time = end_time.replace(tzinfo=timezones.UTC)
     elif start_time.tzinfo is None and end_time.tzinfo is not None:
-        start_time = pytz.UTC.localize(start_time)
+        start_time = start_time.replace(tzinfo=timezones.UTC)
     
     return int((end_time - start_time).total_seconds())
 
@@ -58,125 +63,107 @@ def format_duration(seconds):
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
 def get_all_timezones():
-    """Return a list of all timezone choices"""
-    return [(tz, tz) for tz in pytz.common_timezones]
+    """Return the shared tuple of timezone choices"""
+    return timezones.TIMEZONE_CHOICES
 
-def start_timer(user_id, project_id, task_id=None, description=None):
-    """Start a new timer for the user"""
-    # Check if user has any running timers
-    running_entry = TimeEntry.query.filter_by(
-        user_id=user_id, 
-        status='running'
-    ).first()
-    
-    if running_entry:
-        # Stop existing timer
-        running_entry.end_time = datetime.utcnow()
-        running_entry.duration = calculate_duration_seconds(running_entry.start_time, running_entry.end_time)
-        running_entry.status = 'completed'
+def encode_entry_cursor(entry):
+    """Keyset cursor pointing just past an entry in (start_time, id) descending order"""
+    return f"{entry.start_time.isoformat()}_{entry.id}"
+
+def decode_entry_cursor(cursor):
+    """Parse a cursor from encode_entry_cursor, returning (start_time, id) or None"""
+    try:
+        start_str, entry_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(start_str), int(entry_id)
+    except (AttributeError, ValueError):
+        return None
+
+def get_time_entries_page(user_id, cursor=None, per_page=50, query=None):
+    """Return (entries, next_cursor) for one page of a user's entries, newest first.
+
+    Uses keyset pagination on (start_time, id) so each page costs the same
+    regardless of how far back it is.
+    """
+    if query is None:
+        query = TimeEntry.query
+    query = query.filter(TimeEntry.user_id == user_id)
     
-    # Create new timer
-    new_entry = TimeEntry()
-    new_entry.user_id = user_id
-    new_entry.project_id = project_id
-    new_entry.task_id = task_id
-    new_entry.description = description
-    new_entry.start_time = datetime.utcnow()
-    new_entry.status = 'running'
+    position = decode_entry_cursor(cursor) if cursor else None
+    if position:
+        start_time, entry_id = position
+        query = query.filter(or_(
+            TimeEntry.start_time < start_time,
+            and_(TimeEntry.start_time == start_time, TimeEntry.id < entry_id)
+        ))
     
-    db.session.add(new_entry)
-    db.session.commit()
-    return new_entry
+    # Fetch one extra row to find out whether there is another page
+    entries = query.order_by(TimeEntry.start_time.desc(), TimeEntry.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(entries) > per_page:
+        entries = entries[:per_page]
+        next_cursor = encode_entry_cursor(entries[-1])
+    return entries, next_cursor
+
+def start_timer(user_id, project_id, task_id=None, description=None):
+    """Start a new timer for the user"""
+    return timer.start(user_id, project_id, task_id, description)
+
+def _timer_action(action, time_entry_id):
+    # Like the transitions themselves, but return the entry as it stands when they don't apply
+    try:
+        return action(time_entry_id)
+    except timer.TimerError:
+        return db.session.get(TimeEntry, time_entry_id)
 
 def pause_timer(time_entry_id):
     """Pause a running timer"""
-    entry = TimeEntry.query.get(time_entry_id)
-    if entry and entry.status == 'running':
-        current_duration = calculate_duration_seconds(entry.start_time, datetime.utcnow())
-        entry.duration = current_duration
-        entry.status = 'paused'
-        db.session.commit()
-    return entry
+    return _timer_action(timer.pause, time_entry_id)
 
 def resume_timer(time_entry_id):
     """Resume a paused timer"""
-    entry = TimeEntry.query.get(time_entry_id)
-    if entry and entry.status == 'paused':
-        # Store existing duration
-        existing_duration = entry.duration or 0
-        
-        # Set new start time (now - existing duration)
-        entry.start_time = datetime.utcnow() - timedelta(seconds=existing_duration)
-        entry.status = 'running'
-        db.session.commit()
-    return entry
+    return _timer_action(timer.resume, time_entry_id)
 
 def stop_timer(time_entry_id):
     """Stop a timer (mark as completed)"""
-    entry = TimeEntry.query.get(time_entry_id)
-    if entry and (entry.status == 'running' or entry.status == 'paused'):
-        if entry.status == 'running':
-            entry.end_time = datetime.utcnow()
-            entry.duration = calculate_duration_seconds(entry.start_time, entry.end_time)
-        entry.status = 'completed'
-        db.session.commit()
-    return entry
-
-def get_weekly_stats(user_id):
+    return _timer_action(timer.stop, time_entry_id)
+
+def cache_weekly_totals(key, split):
+    """Store split_daily_totals() output in the stats cache, in its JSON form"""
+    cached = {'settled': split[0], 'live': split[1]}
+    cache.stats_cache.set(key, cached)
+    return cached
+
+def weekly_stats_payload(days, cached, bounds):
+    """Chart data for a week from cached settled totals plus the live time of running entries"""
+    totals = add_live_time(cached['settled'], cached['live'], bounds)
+    
+    day_labels = [day.strftime('%a') for day in days]
+    days = [day.strftime('%Y-%m-%d') for day in days]
+    # Convert seconds to hours
+    daily_hours = [round(total / 3600, 1) for total in totals]
+    
+    # Return values as simple types, not methods
+    return {
+        'days': list(days),
+        'labels': list(day_labels),
+        'values': list(daily_hours)
+    }
+
+@span('weekly_stats')
+def get_weekly_stats(user_id, timezone_str='UTC'):
     """Get weekly time tracking stats for visualization"""
     try:
-        now = datetime.utcnow()
-        start_of_week = now - timedelta(days=now.weekday())
-        start_of_week = start_of_week.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        days = []
-        day_labels = []
-        daily_hours = []
+        days, bounds = current_week(timezone_str)
         
-        for i in range(7):
-            day = start_of_week + timedelta(days=i)
-            next_day = day + timedelta(days=1)
-            day_label = day.strftime('%a')
-            
-            # Get time entries for this day
-            entries = TimeEntry.query.filter(
-                TimeEntry.user_id == user_id,
-                TimeEntry.start_time >= day,
-                TimeEntry.start_time < next_day
-            ).all()
-            
-            # Calculate total duration
-            total_duration = 0
-            for entry in entries:
-                # Check if entry has the is_running property (method)
-                # and access it directly if possible
-                if hasattr(entry, 'status') and entry.status == 'running':
-                    # Still running, calculate duration up to now
-                    duration = calculate_duration_seconds(entry.start_time)
-                elif hasattr(entry, 'status') and entry.status == 'paused':
-                    # Use the stored duration
-                    duration = entry.duration or 0
-                else:
-                    # Completed entry
-                    duration = entry.duration or calculate_duration_seconds(entry.start_time, entry.end_time)
-                total_duration += duration
-            
-            # Convert seconds to hours
-            hours = round(total_duration / 3600, 1)
-            
-            days.append(day.strftime('%Y-%m-%d'))
-            day_labels.append(day_label)
-            daily_hours.append(hours)
-        
-        # Return values as simple types, not methods
-        return {
-            'days': list(days),
-            'labels': list(day_labels),
-            'values': list(daily_hours)
-        }
+        # Settled totals come from the cache or one aggregate query, bucketed by
+        # local day in the user's timezone; running time is added on every read
+        key = cache.weekly_key(user_id, days[0])
+        cached = cache.stats_cache.get(key)
+        if cached is None:
+            cached = cache_weekly_totals(key, split_daily_totals(user_id, bounds))
+        return weekly_stats_payload(days, cached, bounds)
     except Exception as e:
-        import logging
-        logging.error(f"Error in get_weekly_stats: {str(e)}")
+        logger.error("Error in get_weekly_stats: %s", e)
         # Return empty data
         return {
             'days': [],
@@ -184,51 +171,33 @@ def get_weekly_stats(user_id):
             'values': []
         }
 
+def project_stats_payload(totals):
+    """Chart data from per-project totals"""
+    project_names = [str(project['name']) for project in totals]
+    # Convert seconds to hours
+    project_durations = [float(round(project['seconds'] / 3600, 1)) for project in totals]
+    project_colors = [str(project['color']) for project in totals]
+    
+    # Return values explicitly as simple types, not methods
+    return {
+        'labels': list(project_names),
+        'values': list(project_durations),
+        'colors': list(project_colors)
+    }
+
+@span('project_stats')
 def get_project_stats(user_id):
     """Get project time tracking stats for visualization"""
     try:
-        # Get all completed time entries for this user
-        entries = TimeEntry.query.filter(
-            TimeEntry.user_id == user_id,
-            TimeEntry.status == 'completed'
-        ).all()
-        
-        # Aggregate times by project
-        project_times = {}
-        for entry in entries:
-            project_id = entry.project_id
-            project_name = entry.project.name
-            duration = entry.duration or 0
-            
-            if project_id not in project_times:
-                project_times[project_id] = {
-                    'name': project_name,
-                    'duration': 0,
-                    'color': entry.project.color if hasattr(entry.project, 'color') and entry.project.color else '#6c757d'
-                }
-            
-            project_times[project_id]['duration'] += duration
-        
-        # Prepare data for chart
-        project_names = []
-        project_durations = []
-        project_colors = []
-        
-        for project_id, data in project_times.items():
-            project_names.append(str(data['name']))
-            # Convert seconds to hours
-            project_durations.append(float(round(data['duration'] / 3600, 1)))
-            project_colors.append(str(data['color']))
-        
-        # Return values explicitly as simple types, not methods
-        return {
-            'labels': list(project_names),
-            'values': list(project_durations),
-            'colors': list(project_colors)
-        }
+        # Settled totals per project, read from the cache or the daily rollup table
+        key = cache.projects_key(user_id)
+        totals = cache.stats_cache.get(key)
+        if totals is None:
+            totals = rollups.project_totals(user_id)
+            cache.stats_cache.set(key, totals)
+        return project_stats_payload(totals)
     except Exception as e:
-        import logging
-        logging.error(f"Error in get_project_stats: {str(e)}")
+        logger.error("Error in get_project_stats: %s", e)
         # Return empty data
         return {
             'labels': [],